@@ -0,0 +1,122 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Heatmap computation: each backend's `get_spy` and the full `to_spy_heatmap` path including shading.
+
+Bucket maps and projection matrices are cached between calls, so timings are of the steady state
+of a long-running process.
+"""
+
+import tracemalloc
+
+import matspy
+from matspy import to_spy_heatmap
+from matspy.adapters import ENGINES
+
+from .generators import BACKENDS, NNZ, PATTERNS, generate, make_matrix, load_email_eu_core
+
+
+def _peak_temp_bytes(func) -> int:
+    """
+    Peak memory allocated by `func` above what was allocated before the call.
+    Unlike asv's `peakmem_`, this excludes the matrix itself.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Heatmap:
+    """
+    Scaling with nnz, per backend and density pattern.
+    """
+    params = (BACKENDS, PATTERNS, NNZ)
+    param_names = ["backend", "pattern", "nnz"]
+    timeout = 600
+
+    def setup(self, backend, pattern, nnz):
+        shape, rows, cols = generate(pattern, nnz)
+        self.mat = make_matrix(backend, shape, rows, cols)
+        self.adapter = matspy._get_spy_adapter(self.mat)
+
+    def time_get_spy(self, backend, pattern, nnz):
+        self.adapter.get_spy((500, 500))
+
+    def time_to_spy_heatmap(self, backend, pattern, nnz):
+        to_spy_heatmap(self.mat, buckets=500)
+
+    def peakmem_to_spy_heatmap(self, backend, pattern, nnz):
+        to_spy_heatmap(self.mat, buckets=500)
+
+    def track_temp_bytes(self, backend, pattern, nnz):
+        return _peak_temp_bytes(lambda: to_spy_heatmap(self.mat, buckets=500))
+
+    track_temp_bytes.unit = "bytes"
+
+
+class Buckets:
+    """
+    Scaling with bucket count and shading mode, on a fixed matrix.
+    """
+    params = (["scipy_csr", "numpy"], ["binary", "relative", "absolute"], [64, 500, 4096])
+    param_names = ["backend", "shading", "buckets"]
+
+    def setup(self, backend, shading, buckets):
+        shape, rows, cols = generate("power_law", 10**6)
+        self.mat = make_matrix(backend, shape, rows, cols)
+
+    def time_to_spy_heatmap(self, backend, shading, buckets):
+        to_spy_heatmap(self.mat, buckets=buckets, shading=shading)
+
+    def track_temp_bytes(self, backend, shading, buckets):
+        return _peak_temp_bytes(lambda: to_spy_heatmap(self.mat, buckets=buckets, shading=shading))
+
+    track_temp_bytes.unit = "bytes"
+
+
+class Engines:
+    """
+    Each heatmap engine against each backend. The cost estimates used by the `'auto'` engine are fit to these.
+    """
+    params = (["scipy_csr", "scipy_coo", "numpy", "graphblas", "sparse_coo"], [e for e in ENGINES if e != "auto"],
+              ["uniform", "power_law"], [10**5, 10**7], [4, 500, 4096])
+    param_names = ["backend", "engine", "pattern", "nnz", "buckets"]
+    timeout = 600
+
+    def setup(self, backend, engine, pattern, nnz, buckets):
+        shape, rows, cols = generate(pattern, nnz)
+        self.adapter = matspy._get_spy_adapter(make_matrix(backend, shape, rows, cols))
+        if engine not in self.adapter.get_engines():
+            raise NotImplementedError(f"{backend} does not support {engine}")
+        self.adapter.set_option("engine", engine)
+        self.spy_shape = (min(buckets, shape[0]), min(buckets, shape[1]))
+
+    def time_get_spy(self, backend, engine, pattern, nnz, buckets):
+        self.adapter.get_spy(self.spy_shape)
+
+    def track_auto_chooses(self, backend, engine, pattern, nnz, buckets):
+        """
+        1 if `'auto'` would pick this engine, else 0. Compare with the timings to check the cost estimates.
+        """
+        self.adapter.set_option("engine", "auto")
+        return int(self.adapter.get_engine(self.spy_shape) == engine)
+
+
+class EmailEuCore:
+    """
+    The real-world graph shown in the README.
+    """
+    params = [BACKENDS]
+    param_names = ["backend"]
+
+    def setup(self, backend):
+        coo = load_email_eu_core()
+        self.mat = make_matrix(backend, coo.shape, coo.row, coo.col)
+
+    def time_to_spy_heatmap(self, backend):
+        to_spy_heatmap(self.mat, buckets=500)
@@ -0,0 +1,97 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Rendering: matplotlib figures, PNGs, sparklines, and import time.
+"""
+
+from .generators import generate, make_matrix
+
+
+class Render:
+    params = [[10**3, 10**6]]
+    param_names = ["nnz"]
+
+    def setup(self, nnz):
+        try:
+            import matplotlib
+        except ImportError:
+            raise NotImplementedError("matplotlib not installed")
+        matplotlib.use("Agg")
+
+        shape, rows, cols = generate("power_law", nnz)
+        self.mat = make_matrix("scipy_csr", shape, rows, cols)
+
+    def time_spy_to_mpl(self, nnz):
+        from matspy import spy_to_mpl
+        fig, ax = spy_to_mpl(self.mat)
+        fig.canvas.draw()
+
+    def time_spy_to_png(self, nnz):
+        from matspy import spy_to_png
+        spy_to_png(self.mat)
+
+    def time_spy_to_svg(self, nnz):
+        from matspy import spy_to_svg
+        spy_to_svg(self.mat)
+
+    def peakmem_spy_to_png(self, nnz):
+        from matspy import spy_to_png
+        spy_to_png(self.mat)
+
+
+class Sparkline:
+    params = [[10**3, 10**6]]
+    param_names = ["nnz"]
+
+    def setup(self, nnz):
+        shape, rows, cols = generate("power_law", nnz)
+        self.mat = make_matrix("scipy_csr", shape, rows, cols)
+        self.mats = [make_matrix("scipy_csr", *generate(pattern, nnz // 100 or 1))
+                     for pattern in ("uniform", "banded", "power_law") for _ in range(10)]
+
+    def time_to_sparkline(self, nnz):
+        from matspy import to_sparkline
+        to_sparkline(self.mat)
+
+    def time_to_sparklines(self, nnz):
+        from matspy import to_sparklines
+        to_sparklines(self.mats)
+
+    def time_to_sparklines_shared_shading(self, nnz):
+        from matspy import to_sparklines
+        to_sparklines(self.mats, shared_shading=True)
+
+
+class SparklinesWorkers:
+    """
+    `workers` renders the matrices in parallel, one matrix per task. Compare with `workers=1`.
+    Many small matrices measure the per-task overhead, a few large ones the binning.
+    """
+    params = [[(4, 10**7), (1000, 10**4)], [1, 4], ["thread", "process"]]
+    param_names = ["count_nnz", "workers", "worker_type"]
+
+    def setup(self, count_nnz, workers, worker_type):
+        count, nnz = count_nnz
+        shape, rows, cols = generate("power_law", nnz)
+        self.mats = [make_matrix("scipy_csr", shape, rows, cols) for _ in range(count)]
+
+    def time_to_sparklines(self, count_nnz, workers, worker_type):
+        from matspy import to_sparklines
+        to_sparklines(self.mats, workers=workers, worker_type=worker_type)
+
+
+class Import:
+    """
+    Importing matspy must stay cheap: it must not import matplotlib.
+    """
+    def timeraw_import_matspy(self):
+        return "import matspy"
+
+    def timeraw_import_to_spy_heatmap(self):
+        return """
+            import numpy as np
+            import matspy
+            matspy.to_spy_heatmap(np.eye(10))
+        """
@@ -0,0 +1,129 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Synthetic matrices for benchmarks.
+
+Generators return coordinates, which are converted to each backend's matrix type by `make_matrix`.
+Matrices are generated on the fly, so sizes are only limited by memory. Sizes above `MAX_NNZ`, set by the
+`MATSPY_BENCH_MAX_NNZ` environment variable, are skipped so that a default run finishes quickly.
+"""
+
+import os
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+MAX_NNZ = int(float(os.environ.get("MATSPY_BENCH_MAX_NNZ", 1e7)))
+"""Largest number of nonzeros to benchmark. Set `MATSPY_BENCH_MAX_NNZ=1e9` for the full range."""
+
+MAX_DENSE_ELEMENTS = int(float(os.environ.get("MATSPY_BENCH_MAX_DENSE_ELEMENTS", 1e8)))
+"""Largest dense array to benchmark, in elements."""
+
+DENSITY = 1e-3
+"""Density of the generated sparse matrices. The dimension is chosen to reach the requested nnz."""
+
+NNZ = [10**3, 10**5, 10**7, 10**9]
+
+PATTERNS = ["uniform", "banded", "power_law"]
+
+BACKENDS = ["scipy_csr", "scipy_coo", "numpy", "graphblas", "sparse_coo", "sparse_gcxs", "dask"]
+
+EMAIL_EU_CORE = Path(__file__).parent.parent / "doc" / "matrices" / "email-Eu-core.mtx.gz"
+
+
+def skip(reason=""):
+    # asv skips benchmarks whose setup raises NotImplementedError
+    raise NotImplementedError(reason)
+
+
+def get_dimension(nnz: int, density: float = DENSITY) -> int:
+    return max(100, int(np.sqrt(nnz / density)))
+
+
+def uniform(n: int, nnz: int, seed=0) -> Tuple[np.array, np.array]:
+    """
+    Nonzeros spread uniformly at random.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n, nnz), rng.integers(0, n, nnz)
+
+
+def banded(n: int, nnz: int, seed=0) -> Tuple[np.array, np.array]:
+    """
+    Nonzeros in a band around the diagonal, like a discretized PDE.
+    """
+    rng = np.random.default_rng(seed)
+    half_width = max(1, nnz // n // 2)
+    rows = rng.integers(0, n, nnz)
+    cols = np.clip(rows + rng.integers(-half_width, half_width + 1, nnz), 0, n - 1)
+    return rows, cols
+
+
+def power_law(n: int, nnz: int, seed=0, exponent=1.8) -> Tuple[np.array, np.array]:
+    """
+    Heavy-tailed degrees, like a social or communication graph such as email-Eu-core.
+    A few hub rows and columns hold most of the nonzeros. Hubs are scattered by a random permutation.
+    """
+    rng = np.random.default_rng(seed)
+    permutation = rng.permutation(n)
+    rows = permutation[(rng.zipf(exponent, nnz) - 1) % n]
+    cols = permutation[(rng.zipf(exponent, nnz) - 1) % n]
+    return rows, cols
+
+
+def generate(pattern: str, nnz: int) -> Tuple[Tuple[int, int], np.array, np.array]:
+    """
+    :return: `(shape, rows, cols)`. Coordinates may repeat.
+    """
+    if nnz > MAX_NNZ:
+        skip(f"nnz={nnz} is above MATSPY_BENCH_MAX_NNZ")
+
+    n = get_dimension(nnz)
+    rows, cols = {"uniform": uniform, "banded": banded, "power_law": power_law}[pattern](n, nnz)
+    return (n, n), rows, cols
+
+
+def make_matrix(backend: str, shape, rows, cols):
+    """
+    Convert coordinates to a matrix of `backend` type. Skips the benchmark if the backend is not installed.
+    """
+    try:
+        if backend == "numpy" or backend == "dask":
+            if shape[0] * shape[1] > MAX_DENSE_ELEMENTS:
+                skip("too large for a dense array")
+            arr = np.zeros(shape, dtype="float64")
+            arr[rows, cols] = 1
+            if backend == "dask":
+                import dask.array as da
+                return da.from_array(arr, chunks=max(1, shape[0] // 8))
+            return arr
+
+        if backend.startswith("scipy"):
+            import scipy.sparse
+            mat = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+            return mat.tocsr() if backend == "scipy_csr" else mat
+
+        if backend == "graphblas":
+            import graphblas as gb
+            return gb.Matrix.from_coo(rows, cols, np.ones(len(rows)), nrows=shape[0], ncols=shape[1],
+                                      dup_op=gb.binary.plus)
+
+        if backend.startswith("sparse"):
+            import sparse
+            mat = sparse.COO(np.stack((rows, cols)), np.ones(len(rows)), shape=shape)
+            return mat.asformat("gcxs") if backend == "sparse_gcxs" else mat
+    except ImportError:
+        skip(f"{backend} not installed")
+
+    raise ValueError(f"Unknown backend {backend}")
+
+
+def load_email_eu_core():
+    try:
+        import scipy.io
+    except ImportError:
+        skip("scipy not installed")
+    return scipy.io.mmread(EMAIL_EU_CORE).tocoo()
@@ -3,10 +3,11 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import dataclasses
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from typing import Type, Tuple, Dict, List, Union
 
-from .adapters import Driver, MatrixSpyAdapter
+from .adapters import Driver, MatrixSpyAdapter, ENGINES
+from .heatmap import ShadingStats
 
 
 @dataclass
@@ -42,6 +43,12 @@ class MatSpyParams:
     A simple max would allow one or two outliers to skew the entire range making the plot appear too light.
     """
 
+    shading_stats: ShadingStats = None
+    """
+    if `shading == 'relative'`: shade with these statistics instead of those of the matrix itself, so that several
+    plots are on the same scale. See `to_spy_heatmaps(retstats=True)`.
+    """
+
     figsize: float = 3.5
     """Figure size for spy plots, of longest side, in default matplotlib units (inches)."""
 
@@ -62,6 +69,88 @@ class MatSpyParams:
     Behaves like `matplotlib.pyplot.spy`'s `precision` argument, but for dense arrays only.
     """
 
+    row_range: Tuple[int, int] = None
+    """
+    Spy only rows `row_range[0]` to `row_range[1]` (exclusive) of the matrix. The submatrix is not materialized,
+    and plots are labeled with the matrix's row indices. `None` means all rows, as does `None` for either end.
+    """
+
+    col_range: Tuple[int, int] = None
+    """Like `row_range` but for columns."""
+
+    axes: Tuple[int, int] = None
+    """
+    For PyData/Sparse arrays: the axes to plot as rows and columns, such as `(0, 2)`. Elements along the other
+    axes are counted together. `None` means the first two axes. Ignored by other matrix types.
+    """
+
+    engine: str = "auto"
+    """
+    Strategy used to compute the heatmap:
+     - `'auto'`: The fastest strategy the matrix type supports, estimated from its format, nnz, dimensions,
+       and bucket count.
+     - `'direct_bincount'`: Map each stored element straight to its bucket.
+     - `'dense_block_reduce'`: Sum dense blocks of the matrix into buckets. Fast for dense or nearly dense matrices.
+     - `'triple_product'`: Downscale with two sparse matrix multiplies.
+     - `'graphblas_native'`: The triple product computed by GraphBLAS, for GraphBLAS matrices.
+    Matrix types with a single strategy, like Dask arrays and files, ignore this option.
+    Other matrix types raise `ValueError` for a strategy they do not support.
+    """
+
+    heatmap_dtype: str = "float32"
+    """
+    Floating point type of heatmaps returned by `to_spy_heatmap`, `'float32'` or `'float64'`.
+    Buckets are counted in the smallest sufficient unsigned integer type and shaded in place in this type.
+    """
+
+    chunk_rows: int = None
+    """
+    If set, process the matrix in blocks of this many rows (columns for CSC) to bound peak memory.
+    Coordinate formats like COO are sliced into blocks with the same average number of elements.
+    Backends that do not support chunking ignore this option.
+    """
+
+    max_chunk_bytes: int = None
+    """
+    Process the matrix in blocks sized so that temporary memory stays under roughly this many bytes.
+    If not set, backends that support chunking use 64 MiB blocks. May be combined with `chunk_rows`.
+    Backends that do not support chunking ignore this option.
+    """
+
+    workers: int = None
+    """
+    If greater than 1, bin the matrix in row blocks using this many parallel workers.
+    Backends that do not support parallel binning ignore this option.
+    """
+
+    worker_type: str = "thread"
+    """
+    Type of parallel workers:
+     - `'thread'`: A thread pool. NumPy releases the GIL in the heavy operations.
+     - `'process'`: A process pool. Each row block is sent to a worker process. The pool is kept for later calls.
+    """
+
+    cache: bool = False
+    """
+    Whether to cache computed heatmaps so that repeated renders of the same matrix with the same options are
+    near-instant. Cached heatmaps are invalidated if the matrix's shape, nnz or index buffers are replaced.
+    Writeable NumPy arrays are checksummed in whole, so any in-place edit is detected. In-place edits of sparse
+    matrices are only spot-checked at a few sampled elements. Use `matspy.cache_clear()` after modifying one in place.
+    """
+
+    interactive: bool = False
+    """
+    For `spy` and `spy_to_mpl`: whether zooming or panning the plot re-bins the visible part of the matrix at
+    screen resolution. Requires an interactive matplotlib backend and a matrix type that supports spying a submatrix.
+    """
+
+    pyplot: bool = None
+    """
+    For `spy_to_mpl`: whether the figure is managed by pyplot, so that `plt.show()` shows it and `plt.close()`
+    frees it. Unmanaged figures are off-screen and safe to create from any thread.
+    If None then figures are managed if `matplotlib.pyplot` is already imported and the caller is on the main thread.
+    """
+
     spy_aa_tweaks_enabled: bool = None
     """
     Whether to_sparkline() may tweak parameters like bucket count to prevent visible aliasing artifacts.
@@ -95,6 +184,9 @@ class MatSpyParams:
 
         # validate
         ret._assert_one_of("shading", ['relative', 'absolute', 'binary'])
+        ret._assert_one_of("worker_type", ['thread', 'process'])
+        ret._assert_one_of("engine", ENGINES)
+        ret._assert_one_of("heatmap_dtype", ["float32", "float64"])
 
         # Apply some default rules
         if ret.spy_aa_tweaks_enabled is None:
@@ -103,7 +195,8 @@ class MatSpyParams:
         return ret
 
     def to_kwargs(self):
-        return asdict(self)
+        # shallow, so that values like `shading_stats` are not converted to dicts
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
 
 
 params = MatSpyParams()
@@ -134,6 +227,12 @@ def _register_bundled():
     from .adapters.sparse_driver import PyDataSparseDriver
     register_driver(PyDataSparseDriver)
 
+    from .adapters.dask_driver import DaskDriver
+    register_driver(DaskDriver)
+
+    from .adapters.file_driver import FileDriver
+    register_driver(FileDriver)
+
 
 _register_bundled()
 
@@ -147,13 +246,17 @@ def _get_driver(mat):
     raise AttributeError("Unsupported type: " + type_str)
 
 
-def _get_spy_adapter(mat) -> MatrixSpyAdapter:
+def _get_spy_adapter(mat, options: MatSpyParams = None) -> MatrixSpyAdapter:
     if isinstance(mat, MatrixSpyAdapter):
-        return mat
+        adapter = mat
+    else:
+        adapter = _get_driver(mat).adapt_spy(mat)
+        if not adapter:
+            raise AttributeError("Unsupported matrix")
 
-    adapter = _get_driver(mat).adapt_spy(mat)
-    if not adapter:
-        raise AttributeError("Unsupported matrix")
+    if options is not None and options.axes is not None:
+        # changes the adapter's shape, so apply before anything else
+        adapter.set_option("axes", options.axes)
 
     return adapter
 
@@ -161,14 +264,84 @@ def _get_spy_adapter(mat) -> MatrixSpyAdapter:
 def to_spy_heatmap(mat, buckets=500, **kwargs):
     options = params.get(**kwargs)
     options.buckets = buckets
-    adapter = _get_spy_adapter(mat)
+    adapter = _get_spy_adapter(mat, options)
 
-    from .spy_renderer import get_spy_heatmap
+    from .heatmap import get_spy_heatmap
     heatmap = get_spy_heatmap(adapter, **options.to_kwargs())
     return heatmap
 
 
-from matspy.spy_renderer import spy, spy_to_mpl, to_sparkline
+def to_spy_heatmaps(mats, buckets=500, retstats=False, **kwargs):
+    """
+    Same as `to_spy_heatmap` for each of `mats`, but relative shading is on the same scale for all of them.
+
+    :param mats: matrices, in any form accepted by `to_spy_heatmap`.
+    :param retstats: If True, also return the shared `ShadingStats`. Pass them as `shading_stats` to any method
+    to shade more plots to the same scale.
+    :return: a list of heatmaps, in the same order as `mats`.
+    """
+    options = params.get(**kwargs)
+    options.buckets = buckets
+    adapters = [_get_spy_adapter(mat, options) for mat in mats]
+
+    from .heatmap import get_spy_heatmaps
+    heatmaps, stats = get_spy_heatmaps(adapters, [options.to_kwargs()] * len(adapters))
+    if retstats:
+        return heatmaps, stats
+    else:
+        return heatmaps
+
+
+def to_spy_pyramid(mat, buckets=2048, **kwargs):
+    """
+    Bin a matrix once at `buckets` resolution and return a multi-resolution pyramid of the result.
+
+    The returned `SpyPyramid` may be passed to any method in place of `mat`. Requests for `buckets` up to
+    the pyramid's resolution, such as sparklines, thumbnails and different figure sizes, are served from the pyramid
+    without recomputing from the matrix.
+    """
+    from .adapters.pyramid import SpyPyramid
+
+    options = params.get(**kwargs)
+    adapter = _get_spy_adapter(mat, options)
+    for key in ("precision", "engine", "chunk_rows", "max_chunk_bytes", "workers", "worker_type"):
+        adapter.set_option(key, getattr(options, key))
+    return SpyPyramid(adapter, buckets)
+
+
+def cache_clear():
+    """
+    Drop all cached heatmaps, see the `cache` parameter, and all cached bucket maps and projection matrices.
+    """
+    from .cache import heatmap_cache, projection_cache
+    heatmap_cache.clear()
+    projection_cache.clear()
+
+
+def to_spy_heatmap_file(path, buckets=500, shape=None, **kwargs):
+    """
+    Same as `to_spy_heatmap` but for a matrix stored in a file. The file is streamed, not loaded into memory.
+
+    Supports Matrix Market, SciPy `.npz` and `.npy` coordinate files. See `matspy.adapters.file_impl.open_spy_file`.
+    """
+    from .adapters.file_impl import open_spy_file
+    return to_spy_heatmap(open_spy_file(path, shape=shape), buckets=buckets, **kwargs)
+
+
+from matspy.sparkline import to_sparkline, to_sparklines
+
+
+def __getattr__(name):
+    # Plotting methods are loaded on first use, so that importing matspy does not import matplotlib.pyplot.
+    if name in ("spy", "spy_file", "spy_to_mpl", "spy_to_png", "spy_to_svg"):
+        from matspy import spy_renderer
+        return getattr(spy_renderer, name)
+    if name in ("ato_spy_heatmap", "ato_sparkline", "aspy_png"):
+        from matspy import aio
+        return getattr(aio, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-__all__ = ["to_sparkline", "to_spy_heatmap", "spy_to_mpl", "spy"]
+__all__ = ["to_sparkline", "to_sparklines", "to_spy_heatmap", "to_spy_heatmaps", "to_spy_heatmap_file",
+           "to_spy_pyramid", "spy_to_mpl", "spy_to_png", "spy_to_svg", "spy", "spy_file", "cache_clear",
+           "ato_spy_heatmap", "ato_sparkline", "aspy_png"]
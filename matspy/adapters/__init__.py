@@ -2,11 +2,45 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import zlib
 from abc import ABC, abstractmethod
 from typing import Any, Iterable, Optional, Tuple
 
 import numpy as np
 
+ENGINES = ("auto", "direct_bincount", "dense_block_reduce", "triple_product", "graphblas_native")
+"""
+Heatmap engines, i.e. strategies for computing spy data. See the `engine` parameter.
+ - `'direct_bincount'`: Map each stored element straight to its bucket, see `binning.SpyBinner`.
+ - `'dense_block_reduce'`: Sum dense blocks of the matrix into buckets.
+ - `'triple_product'`: Downscale with two sparse matrix multiplies, see `generate_spy_triple_product`.
+ - `'graphblas_native'`: The triple product computed by GraphBLAS.
+"""
+
+DEFAULT_MAX_CHUNK_BYTES = 64 * 2**20
+"""
+Temporary memory limit of chunked adapters if the `max_chunk_bytes` option is not set, so that no temporary is
+the size of the matrix and files are never read in whole.
+"""
+
+LARGE_DIM = 2**19
+"""
+Engine cost estimates treat matrices with a dimension longer than this as large. Bucket maps and multiply workspaces
+of large matrices do not fit in cache, so accessing them by random index is several times slower.
+"""
+
+
+def count_dtype(max_count: Optional[int]) -> np.dtype:
+    """
+    The smallest of uint16, uint32 and uint64 that holds bucket counts up to `max_count`, such as the number of
+    stored elements. `None` means no known bound, i.e. uint64.
+    """
+    if max_count is not None:
+        for dtype in (np.uint16, np.uint32):
+            if max_count <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
 
 def describe(shape: tuple = None, nnz: int = None, nz_type=None, layout: str = None, notes: str = None) -> str:
     """
@@ -36,6 +70,58 @@ def describe(shape: tuple = None, nnz: int = None, nz_type=None, layout: str = N
     return ", ".join(parts)
 
 
+def array_fingerprint(arr, samples: int = 64) -> tuple:
+    """
+    Create a cheap fingerprint of a NumPy array: its buffer address, shape, strides, dtype, and a few sampled elements.
+
+    Takes the same time regardless of the array's size and never copies it. Changes if the array is replaced or
+    resized, or if a sampled element is modified in place. Other in-place edits are not detected.
+    """
+    arr = np.asarray(arr)
+    sample = b""
+    if arr.size > 0 and not arr.dtype.hasobject:
+        # evenly spaced, including the first and last elements
+        flat_indices = np.linspace(0, arr.size - 1, num=min(samples, arr.size), dtype="int64")
+        sample = arr[np.unravel_index(flat_indices, arr.shape)].tobytes()
+    return arr.__array_interface__["data"][0], arr.shape, arr.strides, arr.dtype.str, sample
+
+
+def is_mutable(arr) -> bool:
+    """
+    Whether the elements of NumPy array `arr` may be modified in place, through it or through the array it views.
+    """
+    while isinstance(arr, np.ndarray):
+        if arr.flags.writeable:
+            return True
+        arr = arr.base
+    # a buffer not owned by an array, such as a memory map, may be writeable
+    return arr is not None
+
+
+def array_checksum(arr, max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> int:
+    """
+    CRC-32 of every element of a NumPy array, to detect in-place edits that `array_fingerprint` misses.
+
+    Reads the whole array, but at memory bandwidth and with at most `max_chunk_bytes` of temporary memory for
+    non-contiguous arrays.
+    """
+    arr = np.asarray(arr)
+    if arr.ndim == 0 or arr.size == 0:
+        return zlib.crc32(arr.tobytes())
+
+    row_bytes = max(1, arr.itemsize * (arr.size // arr.shape[0]))
+    chunk_rows = max(1, max_chunk_bytes // row_bytes)
+    crc = 0
+    for start in range(0, arr.shape[0], chunk_rows):
+        chunk = arr[start:(start + chunk_rows)]
+        if chunk.flags.c_contiguous and not chunk.dtype.hasobject:
+            # no copy
+            crc = zlib.crc32(chunk.reshape(-1).view(np.uint8), crc)
+        else:
+            crc = zlib.crc32(chunk.tobytes(), crc)
+    return crc
+
+
 class MatrixSpyAdapter(ABC):
     def __init__(self):
         self.options = {}
@@ -50,8 +136,80 @@ class MatrixSpyAdapter(ABC):
 
     @abstractmethod
     def get_spy(self, spy_shape: tuple) -> np.array:
+        """
+        Spy data of shape `spy_shape`: the number of stored elements in each bucket.
+        Bundled adapters return counts in a compact unsigned integer type, see `count_dtype`.
+        """
         pass
 
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        """
+        Like `get_spy` but of the submatrix `[row_range[0]:row_range[1], col_range[0]:col_range[1]]`.
+
+        Adapters that support windows override this. The default only supports the entire matrix
+        and raises `NotImplementedError` otherwise.
+        """
+        shape = self.get_shape()
+        if tuple(row_range) == (0, shape[0]) and tuple(col_range) == (0, shape[1]):
+            return self.get_spy(spy_shape)
+        raise NotImplementedError(f"{type(self).__name__} does not support spying a submatrix")
+
+    def get_engines(self) -> Tuple[str, ...]:
+        """
+        The heatmap engines this adapter implements, see `ENGINES`, in order of preference.
+
+        Adapters with a choice of engines override this and `estimate_engine_cost`, and dispatch on `get_engine`.
+        The default of no engines means the adapter has a single strategy and ignores the `engine` option.
+        """
+        return ()
+
+    def estimate_engine_cost(self, engine: str, spy_shape: tuple) -> float:
+        """
+        Estimated time, in seconds, to compute spy data of shape `spy_shape` with `engine`.
+        Only needs to be accurate enough to rank engines against each other. Used by the `'auto'` engine.
+        """
+        return 0.0
+
+    def get_engine(self, spy_shape: tuple) -> Optional[str]:
+        """
+        The engine to compute spy data of shape `spy_shape` with, according to the `engine` option.
+
+        `'auto'` picks the engine with the lowest `estimate_engine_cost`.
+
+        :return: One of `get_engines()`, or None if the adapter does not implement any.
+        :raises ValueError: if the `engine` option names an engine this adapter does not implement.
+        """
+        engines = self.get_engines()
+        if not engines:
+            return None
+
+        engine = self.get_option("engine", None) or "auto"
+        if engine == "auto":
+            # ties go to the preferred engine
+            return min(engines, key=lambda e: self.estimate_engine_cost(e, spy_shape))
+
+        if engine not in engines:
+            raise ValueError(f"{type(self).__name__} does not support engine '{engine}'. "
+                             f"Supported: auto, " + ", ".join(engines))
+        return engine
+
+    def get_matrix(self) -> Any:
+        """
+        The adapted matrix object, or None. Used to tell matrices apart in the heatmap cache.
+        """
+        return None
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        """
+        A cheap fingerprint of the adapted matrix, such as shape, nnz, and buffer addresses, that takes the same time
+        regardless of the matrix's size. It should change if the matrix is replaced, resized or restructured,
+        but need not detect every in-place edit. See `array_fingerprint`. Dense adapters, whose heatmaps read every
+        element anyway, also include an `array_checksum` of mutable arrays.
+
+        Heatmaps are only cached for adapters that return a fingerprint. The default of None disables caching.
+        """
+        return None
+
     def set_option(self, key, value):
         self.options[key] = value
 
@@ -71,34 +229,74 @@ class Driver(ABC):
         pass
 
 
+def _gen_even(stop, num):
+    return np.linspace(0, stop, num=num, endpoint=False, dtype="int64")
+
+
+def _gen(stop, num, uneven_to_end=True):
+    remainder = num % stop
+    if not uneven_to_end or num % stop == 0 or remainder > 4:
+        return _gen_even(stop, num)
+
+    step = int(num / stop)
+    a = np.repeat(np.arange(0, stop, dtype='int64'), step)
+    b = np.full((num - len(a)), stop - 1, dtype="int64")
+    return np.concatenate((a, b))
+
+
+def _shape_key(shape) -> tuple:
+    return tuple(int(x) for x in shape)
+
+
 def generate_spy_triple_product(matrix_shape, spy_shape, uneven_to_end=True) ->\
         Tuple[Tuple[np.array, np.array], Tuple[np.array, np.array]]:
     """
     Generate left and right matrices to create a matrix spy plot using two matrix multiplications.
+
+    Results are cached in `matspy.cache.projection_cache`. The returned arrays are shared, so they are read-only.
     """
-    left_shape = (spy_shape[0], matrix_shape[0])
-    right_shape = (matrix_shape[1], spy_shape[1])
+    from ..cache import projection_cache, freeze_arrays
+
+    def generate():
+        left_shape = (spy_shape[0], matrix_shape[0])
+        right_shape = (matrix_shape[1], spy_shape[1])
+
+        left_nnz = max(left_shape)
+        right_nnz = max(right_shape)
 
-    left_nnz = max(left_shape)
-    right_nnz = max(right_shape)
+        left_rows = _gen(left_shape[0], num=left_nnz, uneven_to_end=uneven_to_end)
+        left_cols = _gen_even(left_shape[1], num=left_nnz)
 
-    def gen_even(stop, num):
-        return np.linspace(0, stop, num=num, endpoint=False, dtype="int64")
+        right_rows = _gen_even(right_shape[0], num=right_nnz)
+        right_cols = _gen(right_shape[1], num=right_nnz, uneven_to_end=uneven_to_end)
 
-    def gen(stop, num):
-        remainder = num % stop
-        if not uneven_to_end or num % stop == 0 or remainder > 4:
-            return gen_even(stop, num)
+        ret = (left_shape, (left_rows, left_cols)), (right_shape, (right_rows, right_cols))
+        return ret, freeze_arrays(ret)
 
-        step = int(num / stop)
-        a = np.repeat(np.arange(0, stop, dtype='int64'), step)
-        b = np.full((num - len(a)), stop - 1, dtype="int64")
-        return np.concatenate((a, b))
+    key = ("triple_product", _shape_key(matrix_shape), _shape_key(spy_shape), bool(uneven_to_end))
+    return projection_cache.get(key, generate)
 
-    left_rows = gen(left_shape[0], num=left_nnz)
-    left_cols = gen_even(left_shape[1], num=left_nnz)
 
-    right_rows = gen_even(right_shape[0], num=right_nnz)
-    right_cols = gen(right_shape[1], num=right_nnz)
+def generate_spy_bucket_map(matrix_dim, spy_dim, uneven_to_end=True) -> Tuple[np.array, Optional[np.array]]:
+    """
+    Map each index of one matrix dimension to its spy plot bucket.
+
+    Equivalent to one side of `generate_spy_triple_product`, but in a form that lets coordinates be binned directly.
+
+    Returns `(bucket_of, expand)`. `bucket_of[i]` is the bucket that index `i` falls into.
+    If the spy dimension is larger than the matrix dimension then every index gets its own bucket and `expand` lists
+    which bucket each spy row/column is drawn from. Otherwise `expand` is `None`.
+
+    Results are cached in `matspy.cache.projection_cache`. The returned arrays are shared, so they are read-only.
+    """
+    from ..cache import projection_cache, freeze_arrays
+
+    def generate():
+        if matrix_dim >= spy_dim:
+            ret = _gen(spy_dim, num=matrix_dim, uneven_to_end=uneven_to_end), None
+        else:
+            ret = np.arange(matrix_dim, dtype="int64"), _gen_even(matrix_dim, num=spy_dim)
+        return ret, freeze_arrays(ret)
 
-    return (left_shape, (left_rows, left_cols)), (right_shape, (right_rows, right_cols))
+    key = ("bucket_map", int(matrix_dim), int(spy_dim), bool(uneven_to_end))
+    return projection_cache.get(key, generate)
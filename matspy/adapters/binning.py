@@ -0,0 +1,553 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import itertools
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from . import count_dtype, generate_spy_bucket_map
+
+
+NUMBA_MIN_ELEMENTS = 2**20
+"""
+Inputs with at least this many elements are binned with the compiled kernels in `numba_kernels`, if Numba is
+installed. Smaller inputs are binned with NumPy, which is as fast for them and avoids compiling the kernels.
+Set to `None` to never use Numba.
+"""
+
+NUMPY_CHUNK_ELEMENTS = 2**18
+"""
+Without the compiled kernels, elements are binned with NumPy at most this many at a time, or as many as the grid has
+buckets if that is more. This bounds the temporary bucket arrays regardless of the size of the input.
+"""
+
+_parallel_kernel_lock = threading.Lock()
+_parallel_kernel_started = False
+
+
+@lru_cache(maxsize=None)
+def _import_kernels():
+    try:
+        from . import numba_kernels
+    except ImportError:
+        return None
+    return numba_kernels
+
+
+def get_kernels(num_elements):
+    """
+    The `numba_kernels` module if Numba is installed and `num_elements` is at least `NUMBA_MIN_ELEMENTS`, else None.
+    """
+    if NUMBA_MIN_ELEMENTS is None or num_elements < NUMBA_MIN_ELEMENTS:
+        return None
+    return _import_kernels()
+
+
+@contextmanager
+def parallel_kernel():
+    """
+    Whether a kernel may run in parallel. Only one parallel kernel runs at a time, because not every Numba threading
+    layer supports being called from several threads at once. Concurrent callers use the serial kernels.
+    """
+    global _parallel_kernel_started
+    parallel = _parallel_kernel_lock.acquire(blocking=False)
+    if parallel:
+        _parallel_kernel_started = True
+    try:
+        yield parallel
+    finally:
+        if parallel:
+            _parallel_kernel_lock.release()
+
+
+def check_cancelled(cancel_event):
+    """
+    Raise `CancelledError` if `cancel_event`, a `threading.Event` or None, is set.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise CancelledError("spy cancelled")
+
+
+def _get_process_start_method():
+    if not _parallel_kernel_started:
+        return None
+    return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def new_process_pool(max_workers, initializer=None, initargs=()) -> ProcessPoolExecutor:
+    """
+    A process pool that is safe to use after parallel kernels have run. Numba's worker threads do not survive a fork,
+    so once they are started new pools start their workers with a fresh interpreter instead.
+    """
+    method = _get_process_start_method()
+    mp_context = multiprocessing.get_context(method) if method else None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=initializer,
+                               initargs=initargs)
+
+
+PROCESS_INSTALL_TIMEOUT = 60
+"""Seconds a worker process waits for the rest of the pool while receiving a binner."""
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+_binner_tokens = itertools.count()
+
+# Set in worker processes: the pool's barrier, and the binner of the run in progress as (token, binner).
+_worker_barrier = None
+_worker_binner = (None, None)
+
+
+class _ProcessPool:
+    """
+    A process pool shared by all runs with the same number of workers. Runs take turns, because each one first
+    installs its binner in every worker.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.start_method = _get_process_start_method()
+        context = multiprocessing.get_context(self.start_method)
+        self.lock = threading.Lock()
+        self.barrier = context.Barrier(workers)
+        self.executor = new_process_pool(workers, initializer=_init_worker, initargs=(self.barrier,))
+
+    def install(self, binner) -> int:
+        """
+        Send `binner` to each worker once. Returns the token that tasks use to refer to it.
+        """
+        token = next(_binner_tokens)
+        # The barrier holds each install task until all are running, so every worker receives exactly one.
+        futures = [self.executor.submit(_install_binner, token, binner, PROCESS_INSTALL_TIMEOUT)
+                   for _ in range(self.workers)]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # release the workers still waiting for the failed one
+            self.barrier.abort()
+            raise
+        return token
+
+
+def get_process_pool(workers) -> _ProcessPool:
+    """
+    The process pool with `workers` workers. Pools persist between runs, and are replaced if they break, if installing
+    a binner fails, or if they fork but parallel kernels have since started.
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(workers, None)
+        if pool is not None and pool.start_method != _get_process_start_method():
+            pool.executor.shutdown(wait=False)
+            pool = None
+        if pool is None:
+            pool = _ProcessPool(workers)
+            _process_pools[workers] = pool
+        return pool
+
+
+def _discard_process_pool(pool):
+    with _process_pools_lock:
+        if _process_pools.get(pool.workers, None) is pool:
+            del _process_pools[pool.workers]
+    # Wait for the workers to exit. They must not touch the barrier once its shared memory may be reused.
+    pool.barrier.abort()
+    if sys.version_info >= (3, 9):
+        pool.executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        # Python 3.8 and older cannot cancel pending tasks on shutdown. Callers cancel their own futures.
+        pool.executor.shutdown(wait=True)
+
+
+def _init_worker(barrier):
+    global _worker_barrier
+    _worker_barrier = barrier
+
+
+def _install_binner(token, binner, timeout):
+    global _worker_binner
+    _worker_binner = (token, binner)
+    _worker_barrier.wait(timeout)
+
+
+class _BinnerRef:
+    """Stands in for the binner in the arguments of a task sent to a worker process."""
+
+
+def _call_in_worker(token, func, args):
+    installed_token, binner = _worker_binner
+    if installed_token != token:
+        raise RuntimeError("binner not installed in worker process")
+    if isinstance(func, str):
+        func = getattr(binner, func)
+    return func(*(binner if isinstance(arg, _BinnerRef) else arg for arg in args))
+
+
+def _call(task):
+    func, args = task
+    return func(*args)
+
+
+def _get_window_bucket_map(matrix_dim, spy_dim, window_range, uneven_to_end):
+    start, stop = window_range
+    bucket_map, expand = generate_spy_bucket_map(stop - start, spy_dim, uneven_to_end)
+    num_buckets = spy_dim if expand is None else stop - start
+    if (start, stop) == (0, matrix_dim):
+        return bucket_map, expand, num_buckets
+
+    # indices outside the window go to an extra bucket that is discarded
+    window_map = np.full(matrix_dim, num_buckets, dtype="int64")
+    window_map[start:stop] = bucket_map
+    return window_map, expand, num_buckets + 1
+
+
+class SpyBinner:
+    """
+    Bins matrix coordinates directly into spy plot buckets.
+
+    Produces the same counts as the triple product from `generate_spy_triple_product`, but each stored element is
+    mapped straight to its bucket. The accumulated grid is O(buckets^2). Temporary memory is O(buckets^2) with
+    the compiled kernels, and without them up to `BYTES_PER_ELEMENT` per element in slices of
+    `NUMPY_CHUNK_ELEMENTS` elements.
+
+    Usage: create a grid with `new_grid()`, accumulate coordinates with the `add_*` methods,
+    then call `finish()` to get the spy plot data.
+
+    `options` are the adapter's options. The `add_*` methods split their input into chunks to bound
+    temporary memory according to the `chunk_rows` and `max_chunk_bytes` options, and bin the chunks in parallel
+    according to the `workers` and `worker_type` options. If the `cancel_event` option is set to a
+    `threading.Event` then binning stops with `CancelledError` between chunks once the event is set.
+
+    If `window` is set to `((row_start, row_stop), (col_start, col_stop))` then the spy plot covers only that
+    submatrix. Coordinates are still those of the entire matrix, and elements outside the window are discarded.
+
+    `max_count` bounds the count of any bucket, such as the number of stored elements. Grids are accumulated in the
+    smallest unsigned integer type that holds it, see `count_dtype`. The per-chunk counts returned by the `count_*`
+    methods may be of a wider type, see `accumulate`.
+    """
+
+    BYTES_PER_ELEMENT = 16
+    """Temporary memory used to bin one stored element: its row bucket and column bucket, both int64."""
+
+    def __init__(self, matrix_shape, spy_shape, options: dict = None, uneven_to_end=True, window=None,
+                 max_count=None):
+        self.matrix_shape = tuple(matrix_shape)
+        self.dtype = count_dtype(max_count)
+        self.spy_shape = tuple(spy_shape)
+        self.options = options if options is not None else {}
+        if window is None:
+            window = ((0, matrix_shape[0]), (0, matrix_shape[1]))
+        self.window = tuple((int(start), int(stop)) for start, stop in window)
+
+        self.row_map, self.row_expand, num_rows = _get_window_bucket_map(matrix_shape[0], spy_shape[0],
+                                                                         self.window[0], uneven_to_end)
+        self.col_map, self.col_expand, num_cols = _get_window_bucket_map(matrix_shape[1], spy_shape[1],
+                                                                         self.window[1], uneven_to_end)
+        self.grid_shape = (num_rows, num_cols)
+        """Shape of the accumulated grid. May include discard buckets for elements outside the window."""
+
+        self._bucket_shape = tuple(spy if expand is None else (stop - start)
+                                   for spy, expand, (start, stop) in zip(self.spy_shape,
+                                                                         (self.row_expand, self.col_expand),
+                                                                         self.window))
+
+    def __getstate__(self):
+        # Sent to worker processes. Cancellation is checked by the sending process, and events are not picklable.
+        state = dict(self.__dict__)
+        state["options"] = {key: value for key, value in self.options.items() if key != "cancel_event"}
+        return state
+
+    def check_cancelled(self):
+        """
+        Raise `CancelledError` if the `cancel_event` option is set.
+        """
+        check_cancelled(self.options.get("cancel_event", None))
+
+    def new_grid(self) -> np.array:
+        return np.zeros(self.grid_shape, dtype=self.dtype)
+
+    @staticmethod
+    def accumulate(grid, counts):
+        """
+        Add `counts`, such as from the `count_*` methods, to `grid`. The result fits, so cast without checks.
+        """
+        np.add(grid, counts, out=grid, casting="unsafe")
+
+    def _get_max_chunk_elements(self) -> Optional[int]:
+        max_chunk_bytes = self.options.get("max_chunk_bytes", None)
+        if not max_chunk_bytes:
+            return None
+        return max(1, int(max_chunk_bytes // self.BYTES_PER_ELEMENT))
+
+    def _get_workers(self) -> int:
+        return self.options.get("workers", None) or 1
+
+    def get_row_chunks(self, num_rows, bytes_per_row) -> List[Tuple[int, int]]:
+        """
+        Split `num_rows` rows into `(start, stop)` ranges that each use at most `max_chunk_bytes` of temporary memory.
+        There are at least as many ranges as workers.
+        """
+        chunk_rows = self.options.get("chunk_rows", None) or num_rows
+        max_chunk_bytes = self.options.get("max_chunk_bytes", None)
+        if max_chunk_bytes:
+            chunk_rows = min(chunk_rows, int(max_chunk_bytes // max(1, bytes_per_row)))
+        chunk_rows = min(chunk_rows, -(-num_rows // self._get_workers()))
+        chunk_rows = max(1, chunk_rows)
+
+        return [(start, min(num_rows, start + chunk_rows)) for start in range(0, num_rows, chunk_rows)]
+
+    def _get_compressed_chunks(self, indptr) -> List[Tuple[int, int]]:
+        num_rows = len(indptr) - 1
+        chunk_rows = self.options.get("chunk_rows", None) or num_rows
+
+        max_elements = self._get_max_chunk_elements()
+        workers = self._get_workers()
+        if workers > 1:
+            # balance elements across workers
+            per_worker = max(1, -(-int(indptr[-1] - indptr[0]) // workers))
+            max_elements = min(max_elements, per_worker) if max_elements else per_worker
+
+        chunks = []
+        start = 0
+        while start < num_rows:
+            stop = min(num_rows, start + chunk_rows)
+            if max_elements:
+                # limit by element count, so that long rows do not blow the budget
+                limit = int(np.searchsorted(indptr, indptr[start] + max_elements, side="right")) - 1
+                stop = min(stop, max(start + 1, limit))
+            chunks.append((start, stop))
+            start = stop
+        return chunks
+
+    def run(self, grid, tasks: List[Tuple[Callable, tuple]]):
+        """
+        Run binning tasks and accumulate their results into `grid`.
+
+        Each task is a `(func, args)` tuple. `func(*args)` returns counts of shape `grid_shape`, such as from the
+        `count_*` methods. If the `workers` option is greater than 1 then the tasks are run in a pool of that many
+        threads, or processes if the `worker_type` option is `'process'`. Process pool tasks must be picklable.
+        Process pools persist between runs, see `get_process_pool`. The binner is sent to each worker process once
+        per run, and tasks may refer to it as `func` being one of its methods or as an argument.
+        """
+        workers = self._get_workers()
+        if workers <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                self.check_cancelled()
+                self.accumulate(grid, _call(task))
+            return
+
+        if self.options.get("worker_type", None) == "process":
+            self._run_in_processes(grid, tasks, workers)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self._accumulate_futures(grid, [executor.submit(_call, task) for task in tasks])
+
+    def _run_in_processes(self, grid, tasks, workers):
+        pool = get_process_pool(workers)
+        with pool.lock:
+            self.check_cancelled()
+            try:
+                token = pool.install(self)
+            except BaseException:
+                # The barrier is broken, so no later run could install a binner in this pool.
+                _discard_process_pool(pool)
+                raise
+            try:
+                # Tasks refer to the installed binner instead of pickling it again.
+                futures = [pool.executor.submit(_call_in_worker, token, *self._to_worker_task(task)) for task in tasks]
+                self._accumulate_futures(grid, futures)
+            except BrokenProcessPool:
+                _discard_process_pool(pool)
+                raise
+
+    def _to_worker_task(self, task):
+        func, args = task
+        if getattr(func, "__self__", None) is self:
+            func = func.__name__
+        return func, tuple(_BinnerRef() if arg is self else arg for arg in args)
+
+    def _accumulate_futures(self, grid, futures):
+        try:
+            for future in futures:
+                self.check_cancelled()
+                self.accumulate(grid, future.result())
+        except BaseException:
+            # do not wait for tasks that have not started
+            for future in futures:
+                future.cancel()
+            raise
+
+    def _count(self, row_buckets, col_buckets) -> np.array:
+        # row_buckets is always a temporary, so reuse it for the flat index
+        flat = row_buckets
+        flat *= self.grid_shape[1]
+        flat += col_buckets
+        return np.bincount(flat, minlength=(self.grid_shape[0] * self.grid_shape[1])).reshape(self.grid_shape)
+
+    def _count_slices(self, num_elements, get_buckets: Callable[[int, int], tuple]) -> np.array:
+        """
+        Count elements with NumPy, in slices of at most `NUMPY_CHUNK_ELEMENTS` elements to bound temporary memory.
+
+        `get_buckets(start, stop)` returns the row buckets and column buckets of elements `start` to `stop`.
+        """
+        step = max(NUMPY_CHUNK_ELEMENTS, self.grid_shape[0] * self.grid_shape[1])
+        if num_elements <= step:
+            return self._count(*get_buckets(0, num_elements))
+
+        counts = np.zeros(self.grid_shape, dtype=np.int64)
+        for start in range(0, num_elements, step):
+            counts += self._count(*get_buckets(start, min(num_elements, start + step)))
+        return counts
+
+    @staticmethod
+    def _repeat_compressed(major_map, indptr, start, stop) -> np.array:
+        """
+        The buckets of the rows, or columns, of compressed elements `start` to `stop`, counted from `indptr[0]`.
+        """
+        start, stop = indptr[0] + start, indptr[0] + stop
+        first = int(np.searchsorted(indptr, start, side="right")) - 1
+        last = int(np.searchsorted(indptr, stop, side="left"))
+        return np.repeat(major_map[first:last], np.diff(np.clip(indptr[first:(last + 1)], start, stop)))
+
+    def count_coo(self, rows, cols) -> np.array:
+        """
+        Count elements at coordinates `(rows[i], cols[i])`.
+        """
+        kernels = get_kernels(len(rows))
+        if kernels is not None:
+            grid = self.new_grid()
+            with parallel_kernel() as parallel:
+                kernels.count_coo(grid, self.row_map, self.col_map, rows, cols, parallel=parallel)
+            return grid
+
+        return self._count_slices(len(rows), lambda start, stop: (self.row_map[rows[start:stop]],
+                                                                  self.col_map[cols[start:stop]]))
+
+    def count_csr(self, indptr, indices, row_offset=0) -> np.array:
+        """
+        Count the elements of CSR rows starting at row `row_offset`.
+
+        `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+        """
+        num_rows = len(indptr) - 1
+        kernels = get_kernels(indptr[-1] - indptr[0])
+        if kernels is not None:
+            grid = self.new_grid()
+            with parallel_kernel() as parallel:
+                kernels.count_csr(grid, self.row_map[row_offset:(row_offset + num_rows)], self.col_map, indptr,
+                                  indices, parallel=parallel)
+            return grid
+
+        row_map = self.row_map[row_offset:(row_offset + num_rows)]
+        return self._count_slices(int(indptr[-1] - indptr[0]), lambda start, stop: (
+            self._repeat_compressed(row_map, indptr, start, stop),
+            self.col_map[indices[(indptr[0] + start):(indptr[0] + stop)]]))
+
+    def count_csc(self, indptr, indices, col_offset=0) -> np.array:
+        """
+        Count the elements of CSC columns starting at column `col_offset`.
+
+        `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+        """
+        num_cols = len(indptr) - 1
+        kernels = get_kernels(indptr[-1] - indptr[0])
+        if kernels is not None:
+            grid = self.new_grid()
+            with parallel_kernel() as parallel:
+                kernels.count_csc(grid, self.row_map, self.col_map[col_offset:(col_offset + num_cols)], indptr,
+                                  indices, parallel=parallel)
+            return grid
+
+        col_map = self.col_map[col_offset:(col_offset + num_cols)]
+        return self._count_slices(int(indptr[-1] - indptr[0]), lambda start, stop: (
+            self.row_map[indices[(indptr[0] + start):(indptr[0] + stop)]],
+            self._repeat_compressed(col_map, indptr, start, stop)))
+
+    def count_dense(self, values, row_offset=0, col_offset=0) -> np.array:
+        """
+        Sum a dense block of per-element counts, such as a nonzero mask, into buckets.
+
+        The block starts at row `row_offset` and column `col_offset`.
+        """
+        num_rows, num_cols = values.shape
+        counts = np.zeros(self.grid_shape, dtype=np.int64 if values.dtype.kind in "biu" else
+                          np.result_type(values.dtype, np.int64))
+        if num_rows == 0 or num_cols == 0:
+            return counts
+
+        # Bucket maps are non-decreasing, so each bucket is a contiguous range of rows and of columns.
+        block_row_map = self.row_map[row_offset:(row_offset + num_rows)]
+        block_col_map = self.col_map[col_offset:(col_offset + num_cols)]
+        row_starts = np.concatenate(([0], np.flatnonzero(np.diff(block_row_map)) + 1))
+        col_starts = np.concatenate(([0], np.flatnonzero(np.diff(block_col_map)) + 1))
+
+        summed = np.add.reduceat(values, row_starts, axis=0, dtype=counts.dtype)
+        summed = np.add.reduceat(summed, col_starts, axis=1)
+        counts[np.ix_(block_row_map[row_starts], block_col_map[col_starts])] = summed
+        return counts
+
+    def add_coo(self, grid, rows, cols):
+        """
+        Accumulate elements at coordinates `(rows[i], cols[i])`, in chunks.
+        """
+        chunk_size = len(rows)
+        chunk_rows = self.options.get("chunk_rows", None)
+        if chunk_rows and self.matrix_shape[0] > 0:
+            # slices with the same average element count as `chunk_rows` rows
+            chunk_size = chunk_rows * -(-len(rows) // self.matrix_shape[0])
+        max_elements = self._get_max_chunk_elements()
+        if max_elements:
+            chunk_size = min(chunk_size, max_elements)
+        chunk_size = min(chunk_size, -(-len(rows) // self._get_workers()))
+        chunk_size = max(1, chunk_size)
+
+        self.run(grid, [(self.count_coo, (rows[start:(start + chunk_size)], cols[start:(start + chunk_size)]))
+                        for start in range(0, len(rows), chunk_size)])
+
+    def add_csr(self, grid, indptr, indices, row_offset=0):
+        """
+        Accumulate CSR rows starting at row `row_offset`, in chunks.
+
+        `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+        """
+        tasks = []
+        for start, stop in self._get_compressed_chunks(indptr):
+            block_indptr = indptr[start:(stop + 1)]
+            block_indices = indices[block_indptr[0]:block_indptr[-1]]
+            tasks.append((self.count_csr, (block_indptr - block_indptr[0], block_indices, row_offset + start)))
+        self.run(grid, tasks)
+
+    def add_csc(self, grid, indptr, indices, col_offset=0):
+        """
+        Accumulate CSC columns starting at column `col_offset`, in chunks.
+
+        `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+        """
+        tasks = []
+        for start, stop in self._get_compressed_chunks(indptr):
+            block_indptr = indptr[start:(stop + 1)]
+            block_indices = indices[block_indptr[0]:block_indptr[-1]]
+            tasks.append((self.count_csc, (block_indptr - block_indptr[0], block_indices, col_offset + start)))
+        self.run(grid, tasks)
+
+    def finish(self, grid) -> np.array:
+        """
+        Convert an accumulated grid to spy plot data of shape `spy_shape`, as counts of type `dtype`.
+        """
+        grid = grid[:self._bucket_shape[0], :self._bucket_shape[1]]
+
+        if self.row_expand is not None:
+            grid = grid[self.row_expand, :]
+        if self.col_expand is not None:
+            grid = grid[:, self.col_expand]
+
+        return grid.astype(self.dtype, copy=False)
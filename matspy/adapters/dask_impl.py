@@ -0,0 +1,99 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from itertools import accumulate
+from typing import Optional
+
+import numpy as np
+import dask
+
+from . import describe, MatrixSpyAdapter
+from .binning import SpyBinner
+from .numpy_impl import _count_nonzero
+
+SPLIT_EVERY = 8
+"""How many chunk grids are summed by each task of the reduction tree."""
+
+
+def _count_block(binner: SpyBinner, block, row_offset, col_offset, precision) -> np.array:
+    # in the binner's compact type, so the grids summed by the reduction tree are small
+    return _count_block_wide(binner, block, row_offset, col_offset, precision).astype(binner.dtype, copy=False)
+
+
+def _count_block_wide(binner: SpyBinner, block, row_offset, col_offset, precision) -> np.array:
+    if isinstance(block, np.ndarray):
+        return _count_nonzero(binner, block, precision, row_offset=row_offset, col_offset=col_offset)
+
+    # sparse chunk, such as PyData/Sparse or SciPy sparse
+    coo = block if hasattr(block, "coords") else block.tocoo()
+    if hasattr(coo, "coords"):
+        rows, cols = coo.coords[0], coo.coords[1]
+    else:
+        rows, cols = coo.row, coo.col
+    return binner.count_coo(np.asarray(rows, dtype="int64") + row_offset, np.asarray(cols, dtype="int64") + col_offset)
+
+
+def _sum_grids(*grids) -> np.array:
+    ret = grids[0].copy()
+    for grid in grids[1:]:
+        ret += grid
+    return ret
+
+
+class DaskSpy(MatrixSpyAdapter):
+    """
+    Dask array. Chunks may be dense or sparse-backed.
+
+    Each chunk is binned independently by a Dask task and the bucket grids are summed in a tree,
+    so the array is never materialized. Uses the current Dask scheduler.
+    """
+    def __init__(self, arr):
+        super().__init__()
+        if len(arr.shape) != 2:
+            raise ValueError("Only 2D arrays are supported")
+        self.arr = arr
+
+    def get_shape(self) -> tuple:
+        return self.arr.shape
+
+    def describe(self) -> str:
+        return describe(shape=self.arr.shape, nz_type=self.arr.dtype, layout="dask array",
+                        notes=f"{self.arr.npartitions} chunks")
+
+    def get_matrix(self):
+        return self.arr
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        # Dask arrays are immutable and their name is a token of their task graph
+        return self.arr.name,
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        return self.get_spy_window(spy_shape, (0, self.arr.shape[0]), (0, self.arr.shape[1]))
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        # slicing is lazy, only chunks that overlap the window are computed
+        arr = self.arr[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+
+        # every element is counted at most once, so the window's size bounds the counts
+        binner = SpyBinner(arr.shape, spy_shape, self.options, max_count=arr.size)
+        precision = self.get_option("precision", None)
+
+        # the binner holds the bucket maps, so put it in the graph once rather than in every task
+        binner_key = dask.delayed(binner, traverse=False)
+
+        row_offsets = [0] + list(accumulate(arr.chunks[0]))
+        col_offsets = [0] + list(accumulate(arr.chunks[1]))
+        blocks = arr.to_delayed()
+        grids = [dask.delayed(_count_block, pure=True)(binner_key, blocks[i, j], row_offsets[i], col_offsets[j],
+                                                       precision)
+                 for i in range(blocks.shape[0]) for j in range(blocks.shape[1])]
+        if not grids:
+            return binner.finish(binner.new_grid())
+
+        # tree reduction of the small grids
+        while len(grids) > 1:
+            grids = [dask.delayed(_sum_grids, pure=True)(*grids[i:(i + SPLIT_EVERY)])
+                     for i in range(0, len(grids), SPLIT_EVERY)]
+
+        return binner.finish(grids[0].compute())
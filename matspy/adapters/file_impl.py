@@ -0,0 +1,386 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Spy matrices stored in files without loading them into memory.
+
+Coordinates are streamed from the file in chunks and binned as they are read.
+"""
+
+import bz2
+import gzip
+import os
+import struct
+import zipfile
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+import numpy.lib.format
+
+from . import describe, MatrixSpyAdapter, DEFAULT_MAX_CHUNK_BYTES
+from .binning import SpyBinner
+
+
+def _get_binner(adapter: MatrixSpyAdapter, spy_shape, window=None, max_count=None) -> SpyBinner:
+    options = dict(adapter.options)
+    if not options.get("max_chunk_bytes", None):
+        options["max_chunk_bytes"] = DEFAULT_MAX_CHUNK_BYTES
+    return SpyBinner(adapter.get_shape(), spy_shape, options, window=window, max_count=max_count)
+
+
+def _get_chunk_elements(binner: SpyBinner) -> int:
+    # noinspection PyProtectedMember
+    return binner._get_max_chunk_elements()
+
+
+def _file_fingerprint(*paths: Path) -> tuple:
+    ret = []
+    for path in paths:
+        stat = path.stat()
+        ret.append((str(path.resolve()), stat.st_size, stat.st_mtime_ns))
+    return tuple(ret)
+
+
+def _open_compressed(path: Path):
+    suffix = path.suffix.lower()
+    if suffix == ".gz":
+        return gzip.open(path, "rb")
+    if suffix == ".bz2":
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+class MatrixMarketSpy(MatrixSpyAdapter):
+    """
+    Matrix Market `.mtx` file in coordinate format. May be compressed with gzip or bzip2.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+
+        with _open_compressed(self.path) as f:
+            banner = f.readline().decode("ascii").split()
+            if len(banner) != 5 or banner[0].lower() != "%%matrixmarket" or banner[1].lower() != "matrix":
+                raise ValueError(f"{self.path} is not a Matrix Market matrix file")
+
+            self.mm_format, self.field, self.symmetry = (x.lower() for x in banner[2:])
+            if self.mm_format != "coordinate":
+                raise ValueError("Only coordinate Matrix Market files are supported")
+
+            line = f.readline()
+            while line.startswith(b"%") or not line.strip():
+                line = f.readline()
+            nrows, ncols, self.nnz = (int(x) for x in line.split())
+            self.shape = (nrows, ncols)
+
+    def get_shape(self) -> tuple:
+        return self.shape
+
+    def describe(self) -> str:
+        notes = self.symmetry if self.symmetry != "general" else None
+        return describe(shape=self.shape, nnz=self.nnz, nz_type=self.field, layout="Matrix Market", notes=notes)
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        return _file_fingerprint(self.path)
+
+    def _iter_coordinates(self, chunk_bytes) -> Iterator[Tuple[np.array, np.array]]:
+        num_tokens = {"pattern": 2, "complex": 4}.get(self.field, 3)
+
+        with _open_compressed(self.path) as f:
+            # skip the header
+            line = f.readline()
+            while line.startswith(b"%") or not line.strip():
+                line = f.readline()
+
+            remainder = b""
+            while True:
+                block = f.read(chunk_bytes)
+                if not block:
+                    break
+
+                # only parse whole lines
+                block = remainder + block
+                end = block.rfind(b"\n") + 1
+                block, remainder = block[:end], block[end:]
+                if not block:
+                    continue
+
+                yield self._parse(block, num_tokens)
+
+            if remainder.strip():
+                yield self._parse(remainder, num_tokens)
+
+    @staticmethod
+    def _parse(block: bytes, num_tokens) -> Tuple[np.array, np.array]:
+        entries = np.fromstring(block.decode("ascii"), sep=" ").reshape(-1, num_tokens)
+        # Matrix Market indices are 1-based
+        return entries[:, 0].astype("int64") - 1, entries[:, 1].astype("int64") - 1
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        return self.get_spy_window(spy_shape, (0, self.shape[0]), (0, self.shape[1]))
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        # elements outside the window are still read, but discarded by the binner
+        max_count = self.nnz if self.symmetry == "general" else 2 * self.nnz
+        binner = _get_binner(self, spy_shape, window=(row_range, col_range), max_count=max_count)
+        grid = binner.new_grid()
+
+        # Text is about 20 bytes per element, parsed into 8 bytes per token.
+        chunk_bytes = max(2**16, _get_chunk_elements(binner) * 20 // 4)
+        for rows, cols in self._iter_coordinates(chunk_bytes):
+            binner.add_coo(grid, rows, cols)
+
+            if self.symmetry != "general":
+                # only one triangle is stored, mirror off-diagonal elements
+                off_diagonal = rows != cols
+                binner.add_coo(grid, cols[off_diagonal], rows[off_diagonal])
+
+        return binner.finish(grid)
+
+
+class _NpyArray:
+    """
+    A `.npy` array, either a standalone file or a member of a `.npz` archive, that is read in chunks.
+
+    Standalone files and uncompressed archive members are memory-mapped.
+    Compressed archive members are decompressed as they are read.
+    """
+    def __init__(self, path: Path, member: str = None):
+        self.path = path
+        self.member = member
+        self.array = None
+
+        if member is None:
+            self.array = np.load(path, mmap_mode="r")
+            self.shape, self.dtype = self.array.shape, self.array.dtype
+            return
+
+        with zipfile.ZipFile(path) as zf:
+            info = zf.getinfo(member + ".npy")
+            with zf.open(info) as f:
+                self.shape, fortran_order, self.dtype = self._read_header(f)
+                header_size = f.tell()
+
+            if info.compress_type == zipfile.ZIP_STORED and not self.dtype.hasobject:
+                # The member is stored as-is, so its data can be memory-mapped.
+                # Find the start of the member's data by reading its local file header.
+                with open(path, "rb") as raw:
+                    raw.seek(info.header_offset + 26)
+                    name_len, extra_len = struct.unpack("<HH", raw.read(4))
+                offset = info.header_offset + 30 + name_len + extra_len + header_size
+                self.array = np.memmap(path, dtype=self.dtype, mode="r", offset=offset, shape=self.shape,
+                                       order=("F" if fortran_order else "C"))
+            elif fortran_order and len(self.shape) > 1:
+                # cannot be streamed in row order
+                with zf.open(info) as f:
+                    self.array = numpy.lib.format.read_array(f)
+
+    @staticmethod
+    def _read_header(f):
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            return numpy.lib.format.read_array_header_1_0(f)
+        else:
+            return numpy.lib.format.read_array_header_2_0(f)
+
+    def read(self) -> np.array:
+        """
+        Read the entire array. Only for small arrays.
+        """
+        if self.array is not None:
+            return np.asarray(self.array)
+
+        with zipfile.ZipFile(self.path) as zf:
+            with zf.open(self.member + ".npy") as f:
+                return numpy.lib.format.read_array(f)
+
+    def iter_chunks(self, chunk_size, row: int = None) -> Iterator[np.array]:
+        """
+        Iterate over the array, or row `row` of a 2D array, in consecutive 1D chunks of `chunk_size` elements.
+        """
+        length = self.shape[-1] if row is not None else int(np.prod(self.shape))
+
+        if self.array is not None:
+            flat = self.array[row] if row is not None else self.array.reshape(-1)
+            for start in range(0, length, chunk_size):
+                yield np.asarray(flat[start:(start + chunk_size)])
+            return
+
+        itemsize = self.dtype.itemsize
+        with zipfile.ZipFile(self.path) as zf:
+            with zf.open(self.member + ".npy") as f:
+                self._read_header(f)
+
+                if row:
+                    # skip to the start of the row
+                    to_skip = row * length * itemsize
+                    while to_skip > 0:
+                        to_skip -= len(f.read(min(to_skip, chunk_size * itemsize)))
+
+                remaining = length
+                while remaining > 0:
+                    count = min(remaining, chunk_size)
+                    yield np.frombuffer(f.read(count * itemsize), dtype=self.dtype)
+                    remaining -= count
+
+
+class NpzSpy(MatrixSpyAdapter):
+    """
+    SciPy sparse matrix saved with `scipy.sparse.save_npz`.
+
+    CSR, CSC and COO matrices are streamed. Other formats are loaded with SciPy.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+
+        with np.load(self.path) as npz:
+            if "format" not in npz or "shape" not in npz:
+                raise ValueError(f"{self.path} is not a SciPy sparse matrix file")
+            self.format = npz["format"].item()
+            if isinstance(self.format, bytes):
+                self.format = self.format.decode("ascii")
+            self.shape = tuple(int(x) for x in npz["shape"])
+
+        self.data = _NpyArray(self.path, "data")
+
+    def get_shape(self) -> tuple:
+        return self.shape
+
+    def describe(self) -> str:
+        return describe(shape=self.shape, nnz=int(np.prod(self.data.shape)), nz_type=self.data.dtype,
+                        layout=f"{self.format} (.npz)")
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        return _file_fingerprint(self.path)
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        return self.get_spy_window(spy_shape, (0, self.shape[0]), (0, self.shape[1]))
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        # elements outside the window are still read, but discarded by the binner
+        binner = _get_binner(self, spy_shape, window=(row_range, col_range),
+                             max_count=int(np.prod(self.data.shape)))
+        grid = binner.new_grid()
+        chunk_size = _get_chunk_elements(binner)
+
+        if self.format in ("csr", "csc"):
+            indptr = _NpyArray(self.path, "indptr").read()
+            indices = _NpyArray(self.path, "indices")
+
+            # rows (columns for CSC) are contiguous in indices, so read row blocks in order
+            # noinspection PyProtectedMember
+            chunks = binner._get_compressed_chunks(indptr)
+            index_chunks = indices.iter_chunks(chunk_size)
+            buffer = np.empty(0, dtype=indices.dtype)
+            for start, stop in chunks:
+                needed = int(indptr[stop] - indptr[start])
+                while len(buffer) < needed:
+                    buffer = np.concatenate((buffer, next(index_chunks)))
+                block_indptr = indptr[start:(stop + 1)] - indptr[start]
+                if self.format == "csr":
+                    binner.add_csr(grid, block_indptr, buffer[:needed], row_offset=start)
+                else:
+                    binner.add_csc(grid, block_indptr, buffer[:needed], col_offset=start)
+                buffer = buffer[needed:]
+        elif self.format == "coo":
+            try:
+                rows = _NpyArray(self.path, "row")
+                cols = _NpyArray(self.path, "col")
+                row_chunks, col_chunks = rows.iter_chunks(chunk_size), cols.iter_chunks(chunk_size)
+            except KeyError:
+                coords = _NpyArray(self.path, "coords")
+                row_chunks, col_chunks = coords.iter_chunks(chunk_size, row=0), coords.iter_chunks(chunk_size, row=1)
+
+            for row_chunk, col_chunk in zip(row_chunks, col_chunks):
+                binner.add_coo(grid, row_chunk, col_chunk)
+        else:
+            import scipy.sparse
+            from .scipy_impl import SciPySpy
+            adapter = SciPySpy(scipy.sparse.load_npz(self.path))
+            adapter.options = self.options
+            return adapter.get_spy_window(spy_shape, row_range, col_range)
+
+        return binner.finish(grid)
+
+
+class NpyCoordinatesSpy(MatrixSpyAdapter):
+    """
+    Coordinates stored in raw `.npy` files. Files are memory-mapped.
+
+    Either a single file with a `(nnz, 2)` or `(2, nnz)` integer array, or a pair of `(rows, cols)` files.
+    """
+    def __init__(self, path: Union[str, os.PathLike, Tuple], shape: Optional[Tuple[int, int]] = None):
+        super().__init__()
+        if isinstance(path, (tuple, list)):
+            self.paths = tuple(Path(p) for p in path)
+            self.rows = np.load(self.paths[0], mmap_mode="r")
+            self.cols = np.load(self.paths[1], mmap_mode="r")
+        else:
+            self.paths = (Path(path),)
+            coords = np.load(self.paths[0], mmap_mode="r")
+            if coords.ndim != 2 or 2 not in coords.shape:
+                raise ValueError("Coordinate array must have shape (nnz, 2) or (2, nnz)")
+            if coords.shape[0] == 2 and coords.shape[1] != 2:
+                self.rows, self.cols = coords[0], coords[1]
+            else:
+                self.rows, self.cols = coords[:, 0], coords[:, 1]
+
+        if len(self.rows) != len(self.cols):
+            raise ValueError("Row and column arrays must have the same length")
+
+        if shape is None:
+            # one pass over the coordinates
+            shape = tuple(int(np.max(x, initial=-1)) + 1 for x in (self.rows, self.cols))
+        self.shape = tuple(shape)
+
+    def get_shape(self) -> tuple:
+        return self.shape
+
+    def describe(self) -> str:
+        return describe(shape=self.shape, nnz=len(self.rows), layout="coordinates (.npy)")
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        return self.shape, _file_fingerprint(*self.paths)
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        return self.get_spy_window(spy_shape, (0, self.shape[0]), (0, self.shape[1]))
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        # elements outside the window are still read, but discarded by the binner
+        binner = _get_binner(self, spy_shape, window=(row_range, col_range), max_count=len(self.rows))
+        grid = binner.new_grid()
+
+        chunk_size = _get_chunk_elements(binner)
+        for start in range(0, len(self.rows), chunk_size):
+            stop = start + chunk_size
+            binner.add_coo(grid, np.asarray(self.rows[start:stop]), np.asarray(self.cols[start:stop]))
+
+        return binner.finish(grid)
+
+
+def open_spy_file(path, shape: Optional[Tuple[int, int]] = None) -> MatrixSpyAdapter:
+    """
+    Create an adapter that spies a matrix stored in a file, without loading the matrix into memory.
+
+    Supported files:
+     - Matrix Market `.mtx`, `.mtx.gz`, `.mtx.bz2` in coordinate format.
+     - `.npz` SciPy sparse matrices saved by `scipy.sparse.save_npz`.
+     - `.npy` coordinate arrays, either one file of shape `(nnz, 2)` or `(2, nnz)` or a pair of `(rows, cols)` files.
+       `shape` is the matrix shape. If omitted it is computed from the largest coordinates.
+    """
+    if isinstance(path, (tuple, list)):
+        return NpyCoordinatesSpy(path, shape=shape)
+
+    path = Path(path)
+    suffixes = [s.lower() for s in path.suffixes]
+    if ".mtx" in suffixes:
+        return MatrixMarketSpy(path)
+    if suffixes and suffixes[-1] == ".npz":
+        return NpzSpy(path)
+    if suffixes and suffixes[-1] == ".npy":
+        return NpyCoordinatesSpy(path, shape=shape)
+
+    raise ValueError(f"Unsupported file type: {path}")
@@ -0,0 +1,122 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Compiled binning kernels. Requires Numba.
+
+Each kernel accumulates counts into a grid in a single pass, without the index and mask temporaries of the
+NumPy implementations in `binning.SpyBinner`. Bucket maps are non-decreasing, so consecutive rows (or columns)
+that fall into the same bucket form a group. Groups write to disjoint rows (or columns) of the grid,
+so they are processed in parallel without locks.
+
+Each kernel is compiled twice: a parallel version, and a serial version for callers that are already running
+in parallel. See `binning.get_kernels`.
+"""
+
+import numpy as np
+from numba import get_num_threads, njit, prange
+
+
+def _group_bounds(bucket_map):
+    """
+    Start of each run of equal buckets in the non-decreasing `bucket_map`, followed by `len(bucket_map)`.
+    """
+    if len(bucket_map) == 0:
+        return np.zeros(1, dtype=np.int64)
+    return np.concatenate((np.zeros(1, dtype=np.int64), np.flatnonzero(np.diff(bucket_map)) + 1,
+                           np.array([len(bucket_map)], dtype=np.int64)))
+
+
+def _count_compressed(major_map, minor_map, bounds, indptr, indices, grid, transposed):
+    for group in prange(len(bounds) - 1):
+        major = major_map[bounds[group]]
+        for i in range(bounds[group], bounds[group + 1]):
+            for k in range(indptr[i], indptr[i + 1]):
+                if transposed:
+                    grid[minor_map[indices[k]], major] += 1
+                else:
+                    grid[major, minor_map[indices[k]]] += 1
+
+
+def _count_coo(row_map, col_map, rows, cols, partials):
+    # Coordinates are unordered, so each part accumulates into its own grid.
+    num_parts = partials.shape[0]
+    n = len(rows)
+    for part in prange(num_parts):
+        for k in range(n * part // num_parts, n * (part + 1) // num_parts):
+            partials[part, row_map[rows[k]], col_map[cols[k]]] += 1
+
+
+def _count_dense(values, precision, row_map, col_map, bounds, grid):
+    num_cols = values.shape[1]
+    for group in prange(len(bounds) - 1):
+        row_bucket = row_map[bounds[group]]
+        for i in range(bounds[group], bounds[group + 1]):
+            for j in range(num_cols):
+                value = values[i, j]
+                if precision != 0:
+                    hit = value > precision or value < -precision
+                else:
+                    hit = value != 0
+                if hit:
+                    grid[row_bucket, col_map[j]] += 1
+
+
+_parallel = {
+    "compressed": njit(parallel=True, cache=True)(_count_compressed),
+    "coo": njit(parallel=True, cache=True)(_count_coo),
+    "dense": njit(parallel=True, cache=True)(_count_dense),
+}
+
+_serial = {
+    "compressed": njit(cache=True)(_count_compressed),
+    "coo": njit(cache=True)(_count_coo),
+    "dense": njit(cache=True)(_count_dense),
+}
+
+
+def count_csr(grid, row_map, col_map, indptr, indices, parallel=True):
+    """
+    Accumulate CSR rows into `grid`. `row_map` is the bucket map of these rows only.
+    `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+    """
+    kernels = _parallel if parallel else _serial
+    kernels["compressed"](row_map, col_map, _group_bounds(row_map), indptr, indices, grid, False)
+
+
+def count_csc(grid, row_map, col_map, indptr, indices, parallel=True):
+    """
+    Accumulate CSC columns into `grid`. `col_map` is the bucket map of these columns only.
+    `indptr` may be a slice of a larger `indptr`, i.e. it need not start at 0.
+    """
+    kernels = _parallel if parallel else _serial
+    kernels["compressed"](col_map, row_map, _group_bounds(col_map), indptr, indices, grid, True)
+
+
+def count_coo(grid, row_map, col_map, rows, cols, parallel=True):
+    """
+    Accumulate elements at coordinates `(rows[i], cols[i])` into `grid`.
+
+    In parallel, the coordinates are split into parts that each accumulate into a temporary grid.
+    There are only as many parts as there are elements per grid cell, so the temporary grids stay small.
+    """
+    num_parts = min(get_num_threads(), len(rows) // max(1, grid.size)) if parallel else 1
+    if num_parts <= 1:
+        partials = grid[np.newaxis, :, :]
+        _serial["coo"](row_map, col_map, rows, cols, partials)
+        return
+
+    partials = np.zeros((num_parts,) + grid.shape, dtype=grid.dtype)
+    _parallel["coo"](row_map, col_map, rows, cols, partials)
+    grid += partials.sum(axis=0, dtype=grid.dtype)
+
+
+def count_dense(grid, values, precision, row_map, col_map, parallel=True):
+    """
+    Accumulate the nonzeros of a dense block into `grid`, or if `precision` is set the elements `x` with
+    `x > precision or x < -precision`, like `numpy_impl._get_mask`.
+    `row_map` and `col_map` are the bucket maps of the block's rows and columns.
+    """
+    kernels = _parallel if parallel else _serial
+    kernels["dense"](values, float(precision or 0), row_map, col_map, _group_bounds(row_map), grid)
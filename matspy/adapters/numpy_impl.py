@@ -2,11 +2,91 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import math
+from typing import Optional
+
 import numpy as np
-from scipy.sparse import csr_matrix
 
-from . import describe, MatrixSpyAdapter
-from .scipy_impl import SciPySpy
+from . import array_checksum, array_fingerprint, describe, is_mutable, MatrixSpyAdapter, DEFAULT_MAX_CHUNK_BYTES
+from .binning import SpyBinner, get_kernels, parallel_kernel
+
+DENSITY_SAMPLES = 4096
+"""Number of elements sampled to estimate an array's density, for choosing an engine."""
+
+
+def _get_mask(arr: np.array, precision) -> np.array:
+    if arr.dtype == 'object':
+        not_none = (arr != np.array([None]))
+        if precision:
+            if not np.all(not_none):
+                # avoid comparisons to None by making a copy and replacing None with 0
+                arr = arr.copy()
+                arr[arr == np.array([None])] = 0
+            mask = (arr > precision) | (arr < -precision)
+        else:
+            mask = (arr != 0) & not_none
+    else:
+        if precision:
+            mask = (arr > precision) | (arr < -precision)
+        else:
+            mask = (arr != 0)
+
+    return mask
+
+
+def _estimate_density(arr: np.array, precision) -> float:
+    if arr.size == 0:
+        return 0.0
+    flat_indices = np.linspace(0, arr.size - 1, num=min(DENSITY_SAMPLES, arr.size), dtype="int64")
+    sample = arr[np.unravel_index(flat_indices, arr.shape)]
+    return float(np.count_nonzero(_get_mask(sample, precision))) / len(sample)
+
+
+def _estimate_chunks(options: dict, num_rows, bytes_per_row) -> int:
+    """
+    Approximate number of row strips that `SpyBinner.get_row_chunks` splits `num_rows` rows into.
+    """
+    max_chunk_bytes = options.get("max_chunk_bytes", None) or DEFAULT_MAX_CHUNK_BYTES
+    chunks = math.ceil(num_rows * bytes_per_row / max_chunk_bytes)
+    chunk_rows = options.get("chunk_rows", None)
+    if chunk_rows:
+        chunks = max(chunks, math.ceil(num_rows / chunk_rows))
+    return max(1, chunks, options.get("workers", None) or 1)
+
+
+def _kernel_supports(dtype: np.dtype) -> bool:
+    """
+    Whether the compiled kernels can read arrays of `dtype`. Numba does not support float16 or non-native byte order.
+    """
+    return dtype.isnative and (dtype.kind in "biu" or dtype in (np.float32, np.float64))
+
+
+def _count_nonzero(binner: SpyBinner, block: np.array, precision, row_offset=0, col_offset=0) -> np.array:
+    """
+    Count the nonzeros of a dense block into buckets, or if `precision` is set the elements with absolute value larger
+    than `precision`. The block starts at row `row_offset` and column `col_offset`.
+
+    Numeric blocks are counted by a compiled kernel if available, without creating a mask.
+    """
+    kernels = get_kernels(block.size) if _kernel_supports(block.dtype) else None
+    if kernels is None:
+        return binner.count_dense(_get_mask(block, precision), row_offset=row_offset, col_offset=col_offset)
+
+    grid = binner.new_grid()
+    with parallel_kernel() as parallel:
+        kernels.count_dense(grid, block, precision, binner.row_map[row_offset:(row_offset + block.shape[0])],
+                            binner.col_map[col_offset:(col_offset + block.shape[1])], parallel=parallel)
+    return grid
+
+
+def _count_strip(binner: SpyBinner, strip: np.array, precision, row_offset) -> np.array:
+    return _count_nonzero(binner, strip, precision, row_offset=row_offset)
+
+
+def _count_strip_coords(binner: SpyBinner, strip: np.array, precision, row_offset) -> np.array:
+    rows, cols = np.nonzero(_get_mask(strip, precision))
+    rows += row_offset
+    return binner.count_coo(rows, cols)
 
 
 class NumPySpy(MatrixSpyAdapter):
@@ -22,24 +102,61 @@ class NumPySpy(MatrixSpyAdapter):
     def describe(self) -> str:
         return describe(shape=self.arr.shape, nz_type=self.arr.dtype, layout="array")
 
+    def get_matrix(self):
+        return self.arr
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        if not is_mutable(self.arr):
+            return array_fingerprint(self.arr)
+
+        # Any element may have been edited in place since the heatmap was cached. Binning reads every element,
+        # so a checksum of all of them is cheap in comparison.
+        return array_fingerprint(self.arr) + (array_checksum(self.arr),)
+
+    def get_engines(self):
+        return "dense_block_reduce", "direct_bincount"
+
+    def estimate_engine_cost(self, engine: str, spy_shape: tuple) -> float:
+        # Nanoseconds per element, bucket, etc. Measured with `benchmarks/bench_heatmap.py:Engines`.
+        # Both engines compare every element, and each row strip accumulates into a grid of all buckets.
+        num_rows, num_cols = self.arr.shape
+        spy_cells = spy_shape[0] * spy_shape[1]
+        if engine == "direct_bincount":
+            nnz = self.arr.size * _estimate_density(self.arr, self.get_option("precision", None))
+            chunks = _estimate_chunks(self.options, num_rows, num_cols * (3 + 32))
+            ns = 4.8 * self.arr.size + 29 * nnz + 2 * spy_cells * chunks + 8 * spy_cells
+        else:
+            # summing bucket columns is strided, so it costs more per bucket than summing bucket rows
+            chunks = _estimate_chunks(self.options, num_rows, num_cols * (3 + 8))
+            ns = 4.5 * self.arr.size + 5 * spy_shape[0] * num_cols + 6 * spy_cells * chunks + 40 * spy_cells
+        return ns * 1e-9
+
     def get_spy(self, spy_shape: tuple) -> np.array:
-        precision = self.get_option("precision", None)
+        return self.get_spy_window(spy_shape, (0, self.arr.shape[0]), (0, self.arr.shape[1]))
 
-        if self.arr.dtype == 'object':
-            not_none = (self.arr != np.array([None]))
-            if precision:
-                arr = self.arr
-                if not np.all(not_none):
-                    # avoid comparisons to None by making a copy and replacing None with 0
-                    arr = arr.copy()
-                    arr[arr == np.array([None])] = 0
-                mask = (arr > precision) | (arr < -precision)
-            else:
-                mask = (self.arr != 0) & not_none
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        # a basic slice is a view, the window is not copied
+        arr = self.arr[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+
+        options = dict(self.options)
+        if not options.get("max_chunk_bytes", None):
+            options["max_chunk_bytes"] = DEFAULT_MAX_CHUNK_BYTES
+        binner = SpyBinner(arr.shape, spy_shape, options, max_count=arr.size)
+        grid = binner.new_grid()
+
+        # Process in row strips. Each element needs a few bytes of mask and comparison temporaries,
+        # and at most one int64 partial sum from summing rows within each bucket,
+        # or for direct binning up to two int64 coordinates and two int64 buckets.
+        if self.get_engine(spy_shape) == "direct_bincount":
+            count, bytes_per_row = _count_strip_coords, arr.shape[1] * (3 + 32)
+        elif _kernel_supports(arr.dtype) and get_kernels(arr.size) is not None:
+            # the compiled kernel makes no temporaries
+            count, bytes_per_row = _count_strip, 0
         else:
-            if precision:
-                mask = (self.arr > precision) | (self.arr < -precision)
-            else:
-                mask = (self.arr != 0)
+            count, bytes_per_row = _count_strip, arr.shape[1] * (3 + 8)
+        precision = self.get_option("precision", None)
+
+        binner.run(grid, [(count, (binner, arr[start:stop], precision, start))
+                          for start, stop in binner.get_row_chunks(arr.shape[0], bytes_per_row)])
 
-        return SciPySpy(csr_matrix(mask)).get_spy(spy_shape)
+        return binner.finish(grid)
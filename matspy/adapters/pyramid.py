@@ -0,0 +1,124 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from typing import List
+
+import numpy as np
+
+from . import MatrixSpyAdapter, count_dtype, generate_spy_bucket_map
+
+
+def _downsample(counts: np.array) -> np.array:
+    """
+    Halve each dimension longer than 1 by summing 2x2 blocks. An odd final row or column is its own block.
+    The sums keep the type of `counts`, which must hold the sum of all of `counts`.
+    """
+    factors = tuple(2 if dim > 1 else 1 for dim in counts.shape)
+    padded_shape = tuple(-(-dim // f) * f for dim, f in zip(counts.shape, factors))
+    if padded_shape != counts.shape:
+        padded = np.zeros(padded_shape, dtype=counts.dtype)
+        padded[:counts.shape[0], :counts.shape[1]] = counts
+        counts = padded
+
+    return counts.reshape(padded_shape[0] // factors[0], factors[0],
+                          padded_shape[1] // factors[1], factors[1]).sum(axis=(1, 3), dtype=counts.dtype)
+
+
+def _bucket_edges(matrix_dim, spy_dim) -> np.array:
+    """
+    The matrix indices where each of `spy_dim` buckets starts, followed by `matrix_dim`. `spy_dim <= matrix_dim`.
+    """
+    bucket_map, _ = generate_spy_bucket_map(matrix_dim, spy_dim)
+    return np.searchsorted(bucket_map, np.arange(spy_dim + 1), side="left")
+
+
+def _downsample_edges(edges: np.array) -> np.array:
+    """
+    Bucket edges after `_downsample`.
+    """
+    if len(edges) <= 2:
+        return edges
+    halved = edges[0::2]
+    return halved if len(edges) % 2 == 1 else np.append(halved, edges[-1])
+
+
+def _resample(counts: np.array, edges: np.array, new_edges: np.array, axis: int) -> np.array:
+    """
+    Re-bin `counts` along `axis` from buckets that start at `edges` to buckets that start at `new_edges`.
+    Each bucket's count is split in proportion to the matrix indices it shares with each new bucket.
+    """
+    counts = np.moveaxis(counts, axis, 0).astype(np.float64)
+    cumulative = np.zeros((counts.shape[0] + 1,) + counts.shape[1:])
+    np.cumsum(counts, axis=0, out=cumulative[1:])
+
+    # the count before each new edge, interpolated within the bucket the edge falls into
+    k = np.clip(np.searchsorted(edges, new_edges, side="right") - 1, 0, counts.shape[0] - 1)
+    fraction = (new_edges - edges[k]) / (edges[k + 1] - edges[k])
+    before = cumulative[k] + fraction[:, None] * counts[k]
+    return np.moveaxis(np.diff(before, axis=0), 0, axis)
+
+
+class SpyPyramid(MatrixSpyAdapter):
+    """
+    Multi-resolution spy data of a matrix.
+
+    The matrix is binned once at a fine resolution of `buckets`. Coarser levels are built by repeatedly summing
+    2x2 blocks. Spy requests that fit within the finest level are served from the closest level at least as large
+    as the request, without touching the matrix again. Sizes that are not an exact level are resampled from that
+    level: each cell's count is split among the requested buckets in proportion to the matrix indices they share.
+    These counts are floating point, and approximate the exact counts to within the resolution of that level.
+
+    Larger spy requests fall back to the original adapter, with the options the pyramid was built with.
+
+    A `SpyPyramid` is itself an adapter, so it can be passed to any MatSpy method in place of the matrix.
+    """
+    def __init__(self, adapter: MatrixSpyAdapter, buckets: int):
+        super().__init__()
+        self.adapter = adapter
+
+        mat_shape = adapter.get_shape()
+        # Not finer than the matrix. Finer spy data replicates elements into several buckets,
+        # so summing it into coarser levels would multiply the counts.
+        ratio = min(buckets, max(mat_shape)) / max(mat_shape)
+        fine_shape = tuple(max(1, int(ratio * x)) for x in mat_shape)
+
+        fine = adapter.get_spy(spy_shape=fine_shape)
+        if fine.dtype.kind in "biu":
+            # every level is summed in the type that holds the total count
+            fine = fine.astype(count_dtype(int(fine.sum())), copy=False)
+
+        self.levels: List[np.array] = [fine]
+        self.edges = [tuple(_bucket_edges(mat_dim, spy_dim) for mat_dim, spy_dim in zip(mat_shape, fine.shape))]
+        """The bucket edges of each level along each dimension, see `_bucket_edges`."""
+        while max(self.levels[-1].shape) > 1:
+            self.levels.append(_downsample(self.levels[-1]))
+            self.edges.append(tuple(_downsample_edges(edges) for edges in self.edges[-1]))
+
+    def describe(self) -> str:
+        return self.adapter.describe()
+
+    def get_shape(self) -> tuple:
+        return self.adapter.get_shape()
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        # smallest level that is at least as large as requested
+        candidates = [i for i, level in enumerate(self.levels)
+                      if level.shape[0] >= spy_shape[0] and level.shape[1] >= spy_shape[1]]
+        if not candidates:
+            return self.adapter.get_spy(spy_shape=spy_shape)
+
+        level, (row_edges, col_edges) = self.levels[candidates[-1]], self.edges[candidates[-1]]
+        if level.shape == tuple(spy_shape):
+            return np.array(level)
+
+        mat_shape = self.get_shape()
+        counts = _resample(level, row_edges, _bucket_edges(mat_shape[0], spy_shape[0]), axis=0)
+        return _resample(counts, col_edges, _bucket_edges(mat_shape[1], spy_shape[1]), axis=1)
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        if tuple(row_range) == (0, self.get_shape()[0]) and tuple(col_range) == (0, self.get_shape()[1]):
+            return self.get_spy(spy_shape)
+
+        # pyramid levels do not have the resolution for arbitrary windows, use the matrix
+        return self.adapter.get_spy_window(spy_shape, row_range, col_range)
@@ -2,26 +2,48 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
-from typing import Tuple
+import itertools
+import math
+from typing import Optional, Tuple
 
 import numpy as np
 import scipy.sparse
 
-from . import describe, generate_spy_triple_product, MatrixSpyAdapter
+from . import array_fingerprint, count_dtype, describe, generate_spy_triple_product, MatrixSpyAdapter, LARGE_DIM
+from . import DEFAULT_MAX_CHUNK_BYTES
+from .binning import SpyBinner, get_kernels
+from .numpy_impl import _estimate_chunks
 
 
-def generate_spy_triple_product_coo(matrix_shape, spy_shape) -> Tuple[scipy.sparse.coo_matrix, scipy.sparse.coo_matrix]:
+def generate_spy_triple_product_coo(matrix_shape, spy_shape, dtype="float64") ->\
+        Tuple[scipy.sparse.coo_matrix, scipy.sparse.coo_matrix]:
     # construct a triple product that will scale the matrix
     left, right = generate_spy_triple_product(matrix_shape, spy_shape)
 
     left_shape, (left_rows, left_cols) = left
     right_shape, (right_rows, right_cols) = right
-    left_mat = scipy.sparse.coo_matrix((np.ones(len(left_rows)), (left_rows, left_cols)), shape=left_shape)
-    right_mat = scipy.sparse.coo_matrix((np.ones(len(right_rows)), (right_rows, right_cols)), shape=right_shape)
+    left_mat = scipy.sparse.coo_matrix((np.ones(len(left_rows), dtype=dtype), (left_rows, left_cols)), shape=left_shape)
+    right_mat = scipy.sparse.coo_matrix((np.ones(len(right_rows), dtype=dtype), (right_rows, right_cols)),
+                                        shape=right_shape)
 
     return left_mat, right_mat
 
 
+def _count_bsr_blocks(binner: SpyBinner, rows, cols, blocksize) -> np.array:
+    """
+    Count the elements of BSR blocks whose top left elements are at `(rows[i], cols[i])`.
+    """
+    block_rows, block_cols = blocksize
+    shape = (len(rows), block_rows, block_cols)
+    element_rows = np.broadcast_to((rows[:, None] + np.arange(block_rows))[:, :, None], shape).ravel()
+    element_cols = np.broadcast_to((cols[:, None] + np.arange(block_cols))[:, None, :], shape).ravel()
+    return binner.count_coo(element_rows, element_cols)
+
+
+def _count_dense_strip(binner: SpyBinner, strip, row_offset) -> np.array:
+    return binner.count_dense(strip.toarray(), row_offset=row_offset)
+
+
 class SciPySpy(MatrixSpyAdapter):
     def __init__(self, mat):
         super().__init__()
@@ -34,20 +56,206 @@ class SciPySpy(MatrixSpyAdapter):
         return describe(shape=self.mat.shape, nnz=self.mat.nnz, nz_type=self.mat.dtype,
                         layout=self.mat.getformat())
 
-    def get_spy(self, spy_shape: tuple) -> np.array:
-        # construct a triple product that will scale the matrix
-        left, right = generate_spy_triple_product_coo(self.mat.shape, spy_shape)
+    def get_matrix(self):
+        return self.mat
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        fmt = self.mat.format
+        if fmt in ("csr", "csc", "bsr"):
+            arrays = (self.mat.indptr, self.mat.indices)
+        elif fmt == "coo":
+            arrays = (self.mat.row, self.mat.col)
+        elif fmt == "dia":
+            arrays = (self.mat.offsets, self.mat.data)
+        else:
+            # no cheap way to tell whether LIL and DOK matrices have changed
+            return None
+
+        return (fmt, self.mat.shape, self.mat.nnz, getattr(self.mat, "blocksize", None)) + \
+            tuple(array_fingerprint(arr) for arr in arrays)
+
+    def _add_bsr(self, binner: SpyBinner, grid):
+        # every element of a stored block is a stored element
+        block_rows, block_cols = self.mat.blocksize
+        num_block_rows = len(self.mat.indptr) - 1
+        rows = np.repeat(np.arange(num_block_rows, dtype="int64"), np.diff(self.mat.indptr)) * block_rows
+        cols = self.mat.indices.astype("int64") * block_cols
+
+        # Chunks of stored blocks. Each element needs its two int64 coordinates on top of the binning temporaries.
+        bytes_per_block = (16 + SpyBinner.BYTES_PER_ELEMENT) * block_rows * block_cols
+        binner.run(grid, [(_count_bsr_blocks, (binner, rows[start:stop], cols[start:stop], self.mat.blocksize))
+                          for start, stop in binner.get_row_chunks(len(rows), bytes_per_block)])
+
+    def _get_dia_diagonals(self):
+        """
+        Yield the `(rows, cols)` coordinates of the stored elements of each diagonal of a DIA matrix.
+        """
+        # Like SciPy's conversion to other formats, elements that are out of bounds or zero are not stored elements.
+        num_rows, num_cols = self.mat.shape
+        for k, offset in enumerate(self.mat.offsets):
+            offset = int(offset)
+            cols = np.arange(max(0, offset), min(num_cols, num_rows + offset, self.mat.data.shape[1]), dtype="int64")
+            cols = cols[self.mat.data[k, cols] != 0]
+            yield cols - offset, cols
+
+    def _get_lil_csr(self):
+        """
+        The `(indptr, indices)` of a LIL matrix's structure in CSR format.
+        """
+        indptr = np.zeros(len(self.mat.rows) + 1, dtype="int64")
+        np.cumsum([len(row) for row in self.mat.rows], out=indptr[1:])
+        indices = np.fromiter(itertools.chain.from_iterable(self.mat.rows), dtype="int64", count=int(indptr[-1]))
+        return indptr, indices
+
+    def _get_dok_coords(self):
+        """
+        The `(rows, cols)` coordinates of a DOK matrix's stored elements.
+        """
+        coords = np.fromiter(itertools.chain.from_iterable(self.mat.keys()), dtype="int64", count=2 * self.mat.nnz)
+        return coords[0::2], coords[1::2]
+
+    def _add_dia(self, binner: SpyBinner, grid):
+        for rows, cols in self._get_dia_diagonals():
+            binner.add_coo(grid, rows, cols)
 
-        # save existing matrix data
-        mat_data_save = self.mat.data
+    def _add_lil(self, binner: SpyBinner, grid):
+        binner.add_csr(grid, *self._get_lil_csr())
+
+    def _add_dok(self, binner: SpyBinner, grid):
+        binner.add_coo(grid, *self._get_dok_coords())
+
+    def get_engines(self):
+        return "direct_bincount", "triple_product", "dense_block_reduce"
+
+    def estimate_engine_cost(self, engine: str, spy_shape: tuple) -> float:
+        # Nanoseconds per element, bucket, etc. Measured with `benchmarks/bench_heatmap.py:Engines`.
+        nnz = self.mat.nnz
+        num_rows, num_cols = self.mat.shape
+        spy_cells = spy_shape[0] * spy_shape[1]
+        large = max(self.mat.shape) > LARGE_DIM
+        compressed = self.mat.format in ("csr", "csc")
+
+        if engine == "direct_bincount":
+            # Every element is binned, then the grid is summed once.
+            # The compiled kernels bin CSR, CSC and COO elements without temporaries.
+            if self.mat.format in ("csr", "csc", "coo") and get_kernels(nnz) is not None:
+                per_element = (15 if large else 4.5) if compressed else (25 if large else 6.5)
+            else:
+                per_element = (27 if large else 15) if compressed else 35
+            ns = nnz * per_element + 5 * spy_cells
+        elif engine == "triple_product":
+            # The first multiply is cheap per element but makes random accesses into a workspace of all columns.
+            # Its result has an element per distinct (row bucket, column) pair, which the second multiply visits.
+            inner = spy_shape[0] * num_cols
+            distinct = -inner * math.expm1(-nnz / inner) if inner else 0
+            ns = nnz * (100 if large else 8) + 35 * distinct + 0.7 * spy_cells + 20 * (num_rows + num_cols) + 2e6
+            if not compressed:
+                # building a CSR structure from the format's index arrays
+                ns += 80 * nnz
+        else:
+            chunks = _estimate_chunks(self.options, num_rows, num_cols * (4 + 8))
+            ns = 6 * num_rows * num_cols + 5 * nnz + 6 * spy_cells * chunks + 40 * spy_cells
+            if not compressed:
+                ns += 80 * nnz
+        return ns * 1e-9
+
+    def _get_structure(self, row_range, col_range, dtype="int32"):
+        """
+        The window of the matrix in CSR or CSC format with every stored element replaced by 1 of type `dtype`.
+        The matrix itself is not modified, and its values are not copied. Only DIA values are read, to skip zeros.
+        """
+        fmt = self.mat.format
+        shape = self.mat.shape
+        if fmt in ("csr", "csc"):
+            nnz = int(self.mat.indptr[-1])
+            structure = type(self.mat)((np.ones(nnz, dtype=dtype), self.mat.indices[:nnz], self.mat.indptr),
+                                       shape=shape)
+        elif fmt == "bsr":
+            num_blocks = int(self.mat.indptr[-1])
+            structure = scipy.sparse.bsr_matrix((np.ones((num_blocks,) + self.mat.blocksize, dtype=dtype),
+                                                 self.mat.indices[:num_blocks], self.mat.indptr),
+                                                shape=shape).tocsr()
+        elif fmt == "lil":
+            indptr, indices = self._get_lil_csr()
+            structure = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=dtype), indices, indptr), shape=shape)
+        else:
+            if fmt == "coo":
+                rows, cols = self.mat.row, self.mat.col
+            elif fmt == "dia":
+                diagonals = list(self._get_dia_diagonals())
+                rows = np.concatenate([rows for rows, _ in diagonals] or [np.empty(0, dtype="int64")])
+                cols = np.concatenate([cols for _, cols in diagonals] or [np.empty(0, dtype="int64")])
+            elif fmt == "dok":
+                rows, cols = self._get_dok_coords()
+            else:
+                coo = self.mat.tocoo()
+                rows, cols = coo.row, coo.col
+            structure = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=shape).tocsr()
+
+        if tuple(row_range) != (0, self.mat.shape[0]) or tuple(col_range) != (0, self.mat.shape[1]):
+            structure = structure[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+        return structure
+
+    def _get_spy_triple_product(self, spy_shape, row_range, col_range) -> np.array:
+        # multiply in the count type, so the product is the result without a conversion
+        dtype = count_dtype(self.mat.nnz)
+        structure = self._get_structure(row_range, col_range, dtype=dtype)
+        left, right = generate_spy_triple_product_coo(structure.shape, spy_shape, dtype=dtype)
+        return (left @ structure @ right).toarray()
+
+    def _get_spy_dense_block_reduce(self, spy_shape, row_range, col_range) -> np.array:
+        structure = self._get_structure(row_range, col_range).tocsr()
+
+        options = dict(self.options)
+        if not options.get("max_chunk_bytes", None):
+            options["max_chunk_bytes"] = DEFAULT_MAX_CHUNK_BYTES
+        binner = SpyBinner(structure.shape, spy_shape, options, max_count=structure.nnz)
+        grid = binner.new_grid()
+
+        # Each row strip is densified to int32 counts, then summed into buckets with int64 partial sums.
+        bytes_per_row = structure.shape[1] * (4 + 8)
+        binner.run(grid, [(_count_dense_strip, (binner, structure[start:stop], start))
+                          for start, stop in binner.get_row_chunks(structure.shape[0], bytes_per_row)])
+        return binner.finish(grid)
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        return self.get_spy_window(spy_shape, (0, self.mat.shape[0]), (0, self.mat.shape[1]))
 
-        # replace with all ones
-        self.mat.data = np.ones(self.mat.data.shape)
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        engine = self.get_engine(spy_shape)
+        if engine == "triple_product":
+            return self._get_spy_triple_product(spy_shape, row_range, col_range)
+        if engine == "dense_block_reduce":
+            return self._get_spy_dense_block_reduce(spy_shape, row_range, col_range)
 
-        # triple product
-        spy = left @ self.mat @ right
+        # Bin the structure directly. The matrix is never modified and its data is never copied,
+        # so a matrix may be spied from multiple threads at once.
+        options = dict(self.options)
+        if not options.get("max_chunk_bytes", None):
+            options["max_chunk_bytes"] = DEFAULT_MAX_CHUNK_BYTES
+        binner = SpyBinner(self.mat.shape, spy_shape, options, window=(row_range, col_range), max_count=self.mat.nnz)
+        grid = binner.new_grid()
 
-        # restore original matrix data
-        self.mat.data = mat_data_save
+        fmt = self.mat.format
+        if fmt == "csr":
+            # only visit the rows in the window
+            (row_start, row_stop), _ = binner.window
+            binner.add_csr(grid, self.mat.indptr[row_start:(row_stop + 1)], self.mat.indices, row_offset=row_start)
+        elif fmt == "csc":
+            _, (col_start, col_stop) = binner.window
+            binner.add_csc(grid, self.mat.indptr[col_start:(col_stop + 1)], self.mat.indices, col_offset=col_start)
+        elif fmt == "coo":
+            binner.add_coo(grid, self.mat.row, self.mat.col)
+        elif fmt == "bsr":
+            self._add_bsr(binner, grid)
+        elif fmt == "dia":
+            self._add_dia(binner, grid)
+        elif fmt == "lil":
+            self._add_lil(binner, grid)
+        elif fmt == "dok":
+            self._add_dok(binner, grid)
+        else:
+            csr = self.mat.tocsr()
+            binner.add_csr(grid, csr.indptr, csr.indices)
 
-        return np.array(spy.todense())
+        return binner.finish(grid)
@@ -2,12 +2,14 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import sparse
 
-from . import describe, generate_spy_triple_product, MatrixSpyAdapter
+from . import array_fingerprint, count_dtype, describe, generate_spy_triple_product, MatrixSpyAdapter
+from . import DEFAULT_MAX_CHUNK_BYTES
+from .binning import SpyBinner
 
 
 def generate_spy_triple_product_sparse(matrix_shape, spy_shape) -> Tuple[sparse.SparseArray, sparse.SparseArray]:
@@ -23,12 +25,40 @@ def generate_spy_triple_product_sparse(matrix_shape, spy_shape) -> Tuple[sparse.
 
 
 class PyDataSparseSpy(MatrixSpyAdapter):
-    def __init__(self, mat):
+    """
+    PyData/Sparse array.
+
+    Arrays with more than two dimensions are projected onto two of their axes, `axes[0]` for rows and `axes[1]`
+    for columns. The elements along the other axes are counted together. By default the first two axes are used.
+    The `axes` option, such as from the `axes` parameter, overrides them.
+    """
+    def __init__(self, mat, axes: Tuple[int, int] = None):
         super().__init__()
         self.mat = mat
 
+        if len(mat.shape) < 2:
+            raise ValueError("Only arrays with at least 2 dimensions are supported")
+        self._set_axes(axes)
+
+    def _set_axes(self, axes):
+        if axes is None:
+            axes = (0, 1)
+        ndim = len(self.mat.shape)
+        axes = tuple(int(axis) for axis in axes)
+        if any(not -ndim <= axis < ndim for axis in axes):
+            raise ValueError(f"axes must be in the range [{-ndim}, {ndim}), got {axes}")
+        axes = tuple(axis % ndim for axis in axes)
+        if len(axes) != 2 or axes[0] == axes[1]:
+            raise ValueError("axes must be two different axes")
+        self.axes = axes
+
+    def set_option(self, key, value):
+        super().set_option(key, value)
+        if key == "axes" and value is not None:
+            self._set_axes(value)
+
     def get_shape(self) -> tuple:
-        return self.mat.shape
+        return self.mat.shape[self.axes[0]], self.mat.shape[self.axes[1]]
 
     def describe(self) -> str:
         try:
@@ -36,32 +66,98 @@ class PyDataSparseSpy(MatrixSpyAdapter):
         except AttributeError:
             fmt = self.mat.__class__.__name__
 
-        return describe(shape=self.mat.shape,
+        notes = None
+        if len(self.mat.shape) > 2 or self.axes != (0, 1):
+            by = chr(215)  # ×
+            notes = f"axes {self.axes} of {by.join(str(dim) for dim in self.mat.shape)}"
+
+        return describe(shape=self.get_shape(),
                         nnz=self.mat.nnz, nz_type=self.mat.dtype,
-                        layout=fmt)
+                        layout=fmt, notes=notes)
+
+    def get_matrix(self):
+        return self.mat
+
+    def get_fingerprint(self) -> Optional[tuple]:
+        if isinstance(self.mat, sparse.COO):
+            arrays = (self.mat.coords,)
+        elif isinstance(self.mat, sparse.GCXS):
+            arrays = (self.mat.indptr, self.mat.indices)
+        else:
+            # no cheap way to tell whether DOK arrays have changed
+            return None
+
+        return (type(self.mat).__name__, self.mat.shape, self.axes, self.mat.nnz,
+                tuple(int(axis) for axis in getattr(self.mat, "compressed_axes", None) or ())) + \
+            tuple(array_fingerprint(arr) for arr in arrays)
+
+    def _get_coords(self) -> np.array:
+        """
+        Coordinates of the stored elements, as an array of shape `(ndim, nnz)`. The array is never modified.
+        """
+        if isinstance(self.mat, sparse.COO):
+            return self.mat.coords
 
-    def get_spy(self, spy_shape: tuple) -> np.array:
         if isinstance(self.mat, sparse.DOK):
-            self.mat = self.mat.asformat("coo")
-
-        # construct a triple product that will scale the matrix
-        left, right = generate_spy_triple_product_sparse(self.mat.shape, spy_shape)
-
-        # save existing matrix data
-        mat_data_save = self.mat.data
+            # read the keys of the element dictionary
+            coords = np.fromiter((i for key in self.mat.data for i in key), dtype="int64",
+                                 count=len(self.mat.data) * len(self.mat.shape))
+            return coords.reshape(-1, len(self.mat.shape)).T
+
+        # formats without direct coordinates, such as GCXS with more than 2 dimensions
+        return self.mat.asformat("coo").coords
+
+    def get_engines(self):
+        return "direct_bincount", "triple_product"
+
+    def estimate_engine_cost(self, engine: str, spy_shape: tuple) -> float:
+        # Nanoseconds per element, bucket, etc. Measured with `benchmarks/bench_heatmap.py:Engines`.
+        # PyData/Sparse multiplies are much slower per element, but write the result in place of the bucket grid.
+        spy_cells = spy_shape[0] * spy_shape[1]
+        if engine == "triple_product":
+            ns = 200 * self.mat.nnz + 20 * sum(self.get_shape()) + 4 * spy_cells + 1e6
+        else:
+            ns = 22 * self.mat.nnz + 8 * spy_cells
+        return ns * 1e-9
+
+    def _get_spy_triple_product(self, spy_shape, row_range, col_range) -> np.array:
+        # the projected structure, with every element replaced by 1
+        coords = self._get_coords()
+        structure = sparse.COO(coords=coords[list(self.axes)], data=np.ones(coords.shape[1]), shape=self.get_shape())
+        if tuple(row_range) != (0, structure.shape[0]) or tuple(col_range) != (0, structure.shape[1]):
+            structure = structure[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+
+        left, right = generate_spy_triple_product_sparse(structure.shape, spy_shape)
+        return np.asarray((left @ structure @ right).todense()).astype(count_dtype(coords.shape[1]))
 
-        # replace with all ones
-        self.mat.data = np.ones(self.mat.data.shape)
-
-        # triple product
-        try:
-            spy = left @ self.mat @ right
-        except ValueError:
-            # broken matmul on some types
-            temp = self.mat.asformat("coo")
-            spy = left @ temp @ right
-
-        # restore original matrix data
-        self.mat.data = mat_data_save
-
-        return np.array(spy.todense())
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        shape = self.get_shape()
+        return self.get_spy_window(spy_shape, (0, shape[0]), (0, shape[1]))
+
+    def get_spy_window(self, spy_shape: tuple, row_range: tuple, col_range: tuple) -> np.array:
+        if self.get_engine(spy_shape) == "triple_product":
+            return self._get_spy_triple_product(spy_shape, row_range, col_range)
+
+        options = dict(self.options)
+        if not options.get("max_chunk_bytes", None):
+            options["max_chunk_bytes"] = DEFAULT_MAX_CHUNK_BYTES
+        binner = SpyBinner(self.get_shape(), spy_shape, options, window=(row_range, col_range),
+                           max_count=self.mat.nnz)
+        grid = binner.new_grid()
+
+        row_axis, col_axis = self.axes
+        compressed_axes = tuple(int(axis) for axis in getattr(self.mat, "compressed_axes", None) or ())
+        is_gcxs_2d = isinstance(self.mat, sparse.GCXS) and len(self.mat.shape) == 2
+        if is_gcxs_2d and compressed_axes == (row_axis,):
+            # only visit the rows in the window
+            binner.add_csr(grid, self.mat.indptr[row_range[0]:(row_range[1] + 1)], self.mat.indices,
+                           row_offset=row_range[0])
+        elif is_gcxs_2d and compressed_axes == (col_axis,):
+            binner.add_csc(grid, self.mat.indptr[col_range[0]:(col_range[1] + 1)], self.mat.indices,
+                           col_offset=col_range[0])
+        else:
+            # coordinates outside the window are masked off by the binner
+            coords = self._get_coords()
+            binner.add_coo(grid, coords[row_axis], coords[col_axis])
+
+        return binner.finish(grid)
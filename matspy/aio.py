@@ -0,0 +1,82 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Asynchronous versions of MatSpy methods, for asyncio applications such as web services.
+
+The work runs in an executor so that the event loop is not blocked. Each method takes an `executor` argument,
+by default the event loop's default executor. Thread pools work best: NumPy releases the GIL in the heavy operations,
+and figures are drawn without pyplot's global state.
+
+Cancelling the awaiting task stops the computation at the next checkpoint: between the chunks of direct binning,
+see the `chunk_rows` and `max_chunk_bytes` parameters, and between the stages of binning, shading, drawing and
+encoding. A stage that is a single library call runs to completion, such as a triple product, GraphBLAS operation,
+Dask computation or matplotlib `savefig`. Process pool executors are supported, but their work cannot be stopped early.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import params, _get_spy_adapter
+
+
+async def _run(executor, func, *args):
+    # an event cannot be sent to another process
+    cancel_event = None if isinstance(executor, ProcessPoolExecutor) else threading.Event()
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, func, cancel_event, *args)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        if cancel_event is not None:
+            # stop the computation at the next checkpoint
+            cancel_event.set()
+        raise
+
+
+def _spy_heatmap(cancel_event, mat, buckets, kwargs) -> np.array:
+    from .heatmap import get_spy_heatmap
+
+    options = params.get(**kwargs)
+    options.buckets = buckets
+    return get_spy_heatmap(_get_spy_adapter(mat, options), cancel_event=cancel_event, **options.to_kwargs())
+
+
+def _sparkline(cancel_event, mat, retscale, scale, html_border, kwargs):
+    from .sparkline import _make_sparkline
+
+    options = params.get(**kwargs)
+    sparkline, scale = _make_sparkline(_get_spy_adapter(mat, options), options, scale, html_border,
+                                       cancel_event=cancel_event)
+    return (sparkline, scale) if retscale else sparkline
+
+
+def _spy_png(cancel_event, mat, kwargs) -> bytes:
+    from .spy_renderer import _spy_to_bytes
+    return _spy_to_bytes(mat, "png", cancel_event=cancel_event, **kwargs)
+
+
+async def ato_spy_heatmap(mat, buckets=500, executor=None, **kwargs) -> np.array:
+    """
+    Asynchronous `to_spy_heatmap`.
+    """
+    return await _run(executor, _spy_heatmap, mat, buckets, kwargs)
+
+
+async def ato_sparkline(mat, retscale=False, scale=None, html_border="1px solid black", executor=None, **kwargs):
+    """
+    Asynchronous `to_sparkline`.
+    """
+    return await _run(executor, _sparkline, mat, retscale, scale, html_border, kwargs)
+
+
+async def aspy_png(mat, executor=None, **kwargs) -> bytes:
+    """
+    Asynchronous `spy_to_png`.
+    """
+    return await _run(executor, _spy_png, mat, kwargs)
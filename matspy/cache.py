@@ -0,0 +1,200 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+import numpy as np
+
+from .adapters import MatrixSpyAdapter
+
+
+class HeatmapCache:
+    """
+    LRU cache of computed heatmaps.
+
+    Entries are keyed on the matrix object's identity, the adapter's content fingerprint,
+    and the parameters that affect the heatmap. A changed fingerprint, for example because the matrix was modified,
+    is a cache miss. Entries are dropped when their matrix is garbage collected.
+
+    Garbage collection may run on any thread at any allocation, including while the lock is held, so the weakref
+    callbacks only queue the ids of collected matrices. Their entries are dropped by the next locked call.
+    """
+    def __init__(self, max_entries: int = 128, max_bytes: int = 256 * 2**20):
+        self.max_entries = max_entries
+        """Maximum number of cached heatmaps."""
+
+        self.max_bytes = max_bytes
+        """Maximum total size of cached heatmaps, in bytes."""
+
+        self._entries = OrderedDict()
+        self._refs = {}
+        self._dropped = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(adapter: MatrixSpyAdapter, params: Hashable, fingerprint) -> Optional[Hashable]:
+        if fingerprint is None:
+            fingerprint = adapter.get_fingerprint()
+        if fingerprint is None:
+            return None
+        matrix = adapter.get_matrix()
+        return (id(matrix) if matrix is not None else None), fingerprint, params
+
+    def get(self, adapter: MatrixSpyAdapter, params: Hashable, fingerprint: Hashable = None) -> Optional[np.array]:
+        """
+        Return a copy of the cached heatmap of `adapter`'s matrix computed with `params`, or None.
+
+        `fingerprint` is the adapter's `get_fingerprint()`, if the caller already has it.
+        """
+        key = self._get_key(adapter, params, fingerprint)
+        if key is None:
+            return None
+
+        with self._lock:
+            self._drop_collected()
+            heatmap = self._entries.get(key, None)
+            if heatmap is None:
+                return None
+            self._entries.move_to_end(key)
+            return heatmap.copy()
+
+    def put(self, adapter: MatrixSpyAdapter, params: Hashable, heatmap: np.array, fingerprint: Hashable = None):
+        """
+        Cache the heatmap of `adapter`'s matrix computed with `params`.
+
+        `fingerprint` is the adapter's `get_fingerprint()` from before the heatmap was computed, if the caller
+        has it. An edit made while computing then does not leave a stale heatmap under the new fingerprint.
+        """
+        key = self._get_key(adapter, params, fingerprint)
+        if key is None or heatmap.nbytes > self.max_bytes:
+            return
+
+        matrix = adapter.get_matrix()
+        if matrix is not None:
+            matrix_id = key[0]
+            try:
+                ref = weakref.ref(matrix, lambda _: self._dropped.append(matrix_id))
+            except TypeError:
+                # cannot tell when this object is garbage collected, and its id may be reused
+                return
+
+        heatmap = heatmap.copy()
+        with self._lock:
+            self._drop_collected()
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = heatmap
+            self._bytes += heatmap.nbytes
+            if matrix is not None:
+                self._refs[key[0]] = ref
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                (evicted_id, _, _), evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                if not any(key[0] == evicted_id for key in self._entries):
+                    # the matrix's last entry, so its weakref is no longer needed
+                    self._refs.pop(evicted_id, None)
+
+    def _drop_collected(self):
+        """
+        Drop the entries of garbage collected matrices. Must be called with the lock held.
+        """
+        while self._dropped:
+            matrix_id = self._dropped.popleft()
+            self._refs.pop(matrix_id, None)
+            for key in [key for key in self._entries if key[0] == matrix_id]:
+                self._bytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._dropped.clear()
+            self._entries.clear()
+            self._refs.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            self._drop_collected()
+            return len(self._entries)
+
+
+heatmap_cache = HeatmapCache()
+"""The heatmap cache used when the `cache` parameter is True."""
+
+
+def freeze_arrays(value) -> int:
+    """
+    Make all NumPy arrays in `value`, which may be nested tuples and lists, read-only.
+
+    :return: total size of the arrays, in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(freeze_arrays(x) for x in value)
+    return 0
+
+
+class ProjectionCache:
+    """
+    LRU cache of bucket maps and projection matrices.
+
+    These only depend on shapes, such as `(matrix_shape, spy_shape, uneven_to_end)`, so they can be reused across
+    matrices. Renders of many same-shaped matrices then skip the setup entirely.
+    Cached values are shared and must not be modified.
+    """
+    def __init__(self, max_entries: int = 64, max_bytes: int = 64 * 2**20):
+        self.max_entries = max_entries
+        """Maximum number of cached values."""
+
+        self.max_bytes = max_bytes
+        """Maximum total size of cached values, in bytes."""
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, factory: Callable[[], Tuple[Any, int]]) -> Any:
+        """
+        Return the value cached under `key`. On a miss, `factory()` creates the value and returns `(value, nbytes)`.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        # created outside the lock, so concurrent misses may create the same value twice
+        value, nbytes = factory()
+        if nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+projection_cache = ProjectionCache()
+"""Cache of bucket maps and projection matrices, shared by all adapters."""
@@ -0,0 +1,263 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Spy heatmap computation. Does not use matplotlib.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .adapters import MatrixSpyAdapter
+from .adapters.binning import check_cancelled
+from .cache import heatmap_cache
+
+
+@dataclass(frozen=True)
+class ShadingStats:
+    """
+    Statistics of bucket counts that `relative` shading scales heatmaps by.
+
+    Heatmaps shaded with the same statistics are on the same scale, see `get_shading_stats` and
+    the `shading_stats` argument.
+    """
+    relative_max: float
+    """Bucket count shaded as full. Larger counts are also full."""
+
+
+def _top_k(positives, size, k):
+    """
+    The `k`-th largest of `positives`, the positive values of arrays with `size` elements in total.
+    If there are fewer than `k` positive values then the smallest one. None if there are none.
+    """
+    if positives.size == 0:
+        return None
+
+    k = min(k, size - 1)
+    if k < 1 or k > positives.size:
+        return positives.min()
+
+    # selection, not a full sort
+    kth = positives.size - k
+    return np.partition(positives, kth)[kth]
+
+
+def _concatenate(arrays):
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+def get_shading_stats(heatmaps, shading_relative_max_percentile) -> ShadingStats:
+    """
+    Relative shading statistics of one or more heatmaps of bucket counts, all at once.
+
+    The full bucket is the `shading_relative_max_percentile` percentile of the nonzero buckets of all heatmaps.
+    """
+    heatmaps = list(heatmaps)
+    nnz = sum(np.count_nonzero(counts) for counts in heatmaps)
+    k = max(1, nnz - int(nnz * shading_relative_max_percentile))
+
+    # slice off the final row/column because those can be artificially high due to aliasing effects
+    corners = [counts[:-1, :-1] for counts in heatmaps if min(counts.shape) > 3]
+    ret = None
+    if corners:
+        ret = _top_k(_concatenate([corner[corner > 0] for corner in corners]), sum(c.size for c in corners), k)
+
+    if not ret and heatmaps:
+        ret = _top_k(_concatenate([counts[counts > 0] for counts in heatmaps]), sum(c.size for c in heatmaps), k)
+
+    return ShadingStats(relative_max=float(ret) if ret else 1.0)
+
+
+def _get_window(mat_shape, row_range, col_range):
+    """
+    Resolve `row_range` and `col_range` against `mat_shape`, where `None` means the entire dimension.
+
+    :return: `(row_range, col_range)` as `(start, stop)` tuples.
+    """
+    ret = []
+    for name, dim, dim_range in (("row_range", mat_shape[0], row_range), ("col_range", mat_shape[1], col_range)):
+        if dim_range is None:
+            dim_range = (None, None)
+        start, stop = dim_range
+        start = 0 if start is None else int(start)
+        stop = dim if stop is None else int(stop)
+        if not 0 <= start <= stop <= dim:
+            raise ValueError(f"{name} must be a (start, stop) range within 0 and {dim}, got {tuple(dim_range)}")
+        ret.append((start, stop))
+    return tuple(ret)
+
+
+def _get_spy_counts(adapter: MatrixSpyAdapter, mat_shape, buckets, precision, engine, chunk_rows, max_chunk_bytes,
+                    workers, worker_type, row_range, col_range, cancel_event):
+    """
+    Bucket counts of the window `row_range`, `col_range` of shape `mat_shape`, at `buckets` resolution.
+    """
+    ratio = buckets / max(mat_shape)
+    spy_shape = tuple(max(1, int(ratio * x)) for x in mat_shape)
+
+    adapter.set_option("precision", precision)
+    adapter.set_option("engine", engine)
+    adapter.set_option("chunk_rows", chunk_rows)
+    adapter.set_option("max_chunk_bytes", max_chunk_bytes)
+    adapter.set_option("workers", workers)
+    adapter.set_option("worker_type", worker_type)
+    adapter.set_option("cancel_event", cancel_event)
+    check_cancelled(cancel_event)
+    if row_range != (0, adapter.get_shape()[0]) or col_range != (0, adapter.get_shape()[1]):
+        return adapter.get_spy_window(spy_shape, row_range, col_range)
+    else:
+        return adapter.get_spy(spy_shape=spy_shape)
+
+
+def _shade(counts, mat_shape, buckets, shading, shading_absolute_min, shading_relative_min,
+           shading_relative_max_percentile, heatmap_dtype, shading_stats):
+    # the only copy, all shading is done in place
+    dense = np.array(counts, dtype=heatmap_dtype)
+    if counts.dtype.kind != "u":
+        np.maximum(dense, 0, out=dense)
+
+    # scale values
+    if shading == "absolute":
+        divisor = max(mat_shape) / buckets
+        divisor *= divisor  # area
+        dense /= divisor
+        np.copyto(dense, shading_absolute_min, where=(0 < dense) & (dense < shading_absolute_min))
+        np.minimum(dense, 1, out=dense)
+    elif shading == "relative":
+        if shading_stats is None:
+            shading_stats = get_shading_stats([counts], shading_relative_max_percentile)
+
+        # map (0, relative_max] linearly to (shading_relative_min, 1]. Empty buckets stay 0 when scaled,
+        # so only the offset needs a mask.
+        dense *= (1 - shading_relative_min) / shading_stats.relative_max
+        np.add(dense, shading_relative_min, out=dense, where=dense > 0)
+        np.minimum(dense, 1, out=dense)
+    elif shading == "binary":
+        np.copyto(dense, 1, where=dense != 0)
+    else:
+        raise ValueError("shading must be one of 'absolute', 'relative', 'binary'")
+
+    return dense
+
+
+def _resolve_window(adapter: MatrixSpyAdapter, row_range, col_range):
+    """
+    :return: the window's `row_range`, `col_range` and shape.
+    """
+    row_range, col_range = _get_window(adapter.get_shape(), row_range, col_range)
+    return row_range, col_range, (row_range[1] - row_range[0], col_range[1] - col_range[0])
+
+
+# noinspection PyUnusedLocal
+def get_spy_heatmap(adapter: MatrixSpyAdapter, buckets, shading, shading_absolute_min,
+                    shading_relative_min, shading_relative_max_percentile, precision, engine="auto",
+                    chunk_rows=None, max_chunk_bytes=None, workers=None, worker_type="thread", cache=False,
+                    row_range=None, col_range=None, heatmap_dtype="float32", shading_stats=None, cancel_event=None,
+                    **kwargs):
+    # find spy matrix shape, of the window if one is specified
+    row_range, col_range, mat_shape = _resolve_window(adapter, row_range, col_range)
+    if mat_shape[0] == 0 or mat_shape[1] == 0:
+        return np.array([[]], dtype=heatmap_dtype)
+
+    cache_params = (buckets, shading, shading_absolute_min, shading_relative_min, shading_relative_max_percentile,
+                    precision, engine, row_range, col_range, heatmap_dtype, shading_stats)
+    fingerprint = None
+    if cache:
+        # taken once, as it may read the whole matrix
+        fingerprint = adapter.get_fingerprint()
+        cached = heatmap_cache.get(adapter, cache_params, fingerprint) if fingerprint is not None else None
+        if cached is not None:
+            return cached
+
+    counts = _get_spy_counts(adapter, mat_shape, buckets, precision, engine, chunk_rows, max_chunk_bytes,
+                             workers, worker_type, row_range, col_range, cancel_event)
+    check_cancelled(cancel_event)
+    dense = _shade(counts, mat_shape, buckets, shading, shading_absolute_min, shading_relative_min,
+                   shading_relative_max_percentile, heatmap_dtype, shading_stats)
+
+    if fingerprint is not None:
+        heatmap_cache.put(adapter, cache_params, dense, fingerprint)
+
+    return dense
+
+
+def get_spy_heatmaps(adapters: List[MatrixSpyAdapter], kwargs_list: List[dict]) -> Tuple[List[np.array], ShadingStats]:
+    """
+    Same as `get_spy_heatmap` for each of `adapters` with the arguments in `kwargs_list`, but with relative shading
+    statistics shared by all of them. The statistics are those of all heatmaps together, unless the arguments
+    specify `shading_stats`. Each matrix is binned once.
+
+    :return: the heatmaps, and the statistics they are shaded with.
+    """
+    if not kwargs_list:
+        return [], ShadingStats(relative_max=1.0)
+
+    counts = [get_spy_counts(adapter, kwargs) for adapter, kwargs in zip(adapters, kwargs_list)]
+    stats = get_shared_shading_stats([c for c, _ in counts], kwargs_list)
+    heatmaps = [shade_spy_counts(c, mat_shape, kwargs, stats) for (c, mat_shape), kwargs in zip(counts, kwargs_list)]
+    return heatmaps, stats
+
+
+def get_spy_counts(adapter: MatrixSpyAdapter, kwargs: dict) -> Tuple[Optional[np.array], tuple]:
+    """
+    The bucket counts of a heatmap of `adapter` with the arguments in `kwargs`, for `shade_spy_counts`.
+
+    :return: the counts, or None if the matrix or window is empty, and the shape of the window.
+    """
+    row_range, col_range, mat_shape = _resolve_window(adapter, kwargs.get("row_range", None),
+                                                      kwargs.get("col_range", None))
+    if mat_shape[0] == 0 or mat_shape[1] == 0:
+        return None, mat_shape
+    return _get_spy_counts(adapter, mat_shape, kwargs["buckets"], kwargs["precision"],
+                           kwargs.get("engine", "auto"), kwargs.get("chunk_rows", None),
+                           kwargs.get("max_chunk_bytes", None), kwargs.get("workers", None),
+                           kwargs.get("worker_type", "thread"), row_range, col_range,
+                           kwargs.get("cancel_event", None)), mat_shape
+
+
+def get_shared_shading_stats(counts_list: List[Optional[np.array]], kwargs_list: List[dict]) -> ShadingStats:
+    """
+    The relative shading statistics shared by the counts from `get_spy_counts`, unless the arguments specify
+    `shading_stats`. `kwargs_list` must not be empty.
+    """
+    stats = kwargs_list[0].get("shading_stats", None)
+    if stats is None:
+        stats = get_shading_stats([c for c in counts_list if c is not None],
+                                  kwargs_list[0]["shading_relative_max_percentile"])
+    return stats
+
+
+def shade_spy_counts(counts: Optional[np.array], mat_shape, kwargs: dict, stats: ShadingStats) -> np.array:
+    """
+    Shade counts from `get_spy_counts` into a heatmap, with the arguments in `kwargs` and relative shading `stats`.
+    """
+    heatmap_dtype = kwargs.get("heatmap_dtype", "float32")
+    if counts is None:
+        return np.array([[]], dtype=heatmap_dtype)
+    return _shade(counts, mat_shape, kwargs["buckets"], kwargs["shading"], kwargs["shading_absolute_min"],
+                  kwargs["shading_relative_min"], kwargs["shading_relative_max_percentile"], heatmap_dtype, stats)
+
+
+def _tweak_divisor(num, divisor, lower=0.2, higher=0.5):
+    if num <= divisor:
+        return num
+
+    bucket_candidates = \
+        list(range(divisor + 1, divisor + min(int(divisor * higher), 200))) + \
+        list(range(divisor - 1, divisor - min(int(divisor * lower), 200), -1))
+
+    best_remainder, best_candidate = (num % divisor, divisor)
+
+    for candidate in bucket_candidates:
+        if candidate < 1:
+            continue
+
+        extra = num % candidate
+        if extra < best_remainder:
+            best_remainder = extra
+            best_candidate = candidate
+
+    return best_candidate
@@ -0,0 +1,73 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+Minimal PNG encoder for spy heatmaps. Does not use matplotlib.
+"""
+
+import struct
+import zlib
+from typing import Tuple
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+LEVELS = 256
+"""Number of shades between the empty and full colors. The palette of an 8-bit PNG holds at most 256 colors."""
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def palette_png(indices: np.array, palette: np.array, compresslevel=9) -> bytes:
+    """
+    Encode an 8-bit palette PNG.
+
+    :param indices: 2D array of palette indices, one per pixel.
+    :param palette: Array of shape `(n, 4)` of RGBA colors as integers 0-255, with `n <= 256`.
+    Alpha is only written if some color is not opaque.
+    :param compresslevel: zlib compression level.
+    :return: PNG file contents.
+    """
+    indices = np.asarray(indices, dtype="uint8")
+    palette = np.asarray(palette, dtype="uint8")
+    height, width = indices.shape
+
+    # each scanline starts with filter type 0 (None)
+    scanlines = np.zeros((height, width + 1), dtype="uint8")
+    scanlines[:, 1:] = indices
+
+    # width, height, bit depth 8, color type 3 (palette), default compression, filter and interlace methods
+    header = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+
+    ret = [PNG_SIGNATURE, _chunk(b"IHDR", header), _chunk(b"PLTE", palette[:, :3].tobytes())]
+    if (palette[:, 3] != 255).any():
+        ret.append(_chunk(b"tRNS", palette[:, 3].tobytes()))
+    ret.append(_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compresslevel)))
+    ret.append(_chunk(b"IEND", b""))
+    return b"".join(ret)
+
+
+def gradient_palette(color_empty: Tuple[float, float, float, float],
+                     color_full: Tuple[float, float, float, float]) -> np.array:
+    """
+    A palette of `LEVELS` RGBA colors, linearly interpolated from `color_empty` to `color_full`.
+    Colors are RGBA tuples of floats 0-1.
+    """
+    t = np.linspace(0, 1, LEVELS)[:, np.newaxis]
+    colors = (1 - t) * np.asarray(color_empty, dtype="float64") + t * np.asarray(color_full, dtype="float64")
+    return np.rint(colors * 255).astype("uint8")
+
+
+def heatmap_to_png(heatmap: np.array, color_empty: Tuple[float, float, float, float],
+                   color_full: Tuple[float, float, float, float]) -> bytes:
+    """
+    Encode a spy heatmap with values 0-1 as a PNG with one pixel per bucket.
+    Values are quantized to `LEVELS` shades between `color_empty` and `color_full`.
+    """
+    indices = np.clip(heatmap, 0, 1) * (LEVELS - 1)
+    np.rint(indices, out=indices)
+    return palette_png(indices.astype("uint8"), gradient_palette(color_empty, color_full))
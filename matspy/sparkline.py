@@ -0,0 +1,194 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""
+HTML sparklines. Images are encoded without matplotlib.
+"""
+
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from .adapters import MatrixSpyAdapter
+from .adapters.binning import check_cancelled, new_process_pool
+from .heatmap import get_spy_heatmap, get_spy_counts, get_shared_shading_stats, shade_spy_counts, \
+    _get_window, _tweak_divisor
+from .png import heatmap_to_png
+# noinspection PyProtectedMember
+from matspy import params, _get_spy_adapter
+
+
+def _to_rgba(color):
+    if isinstance(color, (tuple, list)) and len(color) in (3, 4) and all(isinstance(c, (int, float)) for c in color):
+        return tuple(float(c) for c in color) + ((1.0,) if len(color) == 3 else ())
+    # named or hex colors
+    from matplotlib.colors import to_rgba
+    return to_rgba(color)
+
+
+def _get_colors(options):
+    """
+    `color_empty` and `color_full` as RGBA tuples, which are hashable and picklable.
+    """
+    return _to_rgba(options.color_empty), _to_rgba(options.color_full)
+
+
+def _layout_sparkline(adapter: MatrixSpyAdapter, options, scale):
+    """
+    Size a sparkline of `adapter`. Updates `options` with the figure size, dpi and buckets to use.
+
+    :return: the scale, and the image shape in pixels as `(height, width)`.
+    """
+    row_range, col_range = _get_window(adapter.get_shape(), options.row_range, options.col_range)
+    shape = (row_range[1] - row_range[0], col_range[1] - col_range[0])
+
+    max_dim = max(shape)
+    if scale is None:
+        scale = options.sparkline_size / max_dim
+    options.figsize = scale * max_dim
+
+    # only matplotlib's configuration is needed, not pyplot
+    import matplotlib
+    sizing_dpi = matplotlib.rcParams["figure.dpi"]
+
+    img_shape = tuple(int((dim / max_dim) * options.figsize * sizing_dpi) for dim in shape)
+
+    if not options.dpi:
+        # no explicit dpi from the user, use matplotlib default
+        options.dpi = sizing_dpi
+
+    if options.buckets:
+        # user-specified bucket size
+        options.dpi = options.buckets / options.figsize
+    else:
+        # auto select bucket size
+        options.buckets = int(options.dpi * options.figsize)
+
+    # If the bucket size does not evenly divide the matrix dimensions then
+    # there may be visible artifacts like banding in the spy image. These artifacts can
+    # give the impression of structure that isn't there. Some tweaks to parameters may alleviate this.
+    if options.spy_aa_tweaks_enabled:
+        # tweak the bucket size to better fit the matrix
+        options.buckets = _tweak_divisor(max_dim, options.buckets, lower=0.5, higher=0.5)
+
+    return scale, img_shape
+
+
+def _encode_sparkline(heatmap, colors, img_shape, html_border):
+    """
+    Encode a sparkline heatmap as an HTML `<img>` tag.
+
+    The PNG has one pixel per bucket. The browser scales it up to `img_shape` without smoothing.
+    Only takes picklable arguments, so it can run in a worker process.
+    """
+    if heatmap.size == 0:
+        # zero-size
+        return "&#9643;"  # a single character that is an empty square
+
+    import base64
+    encoded = base64.b64encode(heatmap_to_png(heatmap, *colors)).decode()
+    style = "image-rendering: pixelated;"
+    if html_border:
+        style += f" border: {html_border};"
+    img_height, img_width = img_shape
+    return f'<img src="data:image/png;base64,{encoded}" style="{style}" width={img_width} height={img_height}/>'
+
+
+def _make_sparkline(adapter: MatrixSpyAdapter, options, scale, html_border, cancel_event=None):
+    """
+    :return: the sparkline and its scale.
+    """
+    scale, img_shape = _layout_sparkline(adapter, options, scale)
+    heatmap = get_spy_heatmap(adapter, cancel_event=cancel_event, **options.to_kwargs())
+    check_cancelled(cancel_event)
+    return _encode_sparkline(heatmap, _get_colors(options), img_shape, html_border), scale
+
+
+def to_sparkline(mat, retscale=False, scale=None, html_border="1px solid black", **kwargs):
+    options = params.get(**kwargs)
+    adapter = _get_spy_adapter(mat, options)
+
+    sparkline, scale = _make_sparkline(adapter, options, scale, html_border)
+
+    if retscale:
+        return sparkline, scale
+    else:
+        return sparkline
+
+
+def _sparkline_task(adapter, kwargs, colors, img_shape, html_border) -> str:
+    return _encode_sparkline(get_spy_heatmap(adapter, **kwargs), colors, img_shape, html_border)
+
+
+def _shaded_sparkline_task(counts, mat_shape, kwargs, stats, colors, img_shape, html_border) -> str:
+    return _encode_sparkline(shade_spy_counts(counts, mat_shape, kwargs, stats), colors, img_shape, html_border)
+
+
+def _map(executor, func, jobs, workers) -> list:
+    if executor is None:
+        return [func(*job) for job in jobs]
+    # sparklines are small, so send them to process workers in batches
+    return list(executor.map(func, *zip(*jobs), chunksize=max(1, len(jobs) // (4 * workers))))
+
+
+def to_sparklines(mats, scale=None, html_border="1px solid black", shared_shading=False, **kwargs) -> List[str]:
+    """
+    Create sparklines of many matrices, all to the same scale.
+
+    :param mats: matrices, in any form accepted by `to_sparkline`.
+    :param scale: Shared scale, as returned by `to_sparkline(retscale=True)`. If None then the largest matrix
+    is `sparkline_size` large.
+    :param html_border: Same as `to_sparkline`.
+    :param shared_shading: If True, relative shading is on the same scale for all sparklines, like `to_spy_heatmaps`.
+    :param kwargs: Same as `to_sparkline`. If `workers` is greater than 1 then the matrices are binned and encoded
+    in one pool of that many threads, or processes if `worker_type` is `'process'`, one matrix per task.
+    Process workers are sent the matrices. A single matrix is binned in parallel row blocks instead.
+    :return: a list of HTML strings, in the same order as `mats`.
+    """
+    options = params.get(**kwargs)
+    adapters = [_get_spy_adapter(mat, options) for mat in mats]
+    if not adapters:
+        return []
+
+    if scale is None:
+        max_dim = 0
+        for adapter in adapters:
+            row_range, col_range = _get_window(adapter.get_shape(), options.row_range, options.col_range)
+            max_dim = max(max_dim, row_range[1] - row_range[0], col_range[1] - col_range[0])
+        scale = options.sparkline_size / max_dim if max_dim else None
+
+    workers = options.workers or 1
+    parallel = workers > 1 and len(adapters) > 1
+
+    mat_kwargs, img_shapes = [], []
+    for adapter in adapters:
+        mat_options = dataclasses.replace(options)
+        _, img_shape = _layout_sparkline(adapter, mat_options, scale)
+        if parallel:
+            # each matrix is binned within its task
+            mat_options.workers = None
+        mat_kwargs.append(mat_options.to_kwargs())
+        img_shapes.append(img_shape)
+
+    colors = _get_colors(options)
+    executor = None
+    if parallel:
+        executor = new_process_pool(workers) if options.worker_type == "process" else \
+            ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        if not shared_shading:
+            return _map(executor, _sparkline_task, [(adapter, kwargs, colors, img_shape, html_border)
+                                                    for adapter, kwargs, img_shape
+                                                    in zip(adapters, mat_kwargs, img_shapes)], workers)
+
+        # shading is shared, so all counts are needed before any sparkline is shaded
+        counts = _map(executor, get_spy_counts, list(zip(adapters, mat_kwargs)), workers)
+        stats = get_shared_shading_stats([c for c, _ in counts], mat_kwargs)
+        return _map(executor, _shaded_sparkline_task, [(c, mat_shape, kwargs, stats, colors, img_shape, html_border)
+                                                       for (c, mat_shape), kwargs, img_shape
+                                                       in zip(counts, mat_kwargs, img_shapes)], workers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -2,131 +2,34 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import functools
+import sys
+import threading
+
 import numpy as np
 
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
 
 from .adapters import MatrixSpyAdapter
+from .adapters.binning import check_cancelled
+from .heatmap import get_spy_heatmap, _get_window, _tweak_divisor
+from .sparkline import _get_colors
+# to_sparkline used to be defined here
+from .sparkline import to_sparkline
 # noinspection PyProtectedMember
-from matspy import params, to_spy_heatmap, _get_spy_adapter
-
-
-def _get_relative_max(heatmap, k):
-    ret = None
-
-    if min(heatmap.shape) > 3:
-        # slice off the final row/column because those can be artificially high due to aliasing effects
-        corner = heatmap[0:(heatmap.shape[0]-1), 0:(heatmap.shape[1]-1)]
-        ret = _top_k(corner, k)
-
-    if not ret:
-        ret = _top_k(heatmap, k)
-
-    return ret if ret else 1
-
-
-def _top_k(arr, k):
-    arr = arr.flatten()
-
-    if arr.size == 0:
-        return None
-
-    if k == 1:
-        ret = np.max(arr, initial=0)
-        return ret if ret else None
-
-    k = min(k, arr.size - 1)
-    srt = np.sort(arr)
-
-    for top in srt[-k:]:
-        if top > 0:
-            return top
-
-    return None
-
-
-def _rescale(arr, from_range, to_range):
-    from_size = from_range[1] - from_range[0]
-    to_size = to_range[1] - to_range[0]
-
-    if from_size == 0:
-        return np.full_like(arr, to_range[1])
-
-    return (arr - from_range[0]) * (to_size / from_size) + to_range[0]
-
-
-# noinspection PyUnusedLocal
-def get_spy_heatmap(adapter: MatrixSpyAdapter, buckets, shading, shading_absolute_min,
-                    shading_relative_min, shading_relative_max_percentile, precision, **kwargs):
-    # find spy matrix shape
-    mat_shape = adapter.get_shape()
-    if mat_shape[0] == 0 or mat_shape[1] == 0:
-        return np.array([[]])
-
-    ratio = buckets / max(mat_shape)
-    spy_shape = tuple(max(1, int(ratio * x)) for x in mat_shape)
+from matspy import params, _get_spy_adapter
 
-    adapter.set_option("precision", precision)
-    dense = adapter.get_spy(spy_shape=spy_shape)
 
-    if not dense.flags.writeable:
-        dense = np.array(dense)
-
-    dense[dense < 0] = 0
-
-    # scale values
-    if shading == "absolute":
-        divisor = max(adapter.get_shape()) / buckets
-        divisor *= divisor  # area
-        dense /= divisor
-        dense[(0 < dense) & (dense < shading_absolute_min)] = shading_absolute_min
-        dense[dense > 1] = 1
-    elif shading == "relative":
-        mask = dense > 0
-
-        small = np.min(dense[mask], initial=0)
-
-        nnz = dense[mask].flatten().size
-        k = max(1, nnz - int(nnz * shading_relative_max_percentile))
-        big = _get_relative_max(dense, k)
-
-        scaled = _rescale(dense, (small, big), (shading_relative_min, 1))
-        dense[mask] = scaled[mask]
-        dense[dense > 1] = 1
-    elif shading == "binary":
-        dense[dense != 0] = 1
-    else:
-        raise ValueError("shading must be one of 'absolute', 'relative', 'binary'")
-
-    return dense
+@functools.lru_cache(maxsize=16)
+def _get_cached_cmap(color_empty, color_full):
+    return LinearSegmentedColormap.from_list("spy_cmap", [color_empty, color_full])
 
 
 def _get_spy_cmap(options):
-    return LinearSegmentedColormap.from_list("spy_cmap", [options.color_empty, options.color_full])
-
-
-def _tweak_divisor(num, divisor, lower=0.2, higher=0.5):
-    if num <= divisor:
-        return num
-
-    bucket_candidates = \
-        list(range(divisor + 1, divisor + min(int(divisor * higher), 200))) + \
-        list(range(divisor - 1, divisor - min(int(divisor * lower), 200), -1))
-
-    best_remainder, best_candidate = (num % divisor, divisor)
-
-    for candidate in bucket_candidates:
-        if candidate < 1:
-            continue
-
-        extra = num % candidate
-        if extra < best_remainder:
-            best_remainder = extra
-            best_candidate = candidate
-
-    return best_candidate
+    return _get_cached_cmap(*_get_colors(options))
 
 
 def _resize_figure_to_match_dpi(fig, target_dpi):
@@ -145,14 +48,59 @@ def _resize_figure_to_match_dpi(fig, target_dpi):
                         fig_height + (target_plot_height - plot_height))
 
 
+def _new_figure(managed=False):
+    """
+    Create a figure and axes for a spy plot.
+
+    Unmanaged figures have an off-screen Agg canvas and do not touch pyplot's global state, so they may be created
+    and drawn from any thread. Figures that are shown or interactive must be `managed` by pyplot.
+    """
+    if managed:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+
+def _use_pyplot(options) -> bool:
+    if options.interactive:
+        return True
+    if options.pyplot is not None:
+        return options.pyplot
+    # Scripts that use pyplot expect `plt.show()` to show the figure. Figures made off the main thread, such as by
+    # web services, stay off-screen because pyplot is not thread safe.
+    return "matplotlib.pyplot" in sys.modules and threading.current_thread() is threading.main_thread()
+
+
 def spy_to_mpl(mat, **kwargs):
     """
     Create a spy plot and return as matplotlib figure without showing.
+
+    If the caller uses pyplot, see the `pyplot` parameter, then the figure is managed by pyplot like any other
+    and `plt.show()` shows it. Otherwise the figure is off-screen, safe to create from worker threads, and
+    freed when no longer referenced. Use `fig.savefig()` to save it, or `spy()` to show a plot.
+    Interactive plots, see the `interactive` parameter, are always managed by pyplot.
     """
     options = params.get(**kwargs)
-    adapter = _get_spy_adapter(mat)
+    adapter = _get_spy_adapter(mat, options)
+
+    fig, ax = _new_figure(managed=_use_pyplot(options))
+    _draw_spy(fig, ax, adapter, options)
+    return fig, ax
+
+
+def _draw_spy(fig, ax, adapter: MatrixSpyAdapter, options, cancel_event=None, raster=True):
+    """
+    Draw a spy plot of `adapter` on `ax`, sizing `fig` to fit.
+
+    If `raster` then the heatmap is drawn as an image, else as vector rectangles.
+
+    Only uses the object-oriented matplotlib API, not pyplot's global state, so figures may be drawn concurrently.
+    """
+    row_range, col_range = _get_window(adapter.get_shape(), options.row_range, options.col_range)
 
-    fig, ax = plt.subplots()
     fig.set_size_inches(options.figsize, options.figsize)
     if options.indices:
         ax.xaxis.set_major_locator(MaxNLocator(integer=True, min_n_ticks=0, nbins='auto'))
@@ -161,17 +109,18 @@ def spy_to_mpl(mat, **kwargs):
     else:
         ax.set_xticks([])
         ax.set_yticks([])
-    ax.set_ylim(adapter.get_shape()[0], 0)
-    ax.set_xlim(0, adapter.get_shape()[1])
+    # label the axes with the matrix's indices, also when spying a window
+    ax.set_ylim(row_range[1], row_range[0])
+    ax.set_xlim(col_range[0], col_range[1])
 
     if options.title is True:
         options.title = adapter.describe()
     if options.title:
-        plt.title(options.title)
+        ax.set_title(options.title)
 
-    plt.tight_layout()
+    fig.tight_layout()
 
-    max_dim = max(adapter.get_shape())
+    max_dim = max(row_range[1] - row_range[0], col_range[1] - col_range[0])
     bbox = ax.get_window_extent().transformed(fig.dpi_scale_trans.inverted())
     fig_dim_max_pixels = max(bbox.width, bbox.height) * fig.dpi
 
@@ -195,73 +144,142 @@ def spy_to_mpl(mat, **kwargs):
 
     interpolation = "bilinear" if fig_dim_max_pixels / options.buckets < 1.2 else "nearest"
 
-    ax.imshow(to_spy_heatmap(adapter, **options.to_kwargs()),
-              cmap=_get_spy_cmap(options),
-              interpolation=interpolation, interpolation_stage="rgba", aspect="equal", origin="upper", vmin=0, vmax=1,
-              extent=[0, adapter.get_shape()[1], adapter.get_shape()[0], 0])
+    heatmap = get_spy_heatmap(adapter, cancel_event=cancel_event, **options.to_kwargs())
+    check_cancelled(cancel_event)
+    if not raster:
+        # one vector rectangle per nonempty bucket
+        row_edges = np.linspace(row_range[0], row_range[1], heatmap.shape[0] + 1)
+        col_edges = np.linspace(col_range[0], col_range[1], heatmap.shape[1] + 1)
+        ax.pcolormesh(col_edges, row_edges, np.ma.masked_equal(heatmap, 0), cmap=_get_spy_cmap(options),
+                      vmin=0, vmax=1)
+        ax.set_aspect("equal")
+        return
 
-    return fig, ax
+    image = ax.imshow(heatmap,
+                      cmap=_get_spy_cmap(options),
+                      interpolation=interpolation, interpolation_stage="rgba", aspect="equal", origin="upper",
+                      vmin=0, vmax=1,
+                      extent=[col_range[0], col_range[1], row_range[1], row_range[0]])
 
+    if options.interactive:
+        _InteractiveSpy(fig, ax, image, adapter, options)
 
-def spy(mat, **kwargs):
-    fig, ax = spy_to_mpl(mat, **kwargs)
-    plt.show()
-    plt.close(fig)
 
+class _InteractiveSpy:
+    """
+    Re-bins the visible part of a spy plot at screen resolution whenever the axes are zoomed or panned.
+
+    Limit changes are debounced so that panning stays responsive on large matrices.
+    """
+    debounce_ms = 150
+
+    def __init__(self, fig, ax, image, adapter: MatrixSpyAdapter, options):
+        self.fig = fig
+        self.ax = ax
+        self.image = image
+        self.adapter = adapter
+        self.options = options
+
+        self.timer = fig.canvas.new_timer(interval=self.debounce_ms)
+        self.timer.single_shot = True
+        self.timer.add_callback(self.update)
+
+        # The axes keep strong references to plain functions, which keeps this object alive with the figure.
+        ax.callbacks.connect("xlim_changed", lambda _: self.schedule())
+        ax.callbacks.connect("ylim_changed", lambda _: self.schedule())
+
+    def schedule(self):
+        self.timer.stop()
+        self.timer.start()
+
+    def get_window(self):
+        """
+        The visible submatrix as `(row_range, col_range)`, clamped to the matrix.
+        """
+        shape = self.adapter.get_shape()
+        x0, x1 = sorted(self.ax.get_xlim())
+        y0, y1 = sorted(self.ax.get_ylim())
+        row_range = (max(0, int(np.floor(y0))), min(shape[0], int(np.ceil(y1))))
+        col_range = (max(0, int(np.floor(x0))), min(shape[1], int(np.ceil(x1))))
+        return row_range, col_range
+
+    def update(self):
+        row_range, col_range = self.get_window()
+        if row_range[0] >= row_range[1] or col_range[0] >= col_range[1]:
+            return
+
+        # one bucket per screen pixel, but no more than one per matrix element
+        bbox = self.ax.get_window_extent()
+        buckets = max(1, min(int(max(bbox.width, bbox.height)),
+                             max(row_range[1] - row_range[0], col_range[1] - col_range[0])))
+
+        kwargs = self.options.to_kwargs()
+        kwargs.update(buckets=buckets, row_range=row_range, col_range=col_range)
+        try:
+            heatmap = get_spy_heatmap(self.adapter, **kwargs)
+        except NotImplementedError:
+            # this adapter cannot spy a submatrix, keep the existing image
+            return
+
+        self.image.set_data(heatmap)
+        self.image.set_extent([col_range[0], col_range[1], row_range[1], row_range[0]])
+        self.fig.canvas.draw_idle()
+
+
+def _spy_to_bytes(mat, fmt, cancel_event=None, raster=True, **kwargs) -> bytes:
+    from io import BytesIO
 
-def to_sparkline(mat, retscale=False, scale=None, html_border="1px solid black", **kwargs):
     options = params.get(**kwargs)
-    adapter = _get_spy_adapter(mat)
+    adapter = _get_spy_adapter(mat, options)
 
-    max_dim = max(adapter.get_shape())
-    if scale is None:
-        scale = options.sparkline_size / max_dim
-    options.figsize = scale * max_dim
-    sizing_dpi = plt.rcParams["figure.dpi"]
+    fig, ax = _new_figure()
+    _draw_spy(fig, ax, adapter, options, cancel_event=cancel_event, raster=raster)
+    check_cancelled(cancel_event)
 
-    img_height, img_width = tuple(int((dim / max_dim) * options.figsize * sizing_dpi) for dim in adapter.get_shape())
+    bio = BytesIO()
+    fig.savefig(bio, format=fmt, bbox_inches="tight")
+    return bio.getvalue()
 
-    if not options.dpi:
-        # no explicit dpi from the user, use matplotlib default
-        options.dpi = plt.rcParams["figure.dpi"]
 
-    if options.buckets:
-        # user-specified bucket size
-        options.dpi = options.buckets / options.figsize
-    else:
-        # auto select bucket size
-        options.buckets = int(options.dpi * options.figsize)
+def spy_to_png(mat, **kwargs) -> bytes:
+    """
+    Render a spy plot as PNG image bytes.
 
-    # If the bucket size does not evenly divide the matrix dimensions then
-    # there may be visible artifacts like banding in the spy image. These artifacts can
-    # give the impression of structure that isn't there. Some tweaks to parameters may alleviate this.
-    if options.spy_aa_tweaks_enabled:
-        # tweak the bucket size to better fit the matrix
-        options.buckets = _tweak_divisor(max_dim, options.buckets, lower=0.5, higher=0.5)
+    The plot is drawn off-screen without pyplot, so this is safe to call from multiple threads.
+    """
+    return _spy_to_bytes(mat, "png", **kwargs)
 
-    repeat = max(img_height, img_width) / options.buckets
-    repeat = int(repeat) if repeat >= 2 else 1
 
-    heatmap = to_spy_heatmap(adapter, **options.to_kwargs())
-    if heatmap.size == 0:
-        # zero-size
-        return "&#9643;"  # a single character that is an empty square
+def spy_to_svg(mat, raster=True, **kwargs) -> bytes:
+    """
+    Render a spy plot as SVG image bytes.
 
-    if repeat > 1:
-        heatmap = heatmap.repeat(repeat, axis=0)
-        heatmap = heatmap.repeat(repeat, axis=1)
-    spy_cmap = _get_spy_cmap(options)
-    image = spy_cmap(heatmap)
+    :param raster: If True, the heatmap is embedded as a raster image inside the vector axes, title and labels.
+    The SVG size then depends only on the figure size. If False, each nonempty bucket is a vector rectangle.
+    """
+    return _spy_to_bytes(mat, "svg", raster=raster, **kwargs)
 
-    from io import BytesIO
-    import base64
-    bio = BytesIO()
-    plt.imsave(bio, image, format="png", origin="upper", vmin=0, vmax=1, dpi=(options.dpi*repeat))
-    encoded = base64.b64encode(bio.getvalue()).decode()
-    style = f' style="border: {html_border};"' if html_border else ''
-    sparkline = f'<img src="data:image/png;base64,{encoded}"{style} width={img_width} height={img_height}/>'
 
-    if retscale:
-        return sparkline, scale
-    else:
-        return sparkline
+def spy(mat, **kwargs):
+    import matplotlib.pyplot as plt
+
+    options = params.get(**kwargs)
+    adapter = _get_spy_adapter(mat, options)
+
+    fig, ax = _new_figure(managed=True)
+    _draw_spy(fig, ax, adapter, options)
+    plt.show()
+    plt.close(fig)
+
+
+def spy_file(path, shape=None, **kwargs):
+    """
+    Same as `spy` but for a matrix stored in a file. The file is streamed, not loaded into memory.
+
+    Supports Matrix Market, SciPy `.npz` and `.npy` coordinate files. See `matspy.adapters.file_impl.open_spy_file`.
+    """
+    from .adapters.file_impl import open_spy_file
+    spy(open_spy_file(path, shape=shape), **kwargs)
+
+
+__all__ = ["spy_to_mpl", "spy_to_png", "spy_to_svg", "spy", "spy_file", "to_sparkline"]
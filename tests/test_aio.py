@@ -0,0 +1,130 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import numpy as np
+try:
+    import scipy
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from matspy import aspy_png, ato_sparkline, ato_spy_heatmap, to_sparkline, to_spy_heatmap
+from matspy.adapters import MatrixSpyAdapter
+from matspy.adapters.binning import SpyBinner
+
+np.random.seed(123)
+
+
+def _slow_task(binner, started, done):
+    started.set()
+    time.sleep(0.01)
+    done.append(1)
+    return binner.new_grid()
+
+
+class SlowSpy(MatrixSpyAdapter):
+    """
+    Bins in many slow chunks.
+    """
+    def __init__(self, num_chunks):
+        super().__init__()
+        self.num_chunks = num_chunks
+        self.started = threading.Event()
+        self.done = []
+
+    def describe(self) -> str:
+        return "slow"
+
+    def get_shape(self) -> tuple:
+        return 10, 10
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        binner = SpyBinner(self.get_shape(), spy_shape, self.options)
+        grid = binner.new_grid()
+        binner.run(grid, [(_slow_task, (binner, self.started, self.done))] * self.num_chunks)
+        return binner.finish(grid)
+
+
+class CancellingSpy(MatrixSpyAdapter):
+    """
+    Computes spy data in one step, like a triple product, and is cancelled while doing so.
+    """
+    def __init__(self, cancel_event):
+        super().__init__()
+        self.cancel_event = cancel_event
+
+    def describe(self) -> str:
+        return "cancelling"
+
+    def get_shape(self) -> tuple:
+        return 10, 10
+
+    def get_spy(self, spy_shape: tuple) -> np.array:
+        self.cancel_event.set()
+        return np.ones(spy_shape, dtype="uint16")
+
+
+@unittest.skipIf(scipy is None, "scipy not installed")
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.mat = scipy.sparse.random(301, 203, density=0.2, format="csr")
+
+    def test_heatmap(self):
+        np.testing.assert_array_equal(to_spy_heatmap(self.mat, buckets=30, shading="binary"),
+                                      asyncio.run(ato_spy_heatmap(self.mat, buckets=30, shading="binary")))
+
+    def test_sparkline(self):
+        self.assertEqual(to_sparkline(self.mat, retscale=True, buckets=20),
+                         asyncio.run(ato_sparkline(self.mat, retscale=True, buckets=20)))
+
+    def test_png(self):
+        async def render_many():
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                return await asyncio.gather(*[aspy_png(self.mat, executor=executor, title=f"mat {i}")
+                                              for i in range(8)])
+
+        for png in asyncio.run(render_many()):
+            self.assertTrue(png.startswith(b"\x89PNG"))
+
+    def test_cancel(self):
+        adapter = SlowSpy(num_chunks=1000)
+
+        async def cancel_spy():
+            executor = ThreadPoolExecutor(max_workers=1)
+            task = asyncio.ensure_future(ato_spy_heatmap(adapter, buckets=10, executor=executor))
+            await asyncio.get_running_loop().run_in_executor(None, adapter.started.wait)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            executor.shutdown(wait=True)
+
+        asyncio.run(cancel_spy())
+        self.assertLess(len(adapter.done), 100)
+
+    def test_cancel_event(self):
+        cancel_event = threading.Event()
+        cancel_event.set()
+        binner = SpyBinner((10, 10), (5, 5), dict(cancel_event=cancel_event))
+        with self.assertRaises(CancelledError):
+            binner.add_coo(binner.new_grid(), np.array([1]), np.array([1]))
+
+    def test_cancel_stages(self):
+        from matspy.aio import _sparkline, _spy_heatmap, _spy_png
+
+        # work after a stage that does not check for cancellation is skipped
+        for func, args in [(_spy_heatmap, (10, {})), (_sparkline, (False, None, None, {})), (_spy_png, ({},))]:
+            with self.subTest(func=func.__name__):
+                cancel_event = threading.Event()
+                with self.assertRaises(CancelledError):
+                    func(cancel_event, CancellingSpy(cancel_event), *args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,9 @@ class BasicTests(unittest.TestCase):
         with self.assertRaises(ValueError):
             matspy.to_spy_heatmap([], shading="foobar")
 
+        with self.assertRaises(ValueError):
+            matspy.to_spy_heatmap([], worker_type="foobar")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+
+import numpy as np
+try:
+    import dask
+    import dask.array as da
+except ImportError:
+    dask = None
+    da = None
+
+try:
+    import sparse
+except ImportError:
+    sparse = None
+
+from matspy import spy_to_mpl, to_sparkline, to_spy_heatmap
+import matspy
+
+np.random.seed(123)
+
+
+@unittest.skipIf(dask is None, "dask not installed")
+class DaskTests(unittest.TestCase):
+    def setUp(self):
+        self.arr = np.random.random((301, 203))
+        self.arr[self.arr < 0.8] = 0
+        self.scheduler = dask.config.set(scheduler="threads")
+        self.scheduler.__enter__()
+
+    def tearDown(self):
+        self.scheduler.__exit__(None, None, None)
+
+    def test_no_crash(self):
+        import matplotlib.pyplot as plt
+        mat = da.from_array(self.arr, chunks=50)
+        fig, ax = spy_to_mpl(mat)
+        plt.close(fig)
+
+        res = to_sparkline(mat)
+        self.assertGreater(len(res), 10)
+
+    def test_shape(self):
+        mat = da.zeros((10, 3), chunks=2)
+        adapter = matspy._get_spy_adapter(mat)
+        self.assertEqual((10, 3), adapter.get_shape())
+        self.assertIn("dask", adapter.describe())
+
+    def test_chunks(self):
+        for chunks in [(301, 203), (17, 40), (100, 7), 25]:
+            mat = da.from_array(self.arr, chunks=chunks)
+            for buckets in [1, 30, 250, 500]:
+                with self.subTest(chunks=chunks, buckets=buckets):
+                    np.testing.assert_array_equal(to_spy_heatmap(self.arr, buckets=buckets),
+                                                  to_spy_heatmap(mat, buckets=buckets))
+                    # compact counts, like the other adapters
+                    self.assertEqual(np.uint16, matspy._get_spy_adapter(mat).get_spy((10, 10)).dtype)
+
+        mat = da.from_array(self.arr, chunks=(17, 40))
+        np.testing.assert_array_equal(to_spy_heatmap(self.arr, buckets=30, precision=0.9),
+                                      to_spy_heatmap(mat, buckets=30, precision=0.9))
+
+    @unittest.skipIf(sparse is None, "pydata/sparse not installed")
+    def test_sparse_chunks(self):
+        mat = da.from_array(self.arr, chunks=(17, 40)).map_blocks(sparse.COO.from_numpy)
+        np.testing.assert_array_equal(to_spy_heatmap(self.arr, buckets=30), to_spy_heatmap(mat, buckets=30))
+
+    def test_window(self):
+        mat = da.from_array(self.arr, chunks=(17, 40))
+        np.testing.assert_array_equal(to_spy_heatmap(self.arr[10:200, 30:90], buckets=30),
+                                      to_spy_heatmap(mat, buckets=30, row_range=(10, 200), col_range=(30, 90)))
+
+
+if __name__ == '__main__':
+    unittest.main()
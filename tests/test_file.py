@@ -0,0 +1,108 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+try:
+    import scipy
+    import scipy.io
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from matspy import to_sparkline, to_spy_heatmap, to_spy_heatmap_file
+
+np.random.seed(123)
+
+EMAIL_EU_CORE = Path(__file__).parent.parent / "doc" / "matrices" / "email-Eu-core.mtx.gz"
+
+
+@unittest.skipIf(scipy is None, "scipy not installed")
+class FileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.mat = scipy.sparse.random(201, 157, density=0.2, format="coo")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_same_heatmap(self, mat, path, shape=None):
+        for buckets in [1, 30, 300]:
+            expected = to_spy_heatmap(mat, buckets=buckets, shading="absolute")
+            for options in [dict(), dict(max_chunk_bytes=100)]:
+                with self.subTest(path=str(path), buckets=buckets, **options):
+                    actual = to_spy_heatmap_file(path, buckets=buckets, shape=shape, shading="absolute", **options)
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_matrix_market(self):
+        self.assert_same_heatmap(scipy.io.mmread(EMAIL_EU_CORE), EMAIL_EU_CORE)
+
+        path = self.dir / "mat.mtx"
+        scipy.io.mmwrite(path, self.mat)
+        self.assert_same_heatmap(self.mat, path)
+
+    def test_matrix_market_symmetric(self):
+        mat = scipy.sparse.random(100, 100, density=0.1)
+        mat = (mat + mat.T).tocoo()
+        path = self.dir / "sym.mtx"
+        scipy.io.mmwrite(path, mat, symmetry="symmetric")
+        self.assert_same_heatmap(mat, path)
+
+    def test_npz(self):
+        for fmt in "csr", "csc", "coo", "bsr":
+            for compressed in True, False:
+                mat = self.mat.asformat(fmt)
+                path = self.dir / f"mat_{fmt}_{compressed}.npz"
+                scipy.sparse.save_npz(path, mat, compressed=compressed)
+                self.assert_same_heatmap(mat, path)
+
+    def test_window(self):
+        csr = self.mat.tocsr()
+        expected = to_spy_heatmap(csr[20:120, 30:60], buckets=30, shading="absolute")
+
+        paths = [self.dir / "mat.mtx", self.dir / "mat_csr.npz", self.dir / "mat_coo.npz"]
+        scipy.io.mmwrite(paths[0], self.mat)
+        scipy.sparse.save_npz(paths[1], csr)
+        scipy.sparse.save_npz(paths[2], self.mat)
+        for path in paths:
+            with self.subTest(path=str(path)):
+                actual = to_spy_heatmap_file(path, buckets=30, shading="absolute", row_range=(20, 120),
+                                             col_range=(30, 60), max_chunk_bytes=1000)
+                np.testing.assert_array_equal(expected, actual)
+
+    def test_npy(self):
+        coords = np.stack((self.mat.row, self.mat.col)).astype("int64")
+
+        path = self.dir / "coords_2xn.npy"
+        np.save(path, coords)
+        self.assert_same_heatmap(self.mat, path, shape=self.mat.shape)
+
+        path = self.dir / "coords_nx2.npy"
+        np.save(path, coords.T.copy())
+        self.assert_same_heatmap(self.mat, path, shape=self.mat.shape)
+
+        rows_path, cols_path = self.dir / "rows.npy", self.dir / "cols.npy"
+        np.save(rows_path, coords[0])
+        np.save(cols_path, coords[1])
+        self.assert_same_heatmap(self.mat, (rows_path, cols_path), shape=self.mat.shape)
+
+        # shape from largest coordinates
+        heatmap = to_spy_heatmap_file(path, buckets=10)
+        self.assertEqual(heatmap.shape[0], 10)
+
+    def test_path(self):
+        # pathlib.Path works with all methods
+        self.assertGreater(len(to_sparkline(EMAIL_EU_CORE)), 10)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            to_spy_heatmap_file(self.dir / "mat.txt")
+
+
+if __name__ == '__main__':
+    unittest.main()
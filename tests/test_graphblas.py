@@ -2,6 +2,7 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import itertools
 import unittest
 
 from matspy import spy_to_mpl, to_sparkline, to_spy_heatmap
@@ -51,6 +52,26 @@ class GraphBLASTests(unittest.TestCase):
             heatmap = to_spy_heatmap(r, buckets=1, shading="binary")
             self.assertAlmostEqual(heatmap[0][0], 1.0, places=2)
 
+    def test_scipy_equivalence(self):
+        import numpy as np
+        import scipy.sparse
+        from matspy.adapters.scipy_impl import SciPySpy
+
+        for dims in [(301, 203), (10, 10), (5, 1)]:
+            r = scipy.sparse.random(*dims, density=0.3, format="csr")
+            # values are never read, so iso-valued, boolean and explicit zero elements all count
+            mats = [gb.io.from_scipy_sparse(r), gb.Matrix.from_coo(*r.nonzero(), False, nrows=dims[0], ncols=dims[1]),
+                    gb.Matrix.from_coo(*r.nonzero(), 0.0, nrows=dims[0], ncols=dims[1])]
+            for spy_shape in [(1, 1), (7, 5), (dims[0] * 2, dims[1] + 3)]:
+                expected = SciPySpy(r).get_spy(spy_shape)
+                for mat, engine in itertools.product(mats, ["graphblas_native", "direct_bincount"]):
+                    with self.subTest(dims=dims, spy_shape=spy_shape, dtype=str(mat.dtype), engine=engine):
+                        adapter = matspy._get_spy_adapter(mat)
+                        adapter.set_option("engine", engine)
+                        actual = adapter.get_spy(spy_shape)
+                        np.testing.assert_array_equal(expected, actual)
+                        self.assertEqual(actual.dtype.kind, "u")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -29,6 +29,387 @@ class SpyHeatmapTests(unittest.TestCase):
             heatmap = to_spy_heatmap(r, buckets=1, shading="binary")
             self.assertAlmostEqual(heatmap[0][0], 1.0, places=2)
 
+    def test_chunked(self):
+        mats = [
+            scipy.sparse.random(101, 97, density=0.3, format="csr"),
+            scipy.sparse.random(101, 97, density=0.3, format="csc"),
+            scipy.sparse.random(101, 97, density=0.3, format="coo"),
+            scipy.sparse.random(13, 500, density=0.3, format="csr"),
+            numpy.random.random((50, 61)),
+        ]
+        chunk_options = [
+            dict(chunk_rows=1),
+            dict(chunk_rows=7),
+            dict(max_chunk_bytes=1),
+            dict(max_chunk_bytes=1000),
+            dict(chunk_rows=10, max_chunk_bytes=2000),
+        ]
+
+        for mat in mats:
+            for buckets in [1, 10, 30, 200]:
+                expected = to_spy_heatmap(mat, buckets=buckets, shading="absolute")
+                for options in chunk_options:
+                    with self.subTest(type=type(mat).__name__, shape=mat.shape, buckets=buckets, **options):
+                        actual = to_spy_heatmap(mat, buckets=buckets, shading="absolute", **options)
+                        numpy.testing.assert_array_equal(expected, actual)
+
+    def test_parallel(self):
+        mats = [
+            scipy.sparse.random(101, 97, density=0.3, format="csr"),
+            scipy.sparse.random(101, 97, density=0.3, format="csc"),
+            scipy.sparse.random(101, 97, density=0.3, format="coo"),
+            numpy.random.random((50, 61)),
+        ]
+
+        for mat in mats:
+            for buckets in [1, 30, 200]:
+                expected = to_spy_heatmap(mat, buckets=buckets, shading="absolute")
+                for worker_type in ["thread", "process"]:
+                    for options in [dict(workers=3), dict(workers=4, chunk_rows=5)]:
+                        with self.subTest(type=type(mat).__name__, buckets=buckets, worker_type=worker_type, **options):
+                            actual = to_spy_heatmap(mat, buckets=buckets, shading="absolute",
+                                                    worker_type=worker_type, **options)
+                            numpy.testing.assert_array_equal(expected, actual)
+
+    def test_process_pool_reuse(self):
+        from unittest import mock
+        from matspy.adapters import binning
+
+        mat = scipy.sparse.random(300, 200, density=0.1, format="csr")
+        expected = to_spy_heatmap(mat, buckets=20, shading="absolute")
+        with mock.patch.object(binning.SpyBinner, "__getstate__", autospec=True,
+                               side_effect=binning.SpyBinner.__getstate__) as getstate:
+            first = to_spy_heatmap(mat, buckets=20, shading="absolute", workers=2, worker_type="process", chunk_rows=10)
+            pool = binning.get_process_pool(2)
+            second = to_spy_heatmap(mat, buckets=20, shading="absolute", workers=2, worker_type="process")
+        numpy.testing.assert_array_equal(expected, first)
+        numpy.testing.assert_array_equal(expected, second)
+
+        # the pool persists, and each run sends its binner once per worker rather than once per task
+        self.assertIs(pool, binning.get_process_pool(2))
+        self.assertEqual(4, getstate.call_count)
+
+    def test_process_pool_install_failure(self):
+        import threading
+        from unittest import mock
+        from matspy.adapters import binning
+
+        mat = scipy.sparse.random(300, 200, density=0.1, format="csr")
+        expected = to_spy_heatmap(mat, buckets=20, shading="absolute")
+
+        # workers that do not wait for each other break the pool's barrier
+        with mock.patch.object(binning, "PROCESS_INSTALL_TIMEOUT", 0):
+            with self.assertRaises(threading.BrokenBarrierError):
+                to_spy_heatmap(mat, buckets=20, shading="absolute", workers=3, worker_type="process")
+
+        # the broken pool is replaced
+        for _ in range(2):
+            actual = to_spy_heatmap(mat, buckets=20, shading="absolute", workers=3, worker_type="process")
+            numpy.testing.assert_array_equal(expected, actual)
+
+    def test_cache(self):
+        import gc
+        import matspy
+        from matspy.cache import heatmap_cache
+
+        matspy.cache_clear()
+        mat = scipy.sparse.random(200, 100, density=0.2, format="coo")
+
+        expected = to_spy_heatmap(mat, buckets=20)
+        first = to_spy_heatmap(mat, buckets=20, cache=True)
+        self.assertEqual(len(heatmap_cache), 1)
+        numpy.testing.assert_array_equal(expected, first)
+
+        # hit returns a copy
+        first[0, 0] = -1
+        numpy.testing.assert_array_equal(expected, to_spy_heatmap(mat, buckets=20, cache=True))
+        self.assertEqual(len(heatmap_cache), 1)
+
+        # different parameters are a miss
+        to_spy_heatmap(mat, buckets=10, cache=True)
+        self.assertEqual(len(heatmap_cache), 2)
+
+        # modified matrix is a miss
+        mat.row = numpy.zeros_like(mat.row)
+        numpy.testing.assert_array_equal(to_spy_heatmap(mat, buckets=20),
+                                         to_spy_heatmap(mat, buckets=20, cache=True))
+        self.assertEqual(len(heatmap_cache), 3)
+
+        # garbage collected matrices are dropped
+        del mat
+        gc.collect()
+        self.assertEqual(len(heatmap_cache), 0)
+
+        arr = numpy.random.random((10, 10)) > 0.5
+        to_spy_heatmap(arr, buckets=5, cache=True)
+        self.assertEqual(len(heatmap_cache), 1)
+
+        # sampled element modified in place is a miss
+        arr[-1, -1] = not arr[-1, -1]
+        numpy.testing.assert_array_equal(to_spy_heatmap(arr, buckets=5),
+                                         to_spy_heatmap(arr, buckets=5, cache=True))
+        self.assertEqual(len(heatmap_cache), 2)
+
+        # a transposed view shares the buffer but not the strides
+        transposed = arr.T
+        numpy.testing.assert_array_equal(to_spy_heatmap(transposed, buckets=5),
+                                         to_spy_heatmap(transposed, buckets=5, cache=True))
+        self.assertEqual(len(heatmap_cache), 3)
+        matspy.cache_clear()
+        self.assertEqual(len(heatmap_cache), 0)
+
+        # an element that is not sampled, modified in place, is a miss
+        dense = numpy.zeros((100, 100))
+        self.assertTrue(to_spy_heatmap(dense, buckets=10, cache=True).max() == 0)
+        dense[37, 41] = 1
+        self.assertTrue(to_spy_heatmap(dense, buckets=10, cache=True).max() > 0)
+
+        # including through a read-only view
+        view = dense.view()
+        view.flags.writeable = False
+        to_spy_heatmap(view, buckets=10, cache=True)
+        dense[37, 41] = 0
+        self.assertTrue(to_spy_heatmap(view, buckets=10, cache=True).max() == 0)
+        matspy.cache_clear()
+
+    def test_array_checksum(self):
+        from matspy.adapters import array_checksum, is_mutable
+
+        arr = numpy.arange(1000, dtype="float64").reshape(50, 20).copy()
+        expected = array_checksum(arr)
+        # chunked and non-contiguous arrays are the same as contiguous
+        self.assertEqual(expected, array_checksum(arr, max_chunk_bytes=100))
+        self.assertEqual(array_checksum(numpy.ascontiguousarray(arr[:, ::2])), array_checksum(arr[:, ::2], 100))
+        arr[49, 19] = -1
+        self.assertNotEqual(expected, array_checksum(arr))
+
+        self.assertTrue(is_mutable(arr))
+        self.assertTrue(is_mutable(arr[::2]))
+        arr.flags.writeable = False
+        self.assertFalse(is_mutable(arr))
+        self.assertFalse(is_mutable(arr[::2]))
+
+    def test_cache_refs(self):
+        import threading
+        import matspy
+        from matspy.cache import HeatmapCache
+
+        heatmap = numpy.zeros((2, 2))
+        mats = [scipy.sparse.random(20, 10, density=0.2, format="csr") for _ in range(3)]
+        cache = HeatmapCache(max_entries=2)
+        for i in range(len(mats)):
+            cache.put(matspy._get_spy_adapter(mats[i]), "params", heatmap)
+        self.assertEqual(2, len(cache))
+        # evicting a matrix's last entry drops its weakref
+        self.assertEqual(2, len(cache._refs))
+
+        # A matrix may be collected while the lock is held, such as by cyclic GC triggered by an allocation
+        # inside the cache. Its entries are dropped later, without deadlocking.
+        def collect_while_locked():
+            with cache._lock:
+                mats.pop()
+        thread = threading.Thread(target=collect_while_locked, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(cache))
+        self.assertEqual(1, len(cache._refs))
+
+    def test_projection_cache(self):
+        import matspy
+        from matspy.adapters import generate_spy_bucket_map, generate_spy_triple_product
+        from matspy.cache import ProjectionCache, projection_cache
+
+        matspy.cache_clear()
+        bucket_map, expand = generate_spy_bucket_map(1000, 30)
+        self.assertIs(bucket_map, generate_spy_bucket_map(1000, 30)[0])
+        self.assertIsNot(bucket_map, generate_spy_bucket_map(1000, 30, uneven_to_end=False)[0])
+        self.assertFalse(bucket_map.flags.writeable)
+
+        (_, (left_rows, _)), _ = generate_spy_triple_product((1000, 500), (30, 15))
+        self.assertFalse(left_rows.flags.writeable)
+        self.assertEqual(len(projection_cache), 3)
+
+        # same-shaped matrices reuse bucket maps
+        mats = [scipy.sparse.random(1000, 500, density=0.01, format="csr") for _ in range(3)]
+        for mat in mats:
+            expected = (mat.toarray() != 0).reshape(100, 10, 50, 10).sum(axis=(1, 3)) / 100
+            numpy.testing.assert_array_equal(expected, to_spy_heatmap(mat, buckets=100, shading="absolute",
+                                                                      shading_absolute_min=0, heatmap_dtype="float64"))
+        self.assertEqual(len(projection_cache), 5)
+
+        matspy.cache_clear()
+        self.assertEqual(len(projection_cache), 0)
+
+        # bounded
+        cache = ProjectionCache(max_entries=2, max_bytes=100)
+        for i in range(3):
+            self.assertEqual(i, cache.get(i, lambda: (i, 10)))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual("big", cache.get("big", lambda: ("big", 1000)))
+        self.assertEqual(len(cache), 2)
+
+    def test_pyramid(self):
+        from matspy import to_sparkline, to_spy_pyramid
+
+        mat = scipy.sparse.random(1024, 512, density=0.05, format="csr")
+        pyramid = to_spy_pyramid(mat, buckets=256)
+
+        # levels that align with the matrix are exact
+        for buckets in [256, 128, 64, 1]:
+            for shading in ["absolute", "relative", "binary"]:
+                with self.subTest(buckets=buckets, shading=shading):
+                    numpy.testing.assert_array_equal(to_spy_heatmap(mat, buckets=buckets, shading=shading),
+                                                     to_spy_heatmap(pyramid, buckets=buckets, shading=shading))
+
+        # other sizes are resampled from a level
+        for buckets in [200, 100, 3]:
+            with self.subTest(buckets=buckets):
+                expected = to_spy_heatmap(mat, buckets=buckets)
+                actual = to_spy_heatmap(pyramid, buckets=buckets)
+                self.assertEqual(expected.shape, actual.shape)
+
+                spy_shape = expected.shape
+                self.assertAlmostEqual(mat.nnz, pyramid.get_spy(spy_shape).sum(), places=6)
+
+        # larger than the pyramid falls back to the matrix
+        numpy.testing.assert_array_equal(to_spy_heatmap(mat, buckets=500), to_spy_heatmap(pyramid, buckets=500))
+
+        self.assertGreater(len(to_sparkline(pyramid)), 10)
+
+        # more buckets than the matrix has rows and columns
+        small = scipy.sparse.random(50, 50, density=0.3, format="csr")
+        pyramid = to_spy_pyramid(small, buckets=200)
+        for buckets in [200, 50, 25]:
+            with self.subTest(buckets=buckets):
+                numpy.testing.assert_array_equal(to_spy_heatmap(small, buckets=buckets, shading="absolute"),
+                                                 to_spy_heatmap(pyramid, buckets=buckets, shading="absolute"))
+        for level in pyramid.levels:
+            self.assertEqual(small.nnz, level.sum())
+        self.assertEqual(small.nnz, pyramid.get_spy((10, 10)).sum())
+
+    def test_pyramid_resampled(self):
+        from matspy import to_spy_pyramid
+
+        mat = scipy.sparse.random(1000, 750, density=0.3, format="csr")
+        pyramid = to_spy_pyramid(mat, buckets=512)
+
+        # sizes between levels match direct binning, without stripes from uneven bucket coverage
+        for buckets in [300, 200, 100]:
+            with self.subTest(buckets=buckets):
+                expected = to_spy_heatmap(mat, buckets=buckets, shading="absolute")
+                actual = to_spy_heatmap(pyramid, buckets=buckets, shading="absolute")
+                self.assertEqual(expected.shape, actual.shape)
+                self.assertLess(numpy.abs(expected - actual).mean(), 0.06)
+                numpy.testing.assert_allclose(expected.sum(axis=0), actual.sum(axis=0), rtol=0.1)
+                numpy.testing.assert_allclose(expected.sum(axis=1), actual.sum(axis=1), rtol=0.1)
+
+    def test_dtypes(self):
+        import matspy
+        from matspy import to_spy_pyramid
+        from matspy.adapters import count_dtype
+
+        self.assertEqual(count_dtype(2**16 - 1), numpy.uint16)
+        self.assertEqual(count_dtype(2**16), numpy.uint32)
+        self.assertEqual(count_dtype(2**40), numpy.uint64)
+        self.assertEqual(count_dtype(None), numpy.uint64)
+
+        mat = scipy.sparse.random(200, 100, density=0.2, format="csr")
+        self.assertEqual(matspy._get_spy_adapter(mat).get_spy((20, 10)).dtype, numpy.uint16)
+        for shading in ["absolute", "relative", "binary"]:
+            with self.subTest(shading=shading):
+                heatmap = to_spy_heatmap(mat, buckets=20, shading=shading)
+                self.assertEqual(heatmap.dtype, numpy.float32)
+                heatmap64 = to_spy_heatmap(mat, buckets=20, shading=shading, heatmap_dtype="float64")
+                self.assertEqual(heatmap64.dtype, numpy.float64)
+                numpy.testing.assert_allclose(heatmap64, heatmap, rtol=1e-6)
+
+        with self.assertRaises(ValueError):
+            to_spy_heatmap(mat, heatmap_dtype="int32")
+
+        # duplicates make bucket counts exceed the uint16 range
+        n = 2**16 + 5
+        dups = scipy.sparse.coo_matrix((numpy.ones(n), (numpy.zeros(n), numpy.zeros(n))), shape=(10, 10))
+        for m in [dups, to_spy_pyramid(dups, buckets=10)]:
+            with self.subTest(type(m).__name__):
+                counts = matspy._get_spy_adapter(m).get_spy((1, 1))
+                self.assertEqual(counts.dtype, numpy.uint32)
+                self.assertEqual(counts[0, 0], n)
+
+    def test_shading_stats(self):
+        from matspy import to_spy_heatmaps
+        from matspy.heatmap import ShadingStats, get_shading_stats
+
+        def expected_max(heatmaps, percentile):
+            # the k-th largest nonzero bucket, not counting the final row and column of each heatmap
+            nnz = sum(numpy.count_nonzero(h) for h in heatmaps)
+            k = max(1, nnz - int(nnz * percentile))
+            corners = numpy.sort(numpy.concatenate([h[:-1, :-1].ravel() for h in heatmaps]))[::-1]
+            return corners[min(k, numpy.count_nonzero(corners)) - 1]
+
+        counts = numpy.random.poisson(2, (50, 40)).astype("uint16")
+        for percentile in [0, 0.5, 0.99, 1]:
+            with self.subTest(percentile=percentile):
+                self.assertEqual(expected_max([counts], percentile),
+                                 get_shading_stats([counts], percentile).relative_max)
+
+        # too small for a corner, or empty
+        self.assertEqual(3, get_shading_stats([numpy.array([[0, 3], [1, 2]])], 1).relative_max)
+        self.assertEqual(1, get_shading_stats([numpy.zeros((10, 10))], 0.99).relative_max)
+        self.assertEqual(1, get_shading_stats([], 0.99).relative_max)
+
+        # the percentile of a batch is of the buckets of all heatmaps
+        batch = [counts, numpy.random.poisson(5, (20, 30)).astype("uint32")]
+        for percentile in [0.5, 0.99]:
+            with self.subTest(percentile=percentile):
+                self.assertEqual(expected_max(batch, percentile), get_shading_stats(batch, percentile).relative_max)
+
+        mats = [scipy.sparse.random(200, 100, density=d, format="csr") for d in (0.01, 0.1, 0.5)]
+        heatmaps, stats = to_spy_heatmaps(mats, buckets=20, retstats=True)
+        self.assertIsInstance(stats, ShadingStats)
+        for mat, heatmap in zip(mats, heatmaps):
+            numpy.testing.assert_array_equal(to_spy_heatmap(mat, buckets=20, shading_stats=stats), heatmap)
+            numpy.testing.assert_array_equal(to_spy_heatmaps([mat], buckets=20)[0], to_spy_heatmap(mat, buckets=20))
+
+        # the sparsest matrix is lighter than on its own scale
+        self.assertLess(heatmaps[0].max(), to_spy_heatmap(mats[0], buckets=20).max())
+        self.assertEqual([], to_spy_heatmaps([]))
+
+    def test_window(self):
+        from matspy import to_spy_pyramid
+
+        mat = scipy.sparse.random(301, 203, density=0.2, format="coo")
+        mats = {
+            "numpy": mat.toarray(),
+            "pyramid": to_spy_pyramid(mat, buckets=64),
+        }
+        try:
+            import sparse
+            mats["sparse COO"] = sparse.COO.from_scipy_sparse(mat)
+            mats["sparse CSR"] = sparse.GCXS.from_scipy_sparse(mat.tocsr())
+            mats["sparse CSC"] = sparse.GCXS.from_scipy_sparse(mat.tocsc())
+        except ImportError:
+            pass
+        try:
+            import graphblas as gb
+            mats["graphblas"] = gb.io.from_scipy_sparse(mat)
+        except ImportError:
+            pass
+
+        for row_range, col_range in [((10, 100), (50, 203)), ((0, 5), (7, 8)), ((290, None), (None, 12))]:
+            submatrix = mat.tocsr()[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+            expected = to_spy_heatmap(submatrix, buckets=40, shading="absolute")
+            for name, m in mats.items():
+                with self.subTest(name, row_range=row_range, col_range=col_range):
+                    actual = to_spy_heatmap(m, buckets=40, shading="absolute", row_range=row_range,
+                                            col_range=col_range)
+                    numpy.testing.assert_array_equal(expected, actual)
+
+        for row_range in [(-1, 10), (10, 5), (0, 302)]:
+            with self.subTest(row_range=row_range):
+                with self.assertRaises(ValueError):
+                    to_spy_heatmap(mat, row_range=row_range)
+
     def test_aa_tweaks(self):
         from matspy.spy_renderer import _tweak_divisor
 
@@ -0,0 +1,57 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import subprocess
+import sys
+import textwrap
+import unittest
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+
+def run_python(code) -> str:
+    """
+    Run `code` in a fresh interpreter, so that modules imported by other tests do not interfere.
+    """
+    return subprocess.run([sys.executable, "-c", textwrap.dedent(code)], check=True, capture_output=True,
+                          text=True).stdout
+
+
+class ImportTests(unittest.TestCase):
+    def test_heatmap_without_matplotlib(self):
+        out = run_python("""
+            import sys
+            import numpy as np
+            import matspy
+            assert "matplotlib" not in sys.modules, "import matspy"
+
+            matspy.to_spy_heatmap(np.eye(10), buckets=5)
+            assert "matplotlib" not in sys.modules, "to_spy_heatmap"
+
+            matspy.to_sparkline(np.eye(10))
+            assert "matplotlib.pyplot" not in sys.modules, "to_sparkline"
+            print("ok")
+        """)
+        self.assertEqual("ok", out.strip())
+
+    @unittest.skipIf(matplotlib is None, "matplotlib not installed")
+    def test_lazy_plotting(self):
+        out = run_python("""
+            import sys
+            import matplotlib
+            matplotlib.use("Agg")
+            import numpy as np
+            from matspy import spy_to_mpl
+            fig, ax = spy_to_mpl(np.eye(10))
+            assert "matplotlib.pyplot" not in sys.modules
+            print(type(fig).__name__)
+        """)
+        self.assertEqual("Figure", out.strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
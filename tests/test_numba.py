@@ -0,0 +1,80 @@
+# Copyright (C) 2023 Adam Lugowski.
+# Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import scipy
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+from matspy import to_spy_heatmap
+from matspy.adapters import binning
+
+np.random.seed(123)
+
+
+def _with_kernels(func, enabled):
+    saved = binning.NUMBA_MIN_ELEMENTS
+    binning.NUMBA_MIN_ELEMENTS = 0 if enabled else None
+    try:
+        return func()
+    finally:
+        binning.NUMBA_MIN_ELEMENTS = saved
+
+
+@unittest.skipIf(numba is None, "numba not installed")
+class NumbaTests(unittest.TestCase):
+    def assert_same_as_numpy(self, func):
+        np.testing.assert_array_equal(_with_kernels(func, False), _with_kernels(func, True))
+
+    def test_threshold(self):
+        self.assertIsNone(_with_kernels(lambda: binning.get_kernels(10**9), False))
+        self.assertIsNotNone(_with_kernels(lambda: binning.get_kernels(0), True))
+
+    def test_dense(self):
+        arr = np.random.random((301, 203))
+        arr[arr < 0.7] = 0
+        arr[3, 4] = np.nan
+        arr[5, 5] = -0.9
+
+        for dtype in ["float64", "float32", "int32", "bool"]:
+            for options in [dict(), dict(precision=0.75), dict(precision=-0.5),
+                            dict(row_range=(10, 250), col_range=(5, 160)),
+                            dict(workers=2), dict(buckets=1000)]:
+                with self.subTest(dtype=dtype, **options):
+                    typed = np.nan_to_num(arr * 10).astype(dtype) if dtype != "float32" else arr.astype(dtype)
+                    self.assert_same_as_numpy(lambda: to_spy_heatmap(typed, shading="absolute",
+                                                                     **{"buckets": 40, **options}))
+
+    def test_unsupported_dtypes(self):
+        # Numba does not support float16 or non-native byte order, so these use the NumPy path
+        arr = (np.random.random((1100, 1000)) > 0.5)
+        expected = to_spy_heatmap(arr, buckets=10)
+        for dtype in [np.float16, np.dtype(">f8")]:
+            with self.subTest(dtype=str(dtype)):
+                np.testing.assert_array_equal(expected, to_spy_heatmap(arr.astype(dtype), buckets=10))
+
+    @unittest.skipIf(scipy is None, "scipy not installed")
+    def test_sparse(self):
+        mat = scipy.sparse.random(301, 203, density=0.2, format="coo")
+        for fmt in "coo", "csr", "csc", "lil", "bsr":
+            for options in [dict(), dict(row_range=(10, 250), col_range=(5, 160)), dict(workers=3),
+                            dict(max_chunk_bytes=1000), dict(buckets=1000)]:
+                with self.subTest(fmt=fmt, **options):
+                    converted = mat.asformat(fmt)
+                    self.assert_same_as_numpy(lambda: to_spy_heatmap(converted, shading="absolute",
+                                                                     engine="direct_bincount",
+                                                                     **{"buckets": 40, **options}))
+
+
+if __name__ == '__main__':
+    unittest.main()
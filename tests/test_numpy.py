@@ -5,17 +5,12 @@
 import unittest
 
 import numpy as np
-try:
-    import scipy
-except ImportError:
-    scipy = None
 
 from matspy import spy_to_mpl, to_sparkline, to_spy_heatmap
 
 np.random.seed(123)
 
 
-@unittest.skipIf(scipy is None, "scipy not installed")  # scipy is used internally by numpy_impl
 class NumPyTests(unittest.TestCase):
     def setUp(self):
         self.mats = [
@@ -67,6 +62,30 @@ class NumPyTests(unittest.TestCase):
             self.assertEqual(len(heatmap), 1)
             self.assertAlmostEqual( count / area, heatmap[0][0], places=2)
 
+    def test_triple_product_equivalence(self):
+        from matspy.adapters import generate_spy_triple_product
+        from matspy.adapters.numpy_impl import NumPySpy
+
+        def dense_triple_product(mask, spy_shape):
+            (left_shape, left), (right_shape, right) = generate_spy_triple_product(mask.shape, spy_shape)
+            left_mat, right_mat = np.zeros(left_shape), np.zeros(right_shape)
+            np.add.at(left_mat, left, 1)
+            np.add.at(right_mat, right, 1)
+            return left_mat @ mask @ right_mat
+
+        for shape in [(1, 1), (10, 10), (101, 37), (37, 101), (500, 3)]:
+            arr = np.random.random(shape)
+            arr[arr < 0.7] = 0
+            for spy_shape in [(1, 1), (7, 5), (30, 30), (shape[0] + 3, shape[1] * 2)]:
+                for options in [dict(), dict(max_chunk_bytes=500), dict(max_chunk_bytes=1, workers=3),
+                                dict(engine="direct_bincount"), dict(engine="direct_bincount", max_chunk_bytes=500)]:
+                    with self.subTest(shape=shape, spy_shape=spy_shape, **options):
+                        adapter = NumPySpy(arr)
+                        for key, value in options.items():
+                            adapter.set_option(key, value)
+                        np.testing.assert_array_equal(dense_triple_product(arr != 0, spy_shape),
+                                                      adapter.get_spy(spy_shape))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,11 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import itertools
 import unittest
+import warnings
 
-import numpy.random
+import numpy as np
 try:
     import scipy
     import scipy.sparse
@@ -13,7 +15,7 @@ except ImportError:
 
 from matspy import spy_to_mpl, to_sparkline
 
-numpy.random.seed(123)
+np.random.seed(123)
 
 
 @unittest.skipIf(scipy is None, "scipy not installed")
@@ -37,6 +39,262 @@ class SciPyTests(unittest.TestCase):
             res = to_sparkline(mat)
             self.assertGreater(len(res), 10)
 
+    def test_triple_product_equivalence(self):
+        from matspy.adapters.scipy_impl import SciPySpy, generate_spy_triple_product_coo
+
+        for dims in [(100, 100), (101, 97), (10, 3), (1, 50), (7, 7)]:
+            mat = scipy.sparse.random(*dims, density=0.3, format="coo")
+            # include a duplicate and an explicit zero, both of which count as stored elements
+            mat = scipy.sparse.coo_matrix((np.append(mat.data, [0, 0]),
+                                           (np.append(mat.row, [0, 0]), np.append(mat.col, [0, 0]))), shape=dims)
+
+            for spy_shape in [(1, 1), (3, 2), (10, 10), (33, 32), (20, 20), (150, 140)]:
+                spy_shape = tuple(min(s, 2 * d) for s, d in zip(spy_shape, dims))
+                left, right = generate_spy_triple_product_coo(mat.shape, spy_shape)
+
+                for fmt in "coo", "csr", "csc", "lil", "dok", "bsr", "dia":
+                    with self.subTest(dims=dims, spy_shape=spy_shape, fmt=fmt):
+                        with warnings.catch_warnings():
+                            warnings.simplefilter("ignore", scipy.sparse.SparseEfficiencyWarning)
+                            converted = mat.asformat(fmt)
+                        structure = converted.tocoo()
+                        ones = scipy.sparse.coo_matrix((np.ones(structure.nnz), (structure.row, structure.col)),
+                                                       shape=mat.shape)
+                        expected = np.array((left @ ones @ right).todense())
+
+                        for engine in SciPySpy(converted).get_engines():
+                            adapter = SciPySpy(converted)
+                            adapter.set_option("engine", engine)
+                            np.testing.assert_array_equal(expected, adapter.get_spy(spy_shape), err_msg=engine)
+
+    def test_window(self):
+        from matspy import to_spy_heatmap
+        from matspy.adapters.scipy_impl import SciPySpy
+        from matspy.heatmap import get_spy_heatmap
+
+        mat = scipy.sparse.random(301, 203, density=0.2, format="coo")
+        options = dict(buckets=40, shading="absolute", shading_absolute_min=0.2, shading_relative_min=0.4,
+                       shading_relative_max_percentile=0.99, precision=None)
+
+        for row_range, col_range in [((0, 301), (0, 203)), ((10, 100), (50, 203)), ((0, 5), (7, 8)),
+                                     ((290, 301), (0, 12))]:
+            submatrix = mat.tocsr()[row_range[0]:row_range[1], col_range[0]:col_range[1]]
+            expected = to_spy_heatmap(submatrix, buckets=40, shading="absolute")
+            for fmt, engine in itertools.product(["coo", "csr", "csc", "lil"], SciPySpy(mat).get_engines()):
+                with self.subTest(fmt=fmt, engine=engine, row_range=row_range, col_range=col_range):
+                    actual = get_spy_heatmap(SciPySpy(mat.asformat(fmt)), row_range=row_range, col_range=col_range,
+                                             engine=engine, **options)
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_engines(self):
+        from matspy import to_spy_heatmap
+        from matspy.adapters.scipy_impl import SciPySpy
+
+        from matspy.adapters import binning
+
+        # Without compiled kernels, tiny bucket counts on a matrix with long rows favor the triple product
+        mat = scipy.sparse.random(3000, 3000, density=0.3, format="csr")
+        saved = binning.NUMBA_MIN_ELEMENTS
+        binning.NUMBA_MIN_ELEMENTS = None
+        try:
+            self.assertEqual("triple_product", SciPySpy(mat).get_engine((4, 4)))
+            self.assertEqual("direct_bincount", SciPySpy(mat).get_engine((500, 500)))
+        finally:
+            binning.NUMBA_MIN_ELEMENTS = saved
+
+        # The compiled kernels bin a matrix with 1e7 elements faster than the triple product, even into few buckets
+        if binning.get_kernels(2**21) is not None:
+            n, row_nnz = 10**5, 100
+            indices = np.random.randint(0, n, n * row_nnz).astype("int32")
+            indptr = np.arange(0, n * row_nnz + 1, row_nnz)
+            large = scipy.sparse.csr_matrix((np.ones(n * row_nnz, dtype=bool), indices, indptr), shape=(n, n))
+            adapter = SciPySpy(large)
+            self.assertLess(adapter.estimate_engine_cost("direct_bincount", (4, 4)),
+                            adapter.estimate_engine_cost("triple_product", (4, 4)))
+            self.assertEqual("direct_bincount", adapter.get_engine((4, 4)))
+
+        with self.assertRaises(ValueError):
+            to_spy_heatmap(mat, engine="graphblas_native")
+        with self.assertRaises(ValueError):
+            to_spy_heatmap(mat, engine="fastest")
+
+    def test_default_chunks(self):
+        from unittest import mock
+        from matspy import to_spy_heatmap
+        from matspy.adapters import binning
+
+        # more elements than fit in the default chunk size
+        n, row_nnz = 50_000, 100
+        indices = np.random.randint(0, n, n * row_nnz).astype("int32")
+        indptr = np.arange(0, n * row_nnz + 1, row_nnz)
+        mat = scipy.sparse.csr_matrix((np.ones(n * row_nnz, dtype=bool), indices, indptr), shape=(n, n))
+        for fmt in ["csr", "coo"]:
+            with self.subTest(fmt=fmt):
+                with mock.patch.object(binning.SpyBinner, "run", autospec=True,
+                                       side_effect=binning.SpyBinner.run) as run:
+                    to_spy_heatmap(mat.asformat(fmt), buckets=10, engine="direct_bincount")
+                tasks = run.call_args[0][2]
+                self.assertGreater(len(tasks), 1)
+
+    def test_numpy_slices(self):
+        from unittest import mock
+        from matspy import to_spy_heatmap
+        from matspy.adapters import binning
+
+        mat = scipy.sparse.random(101, 97, density=0.3, format="lil")
+        mat[5, :] = 1  # a row longer than a slice
+        mat = mat.tocsr()
+        expected = to_spy_heatmap(mat.toarray() != 0, buckets=3, shading="absolute")
+        with mock.patch.object(binning, "NUMBA_MIN_ELEMENTS", None), \
+                mock.patch.object(binning, "NUMPY_CHUNK_ELEMENTS", 7):
+            for fmt in ["csr", "csc", "coo"]:
+                with self.subTest(fmt=fmt):
+                    actual = to_spy_heatmap(mat.asformat(fmt), buckets=3, shading="absolute",
+                                            engine="direct_bincount")
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_bsr(self):
+        from unittest import mock
+        from matspy import to_spy_heatmap
+        from matspy.adapters import binning
+
+        mat = scipy.sparse.random(96, 120, density=0.05, format="csr").tobsr(blocksize=(3, 4))
+        expected = to_spy_heatmap(mat.tocsr(), buckets=20, shading="absolute")
+        for options in [dict(), dict(max_chunk_bytes=2000), dict(workers=3), dict(workers=2, worker_type="process")]:
+            with self.subTest(**options):
+                with mock.patch.object(binning, "get_process_pool", wraps=binning.get_process_pool) as get_pool:
+                    np.testing.assert_array_equal(expected, to_spy_heatmap(mat, buckets=20, shading="absolute",
+                                                                           **options))
+                # all blocks are binned by a single pool run
+                self.assertEqual(1 if options.get("worker_type") == "process" else 0, get_pool.call_count)
+
+    def test_no_conversion(self):
+        from unittest import mock
+        from matspy.adapters.scipy_impl import SciPySpy
+
+        mat = scipy.sparse.random(96, 120, density=0.05, format="csr")
+        for fmt in "bsr", "lil", "dok", "dia":
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", scipy.sparse.SparseEfficiencyWarning)
+                converted = mat.tobsr(blocksize=(3, 4)) if fmt == "bsr" else mat.asformat(fmt)
+            expected = SciPySpy(converted).get_spy((10, 10))
+            for engine in SciPySpy(converted).get_engines():
+                with self.subTest(fmt=fmt, engine=engine):
+                    # the structure is built from the format's own index arrays, without copying values
+                    with mock.patch.object(converted, "tocsr", side_effect=AssertionError), \
+                            mock.patch.object(converted, "tocoo", side_effect=AssertionError):
+                        adapter = SciPySpy(converted)
+                        adapter.set_option("engine", engine)
+                        np.testing.assert_array_equal(expected, adapter.get_spy((10, 10)))
+
+    def test_window_options(self):
+        import matplotlib.pyplot as plt
+
+        mat = scipy.sparse.random(1000, 800, density=0.01, format="csr")
+        fig, ax = spy_to_mpl(mat, row_range=(200, 300), col_range=(100, 150))
+
+        # axes are labeled with matrix indices
+        self.assertEqual((300, 200), ax.get_ylim())
+        self.assertEqual((100, 150), ax.get_xlim())
+        self.assertEqual([100, 150, 300, 200], list(ax.images[0].get_extent()))
+        plt.close(fig)
+
+        self.assertGreater(len(to_sparkline(mat, row_range=(200, 300), col_range=(100, 150))), 10)
+
+    def test_concurrent_figures(self):
+        import matplotlib.pyplot as plt
+        from concurrent.futures import ThreadPoolExecutor
+
+        mats = [scipy.sparse.random(200, 200, density=0.05, format="csr") for _ in range(16)]
+        fignums = plt.get_fignums()
+
+        def render(i):
+            fig, ax = spy_to_mpl(mats[i], title=f"matrix {i}")
+            fig.canvas.draw()
+            return ax.get_title()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            titles = list(executor.map(render, range(len(mats))))
+
+        self.assertEqual([f"matrix {i}" for i in range(len(mats))], titles)
+        # no figures were left open in pyplot
+        self.assertEqual(fignums, plt.get_fignums())
+
+    def test_pyplot_figures(self):
+        import matplotlib.pyplot as plt
+
+        mat = scipy.sparse.random(200, 200, density=0.05, format="csr")
+
+        # pyplot is imported, so figures made on the main thread are shown by plt.show()
+        fig, ax = spy_to_mpl(mat)
+        self.assertIn(fig.number, plt.get_fignums())
+        plt.close(fig)
+
+        fignums = plt.get_fignums()
+        fig, ax = spy_to_mpl(mat, pyplot=False)
+        self.assertEqual(fignums, plt.get_fignums())
+
+    def test_bytes(self):
+        import matplotlib.pyplot as plt
+        from matspy import spy_to_png, spy_to_svg
+
+        mat = scipy.sparse.random(200, 100, density=0.05, format="csr")
+        fignums = plt.get_fignums()
+
+        self.assertTrue(spy_to_png(mat).startswith(b"\x89PNG"))
+
+        raster = spy_to_svg(mat, title="raster")
+        self.assertIn(b"<svg", raster)
+        self.assertEqual(1, raster.count(b"<image"))
+        self.assertIn(b"raster", raster)
+
+        vector = spy_to_svg(mat, raster=False)
+        self.assertIn(b"<svg", vector)
+        self.assertNotIn(b"<image", vector)
+
+        self.assertEqual(fignums, plt.get_fignums())
+
+    def test_interactive(self):
+        import matplotlib.pyplot as plt
+        from matspy import to_spy_heatmap
+        from matspy.spy_renderer import _InteractiveSpy
+        import matspy
+
+        mat = scipy.sparse.random(1000, 1000, density=0.01, format="csr")
+        fig, ax = spy_to_mpl(mat, interactive=True)
+        image = ax.images[0]
+        interactive = _InteractiveSpy(fig, ax, image, matspy._get_spy_adapter(mat), matspy.params.get())
+
+        ax.set_xlim(100, 150)
+        ax.set_ylim(250, 200)
+        interactive.update()
+
+        self.assertEqual([100, 150, 250, 200], list(image.get_extent()))
+        np.testing.assert_array_equal(to_spy_heatmap(mat[200:250, 100:150], buckets=50), image.get_array())
+        plt.close(fig)
+
+    def test_read_only(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from matspy import to_spy_heatmap
+
+        for fmt in "coo", "csr", "csc", "bsr", "dia":
+            with self.subTest(fmt=fmt):
+                if fmt == "dia":
+                    mat = scipy.sparse.diags([1.0, 2.0, 3.0], [-1, 0, 1], shape=(300, 200), format="dia")
+                else:
+                    mat = scipy.sparse.random(300, 200, density=0.1).asformat(fmt)
+                data = mat.data
+                data.flags.writeable = False
+                expected = to_spy_heatmap(mat, buckets=20)
+
+                # render the same matrix from several threads at once
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    results = list(executor.map(lambda _: to_spy_heatmap(mat, buckets=20), range(8)))
+
+                for actual in results:
+                    np.testing.assert_array_equal(expected, actual)
+                self.assertIs(data, mat.data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,7 +11,7 @@ try:
 except ImportError:
     scipy = None
 
-from matspy import to_sparkline
+from matspy import to_sparkline, to_sparklines
 
 numpy.random.seed(123)
 
@@ -32,6 +32,63 @@ class SparklineTests(unittest.TestCase):
                 s = to_sparkline(r, buckets=1)
                 self.assertGreater(len(s), 1)
 
+    def test_batch(self):
+        mats = [scipy.sparse.random(*dims, density=0.2) for dims in [(100, 100), (50, 200), (10, 10)]]
+
+        # shared scale is set by the largest matrix
+        _, scale = to_sparkline(mats[1], retscale=True)
+        expected = [to_sparkline(mat, scale=scale) for mat in mats]
+        self.assertEqual(expected, to_sparklines(mats))
+        self.assertEqual(expected, to_sparklines(mats, workers=2))
+        self.assertEqual([], to_sparklines([]))
+
+        # shared shading is the same as shading each matrix with the statistics of all of them
+        from matspy import to_spy_heatmaps
+        _, stats = to_spy_heatmaps(mats, retstats=True, buckets=10)
+        expected = [to_sparkline(mat, scale=scale, buckets=10, shading_stats=stats) for mat in mats]
+        self.assertEqual(expected, to_sparklines(mats, buckets=10, shared_shading=True))
+
+    def test_batch_parallel(self):
+        from unittest import mock
+        from matspy.adapters import binning
+
+        mats = [scipy.sparse.random(*dims, density=0.2) for dims in [(100, 100), (50, 200), (10, 10)] * 4]
+        for shared_shading in [False, True]:
+            expected = to_sparklines(mats, buckets=10, shared_shading=shared_shading)
+            for worker_type in ["thread", "process"]:
+                with self.subTest(shared_shading=shared_shading, worker_type=worker_type):
+                    # matrices are spread across one pool, and each is binned within its task
+                    with mock.patch.object(binning.SpyBinner, "run", autospec=True,
+                                           side_effect=binning.SpyBinner.run) as run:
+                        actual = to_sparklines(mats, buckets=10, shared_shading=shared_shading, workers=3,
+                                               worker_type=worker_type, chunk_rows=5)
+                    self.assertEqual(expected, actual)
+                    if worker_type == "thread":
+                        self.assertGreater(run.call_count, 0)
+                        self.assertTrue(all(call[0][0].options["workers"] is None for call in run.call_args_list))
+
+    def test_png(self):
+        import base64
+        import io
+        import re
+        from PIL import Image
+        from matspy.png import heatmap_to_png
+
+        heatmap = numpy.array([[0, 0.5, 1], [1, 0, 0.25]])
+        png = heatmap_to_png(heatmap, (1.0, 1.0, 1.0, 1.0), (0.0, 0.0, 1.0, 0.5))
+        image = Image.open(io.BytesIO(png)).convert("RGBA")
+        self.assertEqual((3, 2), image.size)
+        self.assertEqual((255, 255, 255, 255), image.getpixel((0, 0)))
+        self.assertEqual((0, 0, 255, 128), image.getpixel((2, 0)))
+        self.assertEqual((127, 127, 255, 191), image.getpixel((1, 0)))
+
+        # one pixel per bucket, upscaled by the browser
+        mat = scipy.sparse.random(100, 100, density=0.2)
+        sparkline = to_sparkline(mat, buckets=10, html_border=None)
+        self.assertIn("image-rendering: pixelated", sparkline)
+        encoded = re.search(r"base64,([^\"]+)", sparkline).group(1)
+        self.assertEqual((10, 10), Image.open(io.BytesIO(base64.b64decode(encoded))).size)
+
 
 if __name__ == '__main__':
     unittest.main()
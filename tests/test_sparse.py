@@ -2,6 +2,7 @@
 # Use of this source code is governed by the BSD 2-clause license found in the LICENSE.txt file.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import itertools
 import unittest
 
 try:
@@ -57,6 +58,115 @@ class PyDataSparseTests(unittest.TestCase):
             self.assertEqual(len(heatmap), 1)
             self.assertAlmostEqual( count / area, heatmap[0][0], places=2)
 
+    def test_parallel(self):
+        mat = sparse.COO.from_scipy_sparse(scipy.sparse.random(101, 97, density=0.3))
+        for fmt in "coo", "gcxs", "dok", "csr", "csc":
+            expected = to_spy_heatmap(mat.asformat(fmt), buckets=30, shading="absolute")
+            for worker_type in ["thread", "process"]:
+                with self.subTest(fmt=fmt, worker_type=worker_type):
+                    actual = to_spy_heatmap(mat.asformat(fmt), buckets=30, shading="absolute",
+                                            workers=3, worker_type=worker_type)
+                    np.testing.assert_array_equal(expected, actual)
+
+    def test_default_chunks(self):
+        from unittest import mock
+        from matspy.adapters import binning
+
+        # more elements than fit in the default chunk size
+        n, nnz = 50_000, 5_000_000
+        mat = sparse.COO(np.random.randint(0, n, (2, nnz)), data=True, shape=(n, n), has_duplicates=False)
+        with mock.patch.object(binning.SpyBinner, "run", autospec=True, side_effect=binning.SpyBinner.run) as run:
+            to_spy_heatmap(mat, buckets=10, engine="direct_bincount")
+        tasks = run.call_args[0][2]
+        self.assertGreater(len(tasks), 1)
+
+        from matspy.adapters.sparse_impl import PyDataSparseSpy
+
+        dense = np.random.random((31, 5, 43))
+        dense[dense < 0.8] = 0
+        mats = [sparse.COO.from_scipy_sparse(scipy.sparse.random(101, 97, density=0.3)), sparse.COO.from_numpy(dense)]
+        for mat, fmt in itertools.product(mats, ["coo", "gcxs", "dok"]):
+            for row_range, col_range in [(None, None), ((10, 30), (1, 4))]:
+                with self.subTest(shape=mat.shape, fmt=fmt, row_range=row_range):
+                    expected = to_spy_heatmap(mat, buckets=20, shading="absolute", row_range=row_range,
+                                              col_range=col_range, engine="direct_bincount")
+                    actual = to_spy_heatmap(mat.asformat(fmt), buckets=20, shading="absolute", row_range=row_range,
+                                            col_range=col_range, engine="triple_product")
+                    np.testing.assert_array_equal(expected, actual)
+                    self.assertIsInstance(PyDataSparseSpy(mat).get_engine((20, 20)), str)
+
+    def test_not_modified(self):
+        mat = sparse.COO.from_scipy_sparse(scipy.sparse.random(101, 97, density=0.3))
+        expected = to_spy_heatmap(mat, buckets=30)
+        dok = mat.asformat("dok")
+        np.testing.assert_array_equal(expected, to_spy_heatmap(dok, buckets=30))
+        np.testing.assert_array_equal(expected, to_spy_heatmap(dok, buckets=30, row_range=(0, None)))
+        self.assertIsInstance(dok, sparse.DOK)
+
+    def test_axes(self):
+        from matspy.adapters.sparse_impl import PyDataSparseSpy
+
+        dense = np.random.random((31, 5, 43))
+        dense[dense < 0.8] = 0
+        mat = sparse.COO.from_numpy(dense)
+        for axes in [(0, 1), (0, 2), (2, 0), (1, -1)]:
+            # elements along the other axis are counted together
+            counts = (dense != 0).sum(axis=({0, 1, 2} - {axes[0] % 3, axes[1] % 3}).pop())
+            if axes[0] % 3 > axes[1] % 3:
+                counts = counts.T
+            for fmt in "coo", "gcxs", "dok":
+                with self.subTest(axes=axes, fmt=fmt):
+                    adapter = PyDataSparseSpy(mat.asformat(fmt), axes=axes)
+                    self.assertEqual(counts.shape, adapter.get_shape())
+                    np.testing.assert_array_equal(counts, adapter.get_spy(counts.shape))
+
+        # 2D transpose
+        mat = sparse.COO.from_scipy_sparse(scipy.sparse.random(101, 97, density=0.3))
+        for fmt in "coo", "csr", "csc":
+            with self.subTest(fmt=fmt):
+                np.testing.assert_array_equal(to_spy_heatmap(mat.T, buckets=30),
+                                              to_spy_heatmap(PyDataSparseSpy(mat.asformat(fmt), axes=(1, 0)),
+                                                             buckets=30))
+
+        with self.assertRaises(ValueError):
+            PyDataSparseSpy(mat, axes=(1, 1))
+
+        # out of range axes are not wrapped
+        arr3d = sparse.COO.from_numpy(dense)
+        for axes in [(0, 5), (-4, 1), (3, 0)]:
+            with self.subTest(axes=axes):
+                with self.assertRaises(ValueError):
+                    PyDataSparseSpy(arr3d, axes=axes)
+                with self.assertRaises(ValueError):
+                    to_spy_heatmap(arr3d, axes=axes)
+
+    def test_axes_param(self):
+        import matplotlib.pyplot as plt
+        import matspy
+        from matspy.adapters.sparse_impl import PyDataSparseSpy
+
+        dense = np.random.random((31, 5, 43))
+        dense[dense < 0.8] = 0
+        mat = sparse.COO.from_numpy(dense)
+
+        # axes are applied before the shape is used
+        np.testing.assert_array_equal(to_spy_heatmap(PyDataSparseSpy(mat, axes=(0, 2)), buckets=20),
+                                      to_spy_heatmap(mat, buckets=20, axes=(0, 2)))
+        fig, ax = spy_to_mpl(mat, axes=(0, 2))
+        self.assertIn("axes (0, 2)", ax.get_title())
+        plt.close(fig)
+        self.assertIn("width=100 height=72", to_sparkline(mat, axes=(0, 2)))
+
+        # the same array with different axes is cached separately
+        matspy.cache_clear()
+        first = to_spy_heatmap(mat, buckets=10, axes=(0, 2), cache=True)
+        second = to_spy_heatmap(mat, buckets=10, axes=(2, 0), cache=True)
+        self.assertEqual(first.shape[::-1], second.shape)
+        matspy.cache_clear()
+
+        with self.assertRaises(ValueError):
+            to_spy_heatmap(mat, axes=(1, 1))
+
 
 if __name__ == '__main__':
     unittest.main()